@@ -1,12 +1,16 @@
 import datetime
-import requests
+import logging
 import ckan.model as model
 import ckan.plugins.toolkit as tk
+import ckanext.in_app_reporting.client as client
 import ckanext.in_app_reporting.config as mb_config
+import ckanext.in_app_reporting.sync as sync
 import ckanext.in_app_reporting.utils as utils
-from ckanext.in_app_reporting.model import MetabaseMapping
+from ckanext.in_app_reporting.model import MetabaseCard, MetabaseDashboard, MetabaseMapping
 
 
+log = logging.getLogger(__name__)
+
 METABASE_SITE_URL = mb_config.metabase_site_url()
 METABASE_API_KEY = mb_config.metabase_api_key()
 METABASE_DB_ID = mb_config.metabase_db_id()
@@ -40,50 +44,79 @@ def metabase_mapping_delete(context, data_dict):
         raise tk.ValidationError({'error': str(e)})
 
 
+@tk.chained_action
+def member_create(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    if data_dict.get('object_type') == 'user':
+        utils.invalidate_user_roles(data_dict.get('object'))
+    return result
+
+
+@tk.chained_action
+def member_delete(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    if data_dict.get('object_type') == 'user':
+        utils.invalidate_user_roles(data_dict.get('object'))
+    return result
+
+
+@tk.chained_action
+def user_update(up_func, context, data_dict):
+    # Sysadmin, state and password changes all affect the role decisions
+    result = up_func(context, data_dict)
+    utils.invalidate_user_roles(result.get('id') if result else data_dict.get('id'))
+    return result
+
+
+@tk.chained_action
+def user_delete(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    utils.invalidate_user_roles(data_dict.get('id'))
+    return result
+
+
+@tk.chained_action
+def organization_update(up_func, context, data_dict):
+    # The state of an organization affects every member, so drop all decisions
+    result = up_func(context, data_dict)
+    utils.invalidate_user_roles()
+    return result
+
+
+@tk.chained_action
+def organization_delete(up_func, context, data_dict):
+    result = up_func(context, data_dict)
+    utils.invalidate_user_roles()
+    return result
+
+
 @tk.side_effect_free
 def metabase_mapping_show(context, data_dict):
     tk.check_access('metabase_mapping_show', context, data_dict)
 
     user_id = data_dict.get('user_id')
     email = data_dict.get('email')
-    if not user_id and not email:
-        raise tk.ValidationError({'id': 'Provide either user id or email'})
-
-    query = model.Session.query(MetabaseMapping).autoflush(False)
-    if user_id:
-        mapping = query.filter_by(user_id=user_id).first()
-    else:
-        mapping = query.filter_by(email=email).first()
+    platform_uuid = data_dict.get('platform_uuid')
+    if not user_id and not email and not platform_uuid:
+        raise tk.ValidationError({'id': 'Provide either user id, email or platform uuid'})
 
+    mapping = MetabaseMapping.lookup(user_id=user_id, email=email, platform_uuid=platform_uuid)
     if not mapping:
         raise tk.ObjectNotFound('Metabase mapping not found')
 
-    return {
-        "user_id": mapping.user_id,
-        "platform_uuid": mapping.platform_uuid,
-        "email": mapping.email,
-        "group_ids": [g.strip() for g in mapping.group_ids.split(';')],
-        "collection_ids": [c.strip() for c in mapping.collection_ids.split(';')]
-    }
+    return utils.metabase_mapping_dict(mapping)
 
 
 @tk.side_effect_free
 def metabase_mapping_list(context, data_dict):
     tk.check_access('metabase_mapping_list', context, data_dict)
 
-    query = model.Session.query(MetabaseMapping).autoflush(False)
-    mappings = query.all()
-
-    mapping_list = []
-    for mapping in mappings:
-        mapping_list.append({
-            "user_id": mapping.user_id,
-            "platform_uuid": mapping.platform_uuid,
-            "email": mapping.email,
-            "group_ids": [g.strip() for g in mapping.group_ids.split(';')],
-            "collection_ids": [c.strip() for c in mapping.collection_ids.split(';')]
-        })
-    return mapping_list
+    query, fields = utils.metabase_mapping_list_query(
+        data_dict,
+        default_limit=mb_config.mapping_list_limit(),
+        max_limit=mb_config.mapping_list_max_limit()
+    )
+    return [utils.metabase_mapping_dict(mapping, fields) for mapping in query]
 
 
 @tk.side_effect_free
@@ -167,6 +200,69 @@ def metabase_user_created_dashboards_list(context, data_dict):
     return dashboards
 
 
+@tk.side_effect_free
+def metabase_iframe_urls(context, data_dict):
+    """
+    Build static embedding iframe URLs for several cards and dashboards in
+    one call. Cached tokens are reused; in manage service mode the token
+    service returns one token per request, so the missing ones are
+    requested concurrently, one request per item.
+
+    Args:
+        items: List of dictionaries with model_type (question or dashboard)
+            and entity_id, and optional bordered, titled and downloads flags
+
+    Returns:
+        Dictionary mapping entity_id to iframe URL
+    """
+    tk.check_access('metabase_embed', context, data_dict)
+
+    items = data_dict.get('items')
+    if not isinstance(items, list):
+        raise tk.ValidationError({'items': 'List of items required'})
+    for item in items:
+        if not isinstance(item, dict) or not item.get('entity_id') \
+                or item.get('model_type') not in ['question', 'dashboard']:
+            raise tk.ValidationError(
+                {'items': 'Each item requires an entity_id and a model_type of question or dashboard'})
+
+    return utils.get_metabase_iframe_urls(items)
+
+
+def _response_item(response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def _forget_collection_items(item):
+    # The item is listed in its collection, or one of the configured ones
+    # when Metabase did not say which
+    collection_id = item.get('collection_id') if isinstance(item, dict) else None
+    if collection_id is not None:
+        utils.invalidate_collection_items(collection_id)
+    else:
+        utils.invalidate_collection_items()
+
+
+def _add_to_catalog(index, upsert, item):
+    '''
+    Upsert an item created or published through CKAN into the local catalog,
+    from the item Metabase returns, so that the pickers list it before the
+    next sync. Nothing is added before the catalog's first full sync, which
+    would otherwise be skipped.
+    '''
+    if not isinstance(item, dict) or not item.get('id') or not index.is_populated():
+        return
+    try:
+        upsert(item)
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        log.exception('Failed to add Metabase item %s to the local catalog', item.get('id'))
+
+
 def metabase_card_publish(context, data_dict):
     tk.check_access('metabase_card_publish', context, data_dict)
 
@@ -184,8 +280,12 @@ def metabase_card_publish(context, data_dict):
     }
 
     # Call Metabase API to publish
-    response = requests.put(metabase_url, json=payload, headers=headers)
+    response = client.put(metabase_url, json=payload, headers=headers)
     if response.status_code == 200:
+        utils.mark_metabase_embeddable('card', card_id)
+        item = _response_item(response)
+        _forget_collection_items(item)
+        _add_to_catalog(MetabaseCard, sync.upsert_card, item)
         return {'success': True}
     else:
         raise tk.ValidationError({'error': 'Failed to publish card'})
@@ -210,7 +310,7 @@ def metabase_dashboard_publish(context, data_dict):
 
     # If configured, enable parameters
     if data_dict.get('enable_params'):
-        dashboard = requests.get(metabase_url, headers=headers)
+        dashboard = client.get(metabase_url, headers=headers)
         dashboard = dashboard.json()
         embedding_params = {}
         for parameter in dashboard.get('parameters', []):
@@ -218,8 +318,12 @@ def metabase_dashboard_publish(context, data_dict):
         payload['embedding_params'] = embedding_params
 
     # Call Metabase API to publish
-    response = requests.put(metabase_url, json=payload, headers=headers)
+    response = client.put(metabase_url, json=payload, headers=headers)
     if response.status_code == 200:
+        utils.mark_metabase_embeddable('dashboard', dashboard_id)
+        item = _response_item(response)
+        _forget_collection_items(item)
+        _add_to_catalog(MetabaseDashboard, sync.upsert_dashboard, item)
         return {'success': True}
     else:
         raise tk.ValidationError({'error': 'Failed to publish dashboard'})
@@ -289,6 +393,10 @@ def metabase_model_create(context, data_dict):
     response = utils.metabase_post_request(
         f'{METABASE_SITE_URL}/api/card', model_dict)
     if response:
+        utils.invalidate_metadata('cards:database')
+        utils.invalidate_collection_items(model_dict['collection_id'])
+        # Make the new model visible to the local card catalog right away
+        _add_to_catalog(MetabaseCard, sync.upsert_card, response)
         return response
     else:
         raise tk.ValidationError({'error': 'Failed to publish card'})
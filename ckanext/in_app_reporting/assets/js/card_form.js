@@ -1,23 +1,13 @@
 globalThis.cardId = null;
 ckan.module('get-metabase-chart-list', function (jQuery) {
+    const PAGE_SIZE = 20;
+
     return {
         initialize: function () {
-            const that = this;
-            that.embeddable_list = this.el.data('embeddable');
-
-            // Populate dropdown
-            $.getJSON(this.options.source, function (data) {
-                that.collection_items = data.results;
-                that.setup();
-                // Hide spinner and show select2 dropdown
-                $('#chart-loading').hide();
-                $('#chart-selection').show();
-            }).fail(function() {
-                // Show error state if loading fails
-                $('#chart-loading').hide();
-                $('#chart-selection').show();
-                $('#chart-error').show();
-            });
+            this.setup();
+            // Hide spinner and show select2 dropdown
+            $('#chart-loading').hide();
+            $('#chart-selection').show();
         },
 
         formatResult: function (result) {
@@ -26,11 +16,10 @@ ckan.module('get-metabase-chart-list', function (jQuery) {
             return markup;
         },
 
-        onSelectOption: function(entity_id) {
-            var option = $.grep(this.collection_items, function(e){ return e.entity_id == entity_id; })[0];
+        onSelectOption: function(option) {
             $('#field-title').val(option.name).trigger('keyup');
             $('#field-description').val(option.description).trigger('keyup');
-            if (this.embeddable_list.includes(option.id)) {
+            if (option.embeddable) {
                 globalThis.cardId = null;
                 $('#publish-warning').html("");
                 $('#publish-warning').hide();
@@ -58,17 +47,39 @@ ckan.module('get-metabase-chart-list', function (jQuery) {
                 escapeMarkup: function (markup) {
                     return markup;
                 },
-                matcher: function(term, text) {
-                    return text.toUpperCase().indexOf(term.toUpperCase()) >= 0;
+                // Search and paginate on the server, one page at a time
+                ajax: {
+                    url: this.options.source,
+                    dataType: 'json',
+                    quietMillis: 250,
+                    data: function (term, page) {
+                        return {
+                            q: term,
+                            limit: PAGE_SIZE,
+                            offset: (page - 1) * PAGE_SIZE
+                        };
+                    },
+                    results: function (data, page) {
+                        return {results: data.results, more: data.more};
+                    },
+                    params: {
+                        error: function () {
+                            $('#chart-error').show();
+                        }
+                    }
                 },
-                data: this.collection_items
+                initSelection: function (element, callback) {
+                    var entity_id = element.val();
+                    callback({entity_id: entity_id, name: $('#field-title').val() || entity_id});
+                }
             };
 
             var select2 = this.el.select2(settings);
 
             this.el.on("change", function(e) {
-                const entity_id = e.target.value;
-                that.onSelectOption(entity_id);
+                if (e.added) {
+                    that.onSelectOption(e.added);
+                }
             });
 
             this._select2 = select2;
@@ -0,0 +1,206 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+
+import ckanext.in_app_reporting.client as client
+import ckanext.in_app_reporting.config as mb_config
+import ckanext.in_app_reporting.metrics as metrics
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+log = logging.getLogger(__name__)
+
+# Batches of every thread run on one long-lived event loop in a background
+# thread, with one httpx.AsyncClient bound to it so that connections are kept
+# alive between batches. Rebuilt after a fork.
+_state_lock = threading.Lock()
+_shared_state = None
+
+
+def is_enabled():
+    '''Whether batches of Metabase GETs run on an event loop.'''
+    return httpx is not None and mb_config.async_client_enabled()
+
+
+def can_run():
+    '''Whether the async client is enabled and no event loop already runs in this thread.'''
+    if not is_enabled():
+        return False
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return True
+    return False
+
+
+def _timeout(remaining):
+    return httpx.Timeout(
+        min(mb_config.catalog_read_timeout(), remaining),
+        connect=min(mb_config.http_connect_timeout(), remaining)
+    )
+
+
+async def _send_with_retries(http, url, headers, deadline):
+    retries = mb_config.http_retries()
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise httpx.TimeoutException('Metabase request deadline exceeded: GET {0}'.format(url))
+        try:
+            response = await http.get(url, headers=headers, timeout=_timeout(remaining))
+        except httpx.TransportError as e:
+            response = None
+            error = e
+        else:
+            if response.status_code not in client.RETRY_STATUSES:
+                return response
+        delay = client._backoff(attempt)
+        if attempt >= retries or time.monotonic() + delay >= deadline:
+            if response is None:
+                raise error
+            return response
+        log.warning('Retrying Metabase request GET %s (attempt %s of %s)', url, attempt + 1, retries)
+        metrics.observe_retry('GET', metrics.endpoint_template(url))
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def get_json(http, url, headers=None):
+    '''
+    GET a Metabase API URL on an httpx.AsyncClient and return the parsed
+    JSON, or None on failure.
+
+    Follows the synchronous client: the host's circuit breaker, the connect
+    and catalog read timeouts, bounded retries of transient failures within
+    the request deadline, and the request metrics.
+    '''
+    endpoint = metrics.endpoint_template(url)
+    breaker = client.get_breaker(url)
+    if not breaker.allow():
+        metrics.observe_request('GET', endpoint, 'circuit_open', 0)
+        return None
+    started = time.monotonic()
+    try:
+        response = await _send_with_retries(
+            http, url, headers, started + mb_config.http_request_deadline())
+    except Exception:
+        breaker.record_failure()
+        metrics.observe_request('GET', endpoint, 'error', time.monotonic() - started)
+        log.warning('Metabase request GET %s failed', url, exc_info=True)
+        return None
+    if response.status_code in client.FAILURE_STATUSES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    metrics.observe_request('GET', endpoint, response.status_code,
+                            time.monotonic() - started, len(response.content))
+    if response.status_code != 200:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+class _LoopState(object):
+    def __init__(self):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        concurrency = max(1, mb_config.async_client_concurrency())
+        self.http = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=concurrency, max_keepalive_connections=concurrency))
+        # URL -> task of the request in flight on the loop
+        self.in_flight = {}
+        self.thread = threading.Thread(
+            target=self.loop.run_forever,
+            name='metabase-async-client',
+            daemon=True
+        )
+        self.thread.start()
+
+    def close(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self.http.aclose(), self.loop).result(timeout=5)
+        except Exception:
+            log.debug('Failed to close the async Metabase client', exc_info=True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        if not self.loop.is_running():
+            self.loop.close()
+
+
+def _state():
+    global _shared_state
+    with _state_lock:
+        if _shared_state is None or _shared_state.pid != os.getpid():
+            _shared_state = _LoopState()
+        return _shared_state
+
+
+def _get_shared(state, url, headers):
+    '''
+    Return the task fetching a URL on this loop, starting it unless the same
+    URL is already in flight, like metabase_get_request does across threads.
+    '''
+    task = state.in_flight.get(url)
+    if task is None:
+        task = state.loop.create_task(get_json(state.http, url, headers))
+        state.in_flight[url] = task
+        task.add_done_callback(lambda _: state.in_flight.pop(url, None))
+    return task
+
+
+async def get_json_many(urls, headers=None, concurrency=None):
+    '''
+    GET many Metabase API URLs concurrently on the shared event loop, with
+    at most ``concurrency`` requests in flight (by default the
+    async_client_concurrency setting). Must be run with ``run``.
+
+    Requests share the process' client, and so its kept-alive connections.
+    A URL already in flight on the loop, e.g. repeated in ``urls``, is
+    fetched once and its parsed result shared, which callers must not mutate.
+
+    Returns:
+        The parsed JSON responses in the order of the URLs, None for failures
+    '''
+    state = _state()
+    if asyncio.get_running_loop() is not state.loop:
+        raise RuntimeError('get_json_many must be run with async_client.run')
+    concurrency = max(1, concurrency or mb_config.async_client_concurrency())
+    # Like requests, leave out headers without a value
+    headers = {name: value for name, value in (headers or {}).items() if value is not None}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(url):
+        async with semaphore:
+            return await asyncio.shield(_get_shared(state, url, headers))
+    return await asyncio.gather(*(bounded(url) for url in urls))
+
+
+def run(coroutine):
+    '''
+    Run a coroutine to completion from synchronous code and return its
+    result, on the shared event loop. The calling thread blocks meanwhile.
+    '''
+    return asyncio.run_coroutine_threadsafe(coroutine, _state().loop).result()
+
+
+def close():
+    '''Close the client and stop the event loop of this process.'''
+    global _shared_state
+    with _state_lock:
+        state, _shared_state = _shared_state, None
+    # After a fork the loop thread of the parent does not exist in the child
+    if state is not None and state.pid == os.getpid():
+        state.close()
+
+
+atexit.register(close)
@@ -1,10 +1,13 @@
+import hmac
+import json
 import logging
-from flask import Blueprint, request
+from flask import Blueprint, Response, request, stream_with_context
 from flask.views import MethodView
 from urllib.parse import urlencode, urljoin
 
 import ckan.model as model
 import ckan.plugins.toolkit as tk
+import ckanext.in_app_reporting.metrics as metrics
 import ckanext.in_app_reporting.utils as utils
 import ckanext.in_app_reporting.config as mb_config
 
@@ -15,6 +18,44 @@ METABASE_SITE_URL = mb_config.metabase_site_url()
 collection_ids = mb_config.collection_ids()
 metabase = Blueprint(u'metabase', __name__)
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Mappings loaded from the database at a time by the NDJSON export
+MAPPING_EXPORT_BATCH_SIZE = 1000
+
+
+def _page_args():
+    '''Read the q/limit/offset paging arguments of a picker request.'''
+    q = request.args.get('q', '').strip() or None
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        offset = 0
+    return q, min(max(limit, 1), MAX_PAGE_SIZE), max(offset, 0)
+
+
+def _page_response(items, limit):
+    '''Build a select2 page from a list fetched with one extra item.'''
+    return {
+        'results': items[:limit],
+        'more': len(items) > limit
+    }
+
+
+def _metrics_authorized():
+    '''Sysadmins, or scrapers sending the configured bearer token.'''
+    token = mb_config.metrics_token()
+    if token and hmac.compare_digest(
+            request.headers.get('Authorization', ''), 'Bearer {0}'.format(token)):
+        return True
+    userobj = tk.g.userobj
+    return bool(userobj and userobj.sysadmin)
+
 
 class MetabaseView(MethodView):
     def metabase_embed():
@@ -166,11 +207,10 @@ class MetabaseView(MethodView):
             tk.check_access('metabase_embed', context, {})
             if model_type == 'question':
                 model_type = 'card'
-            embeddable_list = utils.get_metabase_collection_items(model_type)
-            data = {
-                'results': embeddable_list
-            }
-            return data
+            q, limit, offset = _page_args()
+            embeddable_list = utils.get_metabase_collection_items(
+                model_type, q=q, limit=limit + 1, offset=offset)
+            return _page_response(utils.with_embeddable_flag(embeddable_list, model_type), limit)
         except tk.NotAuthorized:
             tk.abort(404, tk._(u'Resource not found'))
 
@@ -187,11 +227,10 @@ class MetabaseView(MethodView):
             resource = tk.get_action('resource_show')(None, {'id': resource_id})
 
             table_id = utils.get_metabase_table_id(resource_id)
-            chart_list = utils.get_metabase_chart_list(table_id, resource_id)
-            data = {
-                'results': chart_list
-            }
-            return data
+            q, limit, offset = _page_args()
+            chart_list = utils.get_metabase_chart_list(
+                table_id, resource_id, q=q, limit=limit + 1, offset=offset)
+            return _page_response(utils.with_embeddable_flag(chart_list, 'card'), limit)
         except (tk.ObjectNotFound, tk.NotAuthorized):
             tk.abort(404, tk._('Resource not found'))
 
@@ -279,6 +318,39 @@ class MetabaseView(MethodView):
         except (tk.NotAuthorized, tk.ValidationError):
             tk.abort(404, tk._('Resource not found'))
 
+    def metabase_metrics():
+        """Expose the Metabase client metrics of this process to Prometheus."""
+        if not mb_config.metrics_enabled() or not _metrics_authorized():
+            tk.abort(404, tk._(u'Resource not found'))
+        return Response(
+            metrics.render_prometheus(),
+            mimetype='text/plain; version=0.0.4; charset=utf-8'
+        )
+
+    def metabase_mapping_export():
+        """
+        Stream the Metabase mappings as newline-delimited JSON, one mapping
+        per line, for sysadmins. Takes the metabase_mapping_list arguments.
+        """
+        context = {
+            u'model': model,
+            u'user': tk.g.user,
+            u'auth_user_obj': tk.g.userobj
+        }
+        try:
+            tk.check_access('metabase_mapping_list', context, {})
+            query, fields = utils.metabase_mapping_list_query(request.args.to_dict())
+        except tk.NotAuthorized:
+            tk.abort(404, tk._('Resource not found'))
+        except tk.ValidationError as e:
+            tk.abort(400, str(e))
+
+        def generate():
+            for mapping in query.yield_per(MAPPING_EXPORT_BATCH_SIZE):
+                yield json.dumps(utils.metabase_mapping_dict(mapping, fields)) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 
 metabase.add_url_rule(
     u'/insights',
@@ -341,3 +413,15 @@ metabase.add_url_rule(
     methods=[u'GET'],
     endpoint='user_created_dashboards_page'
 )
+
+metabase.add_url_rule(
+    u'/metabase/metrics',
+    view_func=MetabaseView.metabase_metrics,
+    methods=[u'GET']
+)
+
+metabase.add_url_rule(
+    u'/api/metabase/mappings.ndjson',
+    view_func=MetabaseView.metabase_mapping_export,
+    methods=[u'GET']
+)
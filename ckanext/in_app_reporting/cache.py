@@ -0,0 +1,298 @@
+import functools
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_request_context
+
+import ckanext.in_app_reporting.metrics as metrics
+
+
+log = logging.getLogger(__name__)
+
+_REQUEST_CACHE_ATTR = '_in_app_reporting_memo'
+_MISSING = object()
+
+
+def _request_cache():
+    cache = getattr(g, _REQUEST_CACHE_ATTR, None)
+    if cache is None:
+        cache = {}
+        setattr(g, _REQUEST_CACHE_ATTR, cache)
+    return cache
+
+
+def request_memoize(func):
+    '''
+    Memoize a function for the lifetime of the current Flask request.
+
+    Results are stored on ``flask.g`` keyed on the function and its
+    arguments, so repeated calls while rendering one page only run once.
+    Calls made outside of a request, e.g. from CLI commands or background
+    jobs whose app context lives for many items, or with unhashable
+    arguments, are passed straight through.
+    '''
+    func_key = '{0}.{1}'.format(func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not has_request_context():
+            return func(*args, **kwargs)
+        key = (func_key, args, frozenset(kwargs.items()))
+        cache = _request_cache()
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return func(*args, **kwargs)
+        result = func(*args, **kwargs)
+        cache[key] = result
+        return result
+
+    return wrapper
+
+
+class TTLCache(object):
+    '''
+    Thread-safe, size bounded in-process cache with per-entry expiry.
+
+    The least recently used entry is evicted once ``maxsize`` is reached.
+    A ``ttl`` of zero or less disables caching entirely.
+    '''
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        '''Store a value, optionally overriding the cache ttl for this entry.'''
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Collapse concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for and share its result, or its exception.
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class RedisBackend(object):
+    '''
+    Cache backend shared by every worker and node, stored in CKAN's Redis.
+
+    Values are stored as JSON under ``prefix`` and expire in Redis after
+    their ttl. Redis errors are logged and treated as cache misses.
+    '''
+
+    def __init__(self, prefix, connection=None):
+        if connection is None:
+            from ckan.lib.redis import connect_to_redis
+            connection = connect_to_redis()
+        self.prefix = prefix
+        self._redis = connection
+
+    def _key(self, key):
+        return '{0}{1}'.format(self.prefix, key)
+
+    def get(self, key, default=None):
+        try:
+            value = self._redis.get(self._key(key))
+        except Exception:
+            log.warning('Failed to read %s from the Redis cache', key, exc_info=True)
+            return default
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        try:
+            self._redis.set(self._key(key), json.dumps(value), px=int(ttl * 1000))
+        except Exception:
+            log.warning('Failed to write %s to the Redis cache', key, exc_info=True)
+
+    def delete(self, key):
+        try:
+            self._redis.delete(self._key(key))
+        except Exception:
+            log.warning('Failed to delete %s from the Redis cache', key, exc_info=True)
+
+    def clear(self):
+        try:
+            keys = list(self._redis.scan_iter(match=self._key('*')))
+            if keys:
+                self._redis.delete(*keys)
+        except Exception:
+            log.warning('Failed to clear the Redis cache', exc_info=True)
+
+
+class MetadataCache(object):
+    '''
+    Read-through cache for Metabase metadata over a pluggable backend.
+
+    Entries are refreshed early with probabilistic early expiration
+    (XFetch): the closer an entry is to expiring, and the longer it took to
+    compute, the more likely a reader is to recompute it ahead of time, so
+    that hot keys do not expire for every worker at once. Recomputations of
+    the same key within a process are collapsed into one. Computations that
+    return None are treated as failures and not cached; the previous value
+    is served instead while it is still stored.
+    '''
+
+    def __init__(self, backend, ttl, beta=1.0, name='metadata'):
+        self.backend = backend
+        self.ttl = ttl
+        self.beta = beta
+        self.name = name
+        self._flight = SingleFlight()
+
+    def get_or_compute(self, key, compute, ttl=None, fresh=False):
+        '''
+        Return the cached value of a key, computing and storing it when it
+        is missing, close to expiry or ``fresh`` is set.
+        '''
+        entry = None if fresh else self.backend.get(key)
+        if entry is not None and not self._expires_early(entry):
+            metrics.observe_cache(self.name, hit=True)
+            return entry['value']
+        metrics.observe_cache(self.name, hit=False)
+        return self._flight.do(key, self._compute, key, compute, ttl, entry)
+
+    def set(self, key, value, ttl=None):
+        '''
+        Store a value computed elsewhere, e.g. to write a change made through
+        CKAN through to the cache. It is not refreshed early.
+        '''
+        if ttl is None:
+            ttl = self.ttl
+        self.backend.set(key, {
+            'value': value,
+            'delta': 0,
+            'expiry': time.time() + ttl
+        }, ttl)
+
+    def update(self, key, update):
+        '''
+        Replace the cached value of a key with ``update(value)`` and keep its
+        expiry, e.g. to apply a change made through CKAN without a refetch.
+        Nothing is stored when the key is not cached.
+        '''
+        entry = self.backend.get(key)
+        if entry is None:
+            return
+        ttl = entry['expiry'] - time.time()
+        if ttl > 0:
+            self.backend.set(key, dict(entry, value=update(entry['value'])), ttl)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def _expires_early(self, entry):
+        # -log(u) for u in (0, 1] is an exponentially distributed head start
+        head_start = -entry['delta'] * self.beta * math.log(1.0 - random.random())
+        return time.time() + head_start >= entry['expiry']
+
+    def _compute(self, key, compute, ttl, stale_entry):
+        if ttl is None:
+            ttl = self.ttl
+        started = time.time()
+        value = compute()
+        if value is None:
+            return stale_entry['value'] if stale_entry is not None else None
+        now = time.time()
+        self.backend.set(key, {
+            'value': value,
+            'delta': now - started,
+            'expiry': now + ttl
+        }, ttl)
+        return value
+
+
+def get_backend(name, maxsize, ttl, prefix):
+    '''Build the ``memory`` or ``redis`` metadata cache backend.'''
+    if name == 'redis':
+        return RedisBackend(prefix)
+    if name != 'memory':
+        log.warning('Unknown cache backend %s, using the in-process cache', name)
+    return TTLCache(maxsize, ttl)
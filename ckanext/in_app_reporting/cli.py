@@ -4,6 +4,7 @@ import click
 import datetime
 import ckantoolkit as tk
 import ckan.model as model
+import ckanext.in_app_reporting.sync as sync
 import ckanext.in_app_reporting.utils as utils
 
 
@@ -74,3 +75,57 @@ def remove(user_id):
     except Exception as e:
         tk.error_shout(e)
         raise click.Abort()
+
+
+@metabase.command(u'index-cards')
+def index_cards():
+    '''
+        Rebuild the local index of Metabase cards and the resources
+        referenced by their native SQL
+    '''
+    try:
+        count = sync.rebuild_card_index()
+        click.echo('Indexed {} Metabase cards'.format(count))
+    except Exception as e:
+        tk.error_shout(e)
+        raise click.Abort()
+
+
+@metabase.command(u'sync-cards')
+@click.option(u'--full', is_flag=True, help=u'Rebuild the whole catalog instead of syncing changes')
+@click.option(u'--enqueue', is_flag=True, help=u'Run the sync as a background job')
+def sync_cards(full, enqueue):
+    '''
+        Sync the local Metabase card catalog with cards changed since the
+        last run
+    '''
+    try:
+        if enqueue:
+            job = sync.enqueue_card_sync(full=full)
+            click.echo('Enqueued Metabase card sync job {}'.format(job.id))
+            return
+        count = sync.sync_cards(full=full)
+        click.echo('Synced {} Metabase cards'.format(count))
+    except Exception as e:
+        tk.error_shout(e)
+        raise click.Abort()
+
+
+@metabase.command(u'sync-dashboards')
+@click.option(u'--full', is_flag=True, help=u'Rebuild the whole catalog instead of syncing changes')
+@click.option(u'--enqueue', is_flag=True, help=u'Run the sync as a background job')
+def sync_dashboards(full, enqueue):
+    '''
+        Sync the local Metabase dashboard catalog with dashboards changed
+        since the last run
+    '''
+    try:
+        if enqueue:
+            job = sync.enqueue_dashboard_sync(full=full)
+            click.echo('Enqueued Metabase dashboard sync job {}'.format(job.id))
+            return
+        count = sync.sync_dashboards(full=full)
+        click.echo('Synced {} Metabase dashboards'.format(count))
+    except Exception as e:
+        tk.error_shout(e)
+        raise click.Abort()
@@ -0,0 +1,317 @@
+import logging
+import os
+import random
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import ckanext.in_app_reporting.config as mb_config
+import ckanext.in_app_reporting.metrics as metrics
+
+
+log = logging.getLogger(__name__)
+
+# Call classes, each with its own read timeout
+CATALOG = 'catalog'
+PUBLISH = 'publish'
+TOKEN = 'token'
+
+# Transient statuses worth retrying on idempotent requests
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+# Statuses that count as a Metabase failure for the circuit breaker, along
+# with connection errors and timeouts. A 500 is left out: one broken card or
+# query must not take down embedding for the whole site
+FAILURE_STATUSES = frozenset([502, 503, 504])
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    '''Raised without contacting Metabase while its circuit is open.'''
+
+
+class CircuitBreaker(object):
+    '''
+    Consecutive failure circuit breaker.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls fail fast. Once ``reset_timeout`` seconds have passed a single
+    trial call is let through: its success closes the circuit, its failure
+    opens it again. A threshold of zero or less disables the breaker.
+    '''
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _cooling_down(self):
+        return self._opened_at is not None and \
+            time.monotonic() - self._opened_at < self.reset_timeout
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._cooling_down()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._cooling_down() or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self.failure_threshold <= 0:
+                return
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    log.warning('Metabase circuit opened after %s consecutive failures', self._failures)
+                self._opened_at = time.monotonic()
+
+
+def _build_session():
+    '''Create a requests session backed by a pooled, keep-alive adapter.'''
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=mb_config.http_pool_connections(),
+        pool_maxsize=mb_config.http_pool_maxsize(),
+        pool_block=mb_config.http_pool_block()
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    # Metabase calls are authenticated per request, so never share cookies
+    # between the threads that use this session
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session():
+    '''
+    Return the process-wide Metabase session.
+
+    The session is created lazily and rebuilt after a fork, so every worker
+    process owns its own connection pool.
+    '''
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def close_session():
+    '''Close the pooled connections held by this process.'''
+    global _session, _session_pid
+    with _session_lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
+        _session_pid = None
+
+
+def get_breaker(url):
+    '''Return the circuit breaker of the host a URL points to.'''
+    host = urlsplit(url or '').netloc
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(host)
+            if breaker is None:
+                breaker = _breakers[host] = CircuitBreaker(
+                    mb_config.circuit_failure_threshold(),
+                    mb_config.circuit_reset_timeout()
+                )
+    return breaker
+
+
+def is_available(url):
+    '''Whether requests to the host of a URL are currently let through.'''
+    return not get_breaker(url).is_open
+
+
+def reset_circuits():
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def _read_timeout(call_class):
+    if call_class == PUBLISH:
+        return mb_config.publish_read_timeout()
+    if call_class == TOKEN:
+        return mb_config.token_read_timeout()
+    return mb_config.catalog_read_timeout()
+
+
+def _backoff(attempt):
+    '''Full jitter exponential backoff delay for a retry attempt.'''
+    return random.uniform(0, mb_config.http_retry_backoff() * (2 ** attempt))
+
+
+def _send_with_retries(method, url, call_class, **kwargs):
+    send = getattr(get_session(), method.lower())
+    retries = mb_config.http_retries() if method in IDEMPOTENT_METHODS else 0
+    connect_timeout = mb_config.http_connect_timeout()
+    read_timeout = _read_timeout(call_class)
+    deadline = time.monotonic() + mb_config.http_request_deadline()
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout('Metabase request deadline exceeded: {0} {1}'.format(method, url))
+        timeout = (min(connect_timeout, remaining), min(read_timeout, remaining))
+        try:
+            response = send(url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            response = None
+            error = e
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                return response
+        delay = _backoff(attempt)
+        if attempt >= retries or time.monotonic() + delay >= deadline:
+            if response is None:
+                raise error
+            return response
+        log.warning('Retrying Metabase request %s %s (attempt %s of %s)',
+                    method, url, attempt + 1, retries)
+        metrics.observe_retry(method, metrics.endpoint_template(url))
+        if response is not None:
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def request(method, url, call_class=CATALOG, **kwargs):
+    '''
+    Send a request to Metabase with timeouts, retries and a deadline.
+
+    Every attempt uses the connect timeout and the read timeout of its call
+    class, both capped by the time left before the request deadline.
+    Idempotent requests are retried with jittered exponential backoff on
+    connection errors, timeouts and transient statuses, as long as the
+    deadline allows. Other requests are sent once.
+
+    Each Metabase host has a circuit breaker. Once it is open requests
+    fail fast with CircuitOpenError instead of waiting for a timeout.
+
+    Args:
+        method: HTTP method
+        url: Request URL
+        call_class: One of CATALOG, PUBLISH or TOKEN
+        kwargs: Passed on to the session
+
+    Returns:
+        The response of the last attempt
+
+    Raises:
+        requests.RequestException: if the last attempt failed
+        CircuitOpenError: if the circuit of the host is open
+    '''
+    method = method.upper()
+    endpoint = metrics.endpoint_template(url)
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        metrics.observe_request(method, endpoint, 'circuit_open', 0)
+        raise CircuitOpenError('Metabase is unavailable: {0} {1}'.format(method, url))
+    started = time.monotonic()
+    try:
+        response = _send_with_retries(method, url, call_class, **kwargs)
+    except Exception:
+        breaker.record_failure()
+        _observe(method, endpoint, 'error', started)
+        raise
+    if response.status_code in FAILURE_STATUSES:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    if kwargs.get('stream'):
+        _observe(method, endpoint, response.status_code, started)
+        _observe_streamed_bytes(method, endpoint, response)
+    else:
+        _observe(method, endpoint, response.status_code, started, _received_bytes(response))
+    return response
+
+
+def _observe_streamed_bytes(method, endpoint, response):
+    '''
+    Record the size of a streamed response when it is closed. Its body is
+    only read as the caller consumes it, and chunked responses carry no
+    Content-Length, so the loaded content or the bytes read from the raw
+    stream are counted.
+    '''
+    close = response.close
+    closed = []
+
+    def close_and_observe():
+        if not closed:
+            closed.append(True)
+            received = _received_bytes(response)
+            if not received:
+                try:
+                    received = response.raw.tell()
+                except Exception:
+                    received = 0
+            if isinstance(received, int):
+                metrics.observe_bytes(method, endpoint, received)
+        close()
+
+    response.close = close_and_observe
+
+
+def _received_bytes(response):
+    length = response.headers.get('Content-Length') if hasattr(response, 'headers') else None
+    if isinstance(length, str) and length.isdigit():
+        return int(length)
+    content = getattr(response, '_content', None)
+    if isinstance(content, bytes):
+        return len(content)
+    return 0
+
+
+def _observe(method, endpoint, status, started, received=0):
+    seconds = time.monotonic() - started
+    metrics.observe_request(method, endpoint, status, seconds, received)
+    threshold = mb_config.slow_call_threshold()
+    if threshold > 0 and seconds >= threshold:
+        log.warning('Slow Metabase request %s %s took %.2fs (status %s)',
+                    method, endpoint, seconds, status)
+
+
+def get(url, call_class=CATALOG, **kwargs):
+    return request('GET', url, call_class=call_class, **kwargs)
+
+
+def post(url, call_class=PUBLISH, **kwargs):
+    return request('POST', url, call_class=call_class, **kwargs)
+
+
+def put(url, call_class=PUBLISH, **kwargs):
+    return request('PUT', url, call_class=call_class, **kwargs)
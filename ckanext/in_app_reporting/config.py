@@ -83,3 +83,172 @@ def group_ids():
     if not group_ids:
         log.error('ckanext.in_app_reporting.group_ids is not set')
     return group_ids
+
+
+def http_pool_connections():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.http_pool_connections', 4))
+
+
+def http_pool_maxsize():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.http_pool_maxsize', 20))
+
+
+def http_pool_block():
+    return tk.asbool(tk.config.get(
+        'ckanext.in_app_reporting.http_pool_block', False))
+
+
+def role_cache_ttl():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.role_cache_ttl', 300))
+
+
+def role_cache_size():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.role_cache_size', 10000))
+
+
+def table_index_ttl():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.table_index_ttl', 600))
+
+
+def table_index_miss_refresh_interval():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.table_index_miss_refresh_interval', 30))
+
+
+def embed_token_cache_size():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.embed_token_cache_size', 1000))
+
+
+def embed_token_expiry_margin():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.embed_token_expiry_margin', 60))
+
+
+def http_connect_timeout():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.http_connect_timeout', 3.05))
+
+
+def catalog_read_timeout():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.catalog_read_timeout', 30))
+
+
+def publish_read_timeout():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.publish_read_timeout', 15))
+
+
+def token_read_timeout():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.token_read_timeout', 10))
+
+
+def http_retries():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.http_retries', 2))
+
+
+def http_retry_backoff():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.http_retry_backoff', 0.5))
+
+
+def http_request_deadline():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.http_request_deadline', 60))
+
+
+def circuit_failure_threshold():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.circuit_failure_threshold', 5))
+
+
+def circuit_reset_timeout():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.circuit_reset_timeout', 30))
+
+
+def metadata_cache_backend():
+    return tk.config.get(
+        'ckanext.in_app_reporting.metadata_cache_backend', 'memory')
+
+
+def metadata_cache_ttl():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.metadata_cache_ttl', 300))
+
+
+def metadata_cache_size():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.metadata_cache_size', 1000))
+
+
+def collection_items_cache_ttl():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.collection_items_cache_ttl', 30))
+
+
+def mapping_cache_ttl():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.mapping_cache_ttl', 300))
+
+
+def mapping_cache_size():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.mapping_cache_size', 1000))
+
+
+def mapping_list_limit():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.mapping_list_limit', 100))
+
+
+def mapping_list_max_limit():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.mapping_list_max_limit', 1000))
+
+
+def catalog_max_age():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.catalog_max_age', 3600))
+
+
+def slow_call_threshold():
+    return float(tk.config.get(
+        'ckanext.in_app_reporting.slow_call_threshold', 2))
+
+
+def metrics_enabled():
+    return tk.asbool(tk.config.get(
+        'ckanext.in_app_reporting.metrics_enabled', False))
+
+
+def metrics_token():
+    return tk.config.get('ckanext.in_app_reporting.metrics_token')
+
+
+def fanout_workers():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.fanout_workers', 20))
+
+
+def fanout_request_concurrency():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.fanout_request_concurrency', 10))
+
+
+def async_client_enabled():
+    return tk.asbool(tk.config.get(
+        'ckanext.in_app_reporting.async_client_enabled', False))
+
+
+def async_client_concurrency():
+    return tk.asint(tk.config.get(
+        'ckanext.in_app_reporting.async_client_concurrency', 50))
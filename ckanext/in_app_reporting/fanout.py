@@ -0,0 +1,134 @@
+import atexit
+import concurrent.futures
+import itertools
+import logging
+import os
+import threading
+
+import ckanext.in_app_reporting.config as mb_config
+import ckanext.in_app_reporting.metrics as metrics
+
+
+log = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Tasks submitted but not started yet, and tasks running
+_stats_lock = threading.Lock()
+_queued = 0
+_active = 0
+
+
+def get_executor():
+    '''
+    Return the process-wide executor used for parallel Metabase calls.
+
+    The executor is created lazily and rebuilt after a fork, so every worker
+    process owns its own threads, capped at the fanout_workers setting.
+    '''
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=mb_config.fanout_workers(),
+                    thread_name_prefix='metabase-fanout'
+                )
+                _executor_pid = pid
+    return _executor
+
+
+def shutdown(wait=True):
+    '''Stop the executor of this process, cancelling the tasks not started yet.'''
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=wait, cancel_futures=True)
+        _executor = None
+        _executor_pid = None
+
+
+atexit.register(shutdown)
+
+
+def _run(func, item):
+    global _queued, _active
+    with _stats_lock:
+        _queued -= 1
+        _active += 1
+    try:
+        return func(item)
+    finally:
+        with _stats_lock:
+            _active -= 1
+
+
+def _submit(executor, func, item):
+    global _queued
+    with _stats_lock:
+        _queued += 1
+    try:
+        future = executor.submit(_run, func, item)
+    except Exception:
+        with _stats_lock:
+            _queued -= 1
+        raise
+    future.add_done_callback(_forget_if_cancelled)
+    return future
+
+
+def _forget_if_cancelled(future):
+    global _queued
+    if future.cancelled():
+        with _stats_lock:
+            _queued -= 1
+
+
+def fan_out(func, items, concurrency=None):
+    '''
+    Call ``func(item)`` for every item on the shared executor.
+
+    At most ``concurrency`` calls of one fan-out (by default the
+    fanout_request_concurrency setting) are queued or running at a time, so
+    a single request cannot take over the pool.
+
+    Yields:
+        (item, future) tuples in completion order. Closing the generator,
+        e.g. when the caller has enough results, cancels the remaining calls.
+    '''
+    concurrency = max(1, concurrency or mb_config.fanout_request_concurrency())
+    executor = get_executor()
+    items = iter(items)
+    pending = {}
+    try:
+        for item in itertools.islice(items, concurrency):
+            pending[_submit(executor, func, item)] = item
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                for next_item in itertools.islice(items, 1):
+                    pending[_submit(executor, func, next_item)] = next_item
+                yield item, future
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def queue_depth():
+    with _stats_lock:
+        return _queued
+
+
+def active_tasks():
+    with _stats_lock:
+        return _active
+
+
+metrics.register_gauge(
+    'metabase_fanout_queued_tasks', 'Metabase fan-out calls waiting for a worker thread.', queue_depth)
+metrics.register_gauge(
+    'metabase_fanout_active_tasks', 'Metabase fan-out calls running.', active_tasks)
@@ -0,0 +1,156 @@
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+
+# Latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_ID_SEGMENT = re.compile(r'^\d+$')
+_UUID_SEGMENT = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$',
+    re.IGNORECASE
+)
+
+_lock = threading.Lock()
+_latency = {}
+_requests = defaultdict(int)
+_bytes = defaultdict(int)
+_retries = defaultdict(int)
+_cache = defaultdict(int)
+# name -> (help text, callable returning the current value)
+_gauges = {}
+
+
+def endpoint_template(url):
+    '''
+    Reduce a URL to its endpoint template, e.g. ``/api/card/12?f=x`` to
+    ``/api/card/{id}``, so that metrics are grouped per endpoint.
+    '''
+    segments = []
+    for segment in urlsplit(url or '').path.split('/'):
+        if _ID_SEGMENT.match(segment):
+            segment = '{id}'
+        elif _UUID_SEGMENT.match(segment):
+            segment = '{uuid}'
+        segments.append(segment)
+    return '/'.join(segments) or '/'
+
+
+def observe_request(method, endpoint, status, seconds, received=0):
+    '''Record one Metabase request: its latency, outcome and response size.'''
+    key = (method, endpoint)
+    with _lock:
+        buckets, count, total = _latency.get(key, ([0] * len(LATENCY_BUCKETS), 0, 0.0))
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+        _latency[key] = (buckets, count + 1, total + seconds)
+        _requests[(method, endpoint, str(status))] += 1
+        if received:
+            _bytes[key] += received
+
+
+def observe_bytes(method, endpoint, received):
+    '''Record the size of a streamed response, known once it has been read.'''
+    if received:
+        with _lock:
+            _bytes[(method, endpoint)] += received
+
+
+def observe_retry(method, endpoint):
+    with _lock:
+        _retries[(method, endpoint)] += 1
+
+
+def observe_cache(cache_name, hit):
+    with _lock:
+        _cache[(cache_name, 'hit' if hit else 'miss')] += 1
+
+
+def register_gauge(name, help_text, read):
+    '''Report the value returned by ``read()`` as a gauge on every render.'''
+    _gauges[name] = (help_text, read)
+
+
+def reset():
+    with _lock:
+        _latency.clear()
+        _requests.clear()
+        _bytes.clear()
+        _retries.clear()
+        _cache.clear()
+
+
+def _labels(**labels):
+    return ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels.items()
+    )
+
+
+def render_prometheus():
+    '''Render the metrics of this process in the Prometheus text format.'''
+    with _lock:
+        latency = {key: (list(buckets), count, total) for key, (buckets, count, total) in _latency.items()}
+        requests_total = dict(_requests)
+        bytes_total = dict(_bytes)
+        retries_total = dict(_retries)
+        cache_total = dict(_cache)
+
+    lines = [
+        '# HELP metabase_request_duration_seconds Latency of Metabase API requests.',
+        '# TYPE metabase_request_duration_seconds histogram',
+    ]
+    for (method, endpoint), (buckets, count, total) in sorted(latency.items()):
+        for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+            lines.append('metabase_request_duration_seconds_bucket{{{0}}} {1}'.format(
+                _labels(method=method, endpoint=endpoint, le=bound), bucket_count))
+        lines.append('metabase_request_duration_seconds_bucket{{{0}}} {1}'.format(
+            _labels(method=method, endpoint=endpoint, le='+Inf'), count))
+        lines.append('metabase_request_duration_seconds_sum{{{0}}} {1}'.format(
+            _labels(method=method, endpoint=endpoint), total))
+        lines.append('metabase_request_duration_seconds_count{{{0}}} {1}'.format(
+            _labels(method=method, endpoint=endpoint), count))
+
+    lines.extend([
+        '# HELP metabase_requests_total Metabase API requests by response status.',
+        '# TYPE metabase_requests_total counter',
+    ])
+    for (method, endpoint, status), value in sorted(requests_total.items()):
+        lines.append('metabase_requests_total{{{0}}} {1}'.format(
+            _labels(method=method, endpoint=endpoint, status=status), value))
+
+    lines.extend([
+        '# HELP metabase_response_bytes_total Bytes received from the Metabase API.',
+        '# TYPE metabase_response_bytes_total counter',
+    ])
+    for (method, endpoint), value in sorted(bytes_total.items()):
+        lines.append('metabase_response_bytes_total{{{0}}} {1}'.format(
+            _labels(method=method, endpoint=endpoint), value))
+
+    lines.extend([
+        '# HELP metabase_request_retries_total Retried Metabase API requests.',
+        '# TYPE metabase_request_retries_total counter',
+    ])
+    for (method, endpoint), value in sorted(retries_total.items()):
+        lines.append('metabase_request_retries_total{{{0}}} {1}'.format(
+            _labels(method=method, endpoint=endpoint), value))
+
+    lines.extend([
+        '# HELP metabase_cache_requests_total Metabase cache lookups by result.',
+        '# TYPE metabase_cache_requests_total counter',
+    ])
+    for (cache_name, result), value in sorted(cache_total.items()):
+        lines.append('metabase_cache_requests_total{{{0}}} {1}'.format(
+            _labels(cache=cache_name, result=result), value))
+
+    for name, (help_text, read) in sorted(_gauges.items()):
+        lines.extend([
+            '# HELP {0} {1}'.format(name, help_text),
+            '# TYPE {0} gauge'.format(name),
+            '{0} {1}'.format(name, read()),
+        ])
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,51 @@
+"""add metabase card index
+
+Revision ID: 32e248b9587d
+Revises: 0ef0f87f0f18
+Create Date: 2026-10-17 09:12:41.503187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '32e248b9587d'
+down_revision = '0ef0f87f0f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    if "metabase_card" not in tables:
+        op.create_table(
+            "metabase_card",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=False),
+            sa.Column("entity_id", sa.UnicodeText),
+            sa.Column("name", sa.UnicodeText),
+            sa.Column("type", sa.UnicodeText),
+            sa.Column("collection_id", sa.UnicodeText),
+            sa.Column("table_id", sa.Integer),
+            sa.Column("updated_at", sa.UnicodeText),
+        )
+        op.create_index("idx_metabase_card_table_id", "metabase_card", ["table_id"])
+        op.create_index("idx_metabase_card_collection_id", "metabase_card", ["collection_id"])
+    if "metabase_card_resource" not in tables:
+        op.create_table(
+            "metabase_card_resource",
+            sa.Column("resource_id", sa.UnicodeText, primary_key=True),
+            sa.Column(
+                "card_id",
+                sa.Integer,
+                sa.ForeignKey("metabase_card.id", ondelete="CASCADE"),
+                primary_key=True
+            ),
+        )
+
+
+def downgrade():
+    op.drop_table("metabase_card_resource")
+    op.drop_table("metabase_card")
@@ -0,0 +1,60 @@
+"""add metabase creator index
+
+Revision ID: 34e70115a0bc
+Revises: cde48d093172
+Create Date: 2026-10-17 15:02:37.841206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '34e70115a0bc'
+down_revision = 'cde48d093172'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    card_columns = [column["name"] for column in inspector.get_columns("metabase_card")]
+    for name in ("description", "display", "created_at"):
+        if name not in card_columns:
+            op.add_column("metabase_card", sa.Column(name, sa.UnicodeText))
+    if "created_at" not in card_columns:
+        # Cards mirrored before this revision have no creator or details, and
+        # incremental syncs skip them until they are edited. Empty the mirror
+        # and its watermarks so that the next sync rebuilds it in full; the
+        # pickers read the Metabase API until then.
+        op.execute("DELETE FROM metabase_card_resource")
+        op.execute("DELETE FROM metabase_card")
+        op.execute("DELETE FROM metabase_sync_state WHERE key LIKE 'cards:%'")
+    card_indexes = [index["name"] for index in inspector.get_indexes("metabase_card")]
+    if "idx_metabase_card_creator_email" not in card_indexes:
+        op.create_index("idx_metabase_card_creator_email", "metabase_card", ["creator_email"])
+    if "metabase_dashboard" not in tables:
+        op.create_table(
+            "metabase_dashboard",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=False),
+            sa.Column("entity_id", sa.UnicodeText),
+            sa.Column("name", sa.UnicodeText),
+            sa.Column("description", sa.UnicodeText),
+            sa.Column("collection_id", sa.UnicodeText),
+            sa.Column("created_at", sa.UnicodeText),
+            sa.Column("updated_at", sa.UnicodeText),
+            sa.Column("creator_id", sa.Integer),
+            sa.Column("creator_email", sa.UnicodeText),
+        )
+        op.create_index("idx_metabase_dashboard_collection_id", "metabase_dashboard", ["collection_id"])
+        op.create_index("idx_metabase_dashboard_creator_email", "metabase_dashboard", ["creator_email"])
+
+
+def downgrade():
+    op.drop_table("metabase_dashboard")
+    op.drop_index("idx_metabase_card_creator_email", table_name="metabase_card")
+    op.drop_column("metabase_card", "created_at")
+    op.drop_column("metabase_card", "display")
+    op.drop_column("metabase_card", "description")
@@ -0,0 +1,63 @@
+"""add metabase mapping memberships
+
+Revision ID: 5b1d7e2c9a40
+Revises: 34e70115a0bc
+Create Date: 2026-10-17 17:21:09.513442
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1d7e2c9a40'
+down_revision = '34e70115a0bc'
+branch_labels = None
+depends_on = None
+
+
+def _split_ids(ids):
+    return list(dict.fromkeys(i.strip() for i in (ids or '').split(';') if i.strip()))
+
+
+def _create_membership_table(name, column):
+    table = op.create_table(
+        name,
+        sa.Column(
+            "user_id", sa.UnicodeText,
+            sa.ForeignKey("metabase_mapping.user_id", ondelete="CASCADE", onupdate="CASCADE"),
+            primary_key=True
+        ),
+        sa.Column(column, sa.UnicodeText, primary_key=True),
+    )
+    op.create_index("idx_{0}_{1}".format(name, column), name, [column])
+    return table
+
+
+def upgrade():
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    # Backfill the memberships from the ";"-joined ids of the existing mappings
+    mappings = engine.execute(
+        sa.text("SELECT user_id, collection_ids, group_ids FROM metabase_mapping")
+    ).fetchall()
+    if "metabase_mapping_collection" not in tables:
+        collections = _create_membership_table("metabase_mapping_collection", "collection_id")
+        op.bulk_insert(collections, [
+            {"user_id": user_id, "collection_id": collection_id}
+            for user_id, collection_ids, _ in mappings
+            for collection_id in _split_ids(collection_ids)
+        ])
+    if "metabase_mapping_group" not in tables:
+        groups = _create_membership_table("metabase_mapping_group", "group_id")
+        op.bulk_insert(groups, [
+            {"user_id": user_id, "group_id": group_id}
+            for user_id, _, group_ids in mappings
+            for group_id in _split_ids(group_ids)
+        ])
+
+
+def downgrade():
+    op.drop_table("metabase_mapping_group")
+    op.drop_table("metabase_mapping_collection")
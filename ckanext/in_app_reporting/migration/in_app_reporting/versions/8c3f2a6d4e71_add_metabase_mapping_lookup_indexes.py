@@ -0,0 +1,34 @@
+"""add metabase mapping lookup indexes
+
+Revision ID: 8c3f2a6d4e71
+Revises: 5b1d7e2c9a40
+Create Date: 2026-10-17 18:04:52.117630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3f2a6d4e71'
+down_revision = '5b1d7e2c9a40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    mapping_indexes = [index["name"] for index in inspector.get_indexes("metabase_mapping")]
+    # Expression indexes are not reflected by every SQLAlchemy version
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_metabase_mapping_email_lower "
+        "ON metabase_mapping (lower(email))"
+    )
+    if "idx_metabase_mapping_platform_uuid" not in mapping_indexes:
+        op.create_index("idx_metabase_mapping_platform_uuid", "metabase_mapping", ["platform_uuid"])
+
+
+def downgrade():
+    op.drop_index("idx_metabase_mapping_platform_uuid", table_name="metabase_mapping")
+    op.drop_index("idx_metabase_mapping_email_lower", table_name="metabase_mapping")
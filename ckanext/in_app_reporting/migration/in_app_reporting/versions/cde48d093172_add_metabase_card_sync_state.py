@@ -0,0 +1,40 @@
+"""add metabase card sync state
+
+Revision ID: cde48d093172
+Revises: 32e248b9587d
+Create Date: 2026-10-17 11:40:06.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cde48d093172'
+down_revision = '32e248b9587d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    engine = op.get_bind()
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    card_columns = [column["name"] for column in inspector.get_columns("metabase_card")]
+    if "creator_id" not in card_columns:
+        op.add_column("metabase_card", sa.Column("creator_id", sa.Integer))
+    if "creator_email" not in card_columns:
+        op.add_column("metabase_card", sa.Column("creator_email", sa.UnicodeText))
+    if "metabase_sync_state" not in tables:
+        op.create_table(
+            "metabase_sync_state",
+            sa.Column("key", sa.UnicodeText, primary_key=True),
+            sa.Column("value", sa.UnicodeText),
+            sa.Column("modified", sa.DateTime),
+        )
+
+
+def downgrade():
+    op.drop_table("metabase_sync_state")
+    op.drop_column("metabase_card", "creator_email")
+    op.drop_column("metabase_card", "creator_id")
@@ -2,7 +2,8 @@ import datetime
 import json
 
 from six import text_type
-from sqlalchemy import Column, types, ForeignKey
+from sqlalchemy import Column, types, ForeignKey, Index, func, or_
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import class_mapper
 
 try:
@@ -28,6 +29,10 @@ except ImportError:
 
 metabase_mapping_table = None
 
+# Sync state keys recording when each catalog was last synced, on CKAN's clock
+CARD_SYNCED_AT_KEY = 'cards:synced_at'
+DASHBOARD_SYNCED_AT_KEY = 'dashboards:synced_at'
+
 
 class MetabaseMapping(DomainObject, BaseModel):
     __tablename__ = "metabase_mapping"
@@ -44,12 +49,307 @@ class MetabaseMapping(DomainObject, BaseModel):
     created = Column(types.DateTime, default=datetime.datetime.utcnow)
     modified = Column(types.DateTime, default=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        Index("idx_metabase_mapping_email_lower", func.lower(email)),
+        Index("idx_metabase_mapping_platform_uuid", "platform_uuid"),
+    )
+
     @classmethod
     def get(cls, **kw):
         '''Finds a single entity in the register.'''
         query = model.Session.query(cls).autoflush(False)
         return query.filter_by(**kw).first()
 
+    @classmethod
+    def lookup(cls, user_id=None, email=None, platform_uuid=None):
+        '''
+        The mapping of a user by id, email (case-insensitively) or OpenGov
+        platform UUID, in that order of preference, or None. Emails and
+        UUIDs are not unique, when several mappings match the one with the
+        lowest user id is returned, so that repeated lookups agree.
+        '''
+        query = model.Session.query(cls).autoflush(False)
+        if user_id:
+            return query.filter(cls.user_id == user_id).first()
+        if email:
+            # Matches the lower(email) index
+            query = query.filter(func.lower(cls.email) == email.lower())
+        elif platform_uuid:
+            query = query.filter(cls.platform_uuid == platform_uuid)
+        else:
+            return None
+        return query.order_by(cls.user_id).first()
+
+    @classmethod
+    def members_of(cls, collection_id=None, group_id=None):
+        '''Query of the mappings that include a collection and/or a group.'''
+        query = model.Session.query(cls).autoflush(False)
+        if collection_id:
+            query = query.filter(cls.user_id.in_(
+                model.Session.query(MetabaseMappingCollection.user_id)
+                .filter(MetabaseMappingCollection.collection_id == str(collection_id))
+            ))
+        if group_id:
+            query = query.filter(cls.user_id.in_(
+                model.Session.query(MetabaseMappingGroup.user_id)
+                .filter(MetabaseMappingGroup.group_id == str(group_id))
+            ))
+        return query
+
+    def save_memberships(self):
+        '''
+        Replace the collection and group rows of this mapping with the ids in
+        its ``collection_ids`` and ``group_ids``.
+        '''
+        self.delete_memberships()
+        model.Session.add_all(
+            MetabaseMappingCollection(user_id=self.user_id, collection_id=collection_id)
+            for collection_id in split_ids(self.collection_ids)
+        )
+        model.Session.add_all(
+            MetabaseMappingGroup(user_id=self.user_id, group_id=group_id)
+            for group_id in split_ids(self.group_ids)
+        )
+
+    def delete_memberships(self):
+        '''Delete the collection and group rows of this mapping.'''
+        model.Session.flush()
+        for member_cls in (MetabaseMappingCollection, MetabaseMappingGroup):
+            model.Session.query(member_cls) \
+                .filter(member_cls.user_id == self.user_id) \
+                .delete(synchronize_session=False)
+
+
+def split_ids(ids):
+    '''The distinct non-empty ids of a ``;``-joined id string, in order.'''
+    return list(dict.fromkeys(i.strip() for i in (ids or '').split(';') if i.strip()))
+
+
+class MetabaseMappingCollection(DomainObject, BaseModel):
+    '''A Metabase collection of a mapped user, one row per collection.'''
+    __tablename__ = "metabase_mapping_collection"
+
+    user_id = Column(
+        types.UnicodeText,
+        ForeignKey("metabase_mapping.user_id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True
+    )
+    collection_id = Column(types.UnicodeText, primary_key=True)
+
+    __table_args__ = (
+        Index("idx_metabase_mapping_collection_collection_id", "collection_id"),
+    )
+
+
+class MetabaseMappingGroup(DomainObject, BaseModel):
+    '''A Metabase group of a mapped user, one row per group.'''
+    __tablename__ = "metabase_mapping_group"
+
+    user_id = Column(
+        types.UnicodeText,
+        ForeignKey("metabase_mapping.user_id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True
+    )
+    group_id = Column(types.UnicodeText, primary_key=True)
+
+    __table_args__ = (
+        Index("idx_metabase_mapping_group_group_id", "group_id"),
+    )
+
+
+def _contains_pattern(text):
+    '''LIKE pattern matching values that contain ``text`` literally.'''
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%{0}%'.format(escaped)
+
+
+class MetabaseCard(DomainObject, BaseModel):
+    '''Local copy of the Metabase card metadata used by listing helpers.'''
+    __tablename__ = "metabase_card"
+
+    id = Column(types.Integer, primary_key=True, autoincrement=False)
+    entity_id = Column(types.UnicodeText)
+    name = Column(types.UnicodeText)
+    type = Column(types.UnicodeText)
+    collection_id = Column(types.UnicodeText)
+    table_id = Column(types.Integer)
+    updated_at = Column(types.UnicodeText)
+    creator_id = Column(types.Integer)
+    creator_email = Column(types.UnicodeText)
+    description = Column(types.UnicodeText)
+    display = Column(types.UnicodeText)
+    created_at = Column(types.UnicodeText)
+
+    __table_args__ = (
+        Index("idx_metabase_card_table_id", "table_id"),
+        Index("idx_metabase_card_collection_id", "collection_id"),
+        Index("idx_metabase_card_creator_email", "creator_email"),
+    )
+
+    @classmethod
+    def is_populated(cls):
+        '''
+        Whether a full sync of the card index has completed. Rows upserted
+        before that do not count.
+        '''
+        return _has_synced(CARD_SYNCED_AT_KEY)
+
+    @classmethod
+    def is_fresh(cls, max_age):
+        '''Whether the card index was synced in the last ``max_age`` seconds, 0 disables the check.'''
+        return _synced_within(CARD_SYNCED_AT_KEY, max_age)
+
+    @classmethod
+    def cards_for_table(cls, table_id, collection_ids):
+        '''Cards and models in the given collections built on a Metabase table.'''
+        return model.Session.query(cls).autoflush(False) \
+            .filter(cls.table_id == table_id) \
+            .filter(cls.collection_id.in_(collection_ids)) \
+            .order_by(cls.type, cls.name) \
+            .all()
+
+    @classmethod
+    def sql_cards_for_resource(cls, resource_id, collection_ids):
+        '''Native SQL cards in the given collections that query a resource.'''
+        return model.Session.query(cls).autoflush(False) \
+            .join(MetabaseCardResource, MetabaseCardResource.card_id == cls.id) \
+            .filter(MetabaseCardResource.resource_id == resource_id) \
+            .filter(cls.table_id.is_(None)) \
+            .filter(cls.collection_id.in_(collection_ids)) \
+            .order_by(cls.type, cls.name) \
+            .all()
+
+    @classmethod
+    def charts_for_resource(cls, table_id, resource_id, collection_ids,
+                            q=None, limit=None, offset=0):
+        '''
+        Cards in the given collections that either are questions on the
+        Metabase table or native SQL cards that query the resource,
+        optionally filtered on name and paginated.
+        '''
+        sql_card_ids = model.Session.query(MetabaseCardResource.card_id) \
+            .filter(MetabaseCardResource.resource_id == resource_id)
+        query = model.Session.query(cls).autoflush(False) \
+            .filter(cls.collection_id.in_(collection_ids)) \
+            .filter(or_(
+                (cls.table_id == table_id) & (cls.type == 'question'),
+                cls.table_id.is_(None) & cls.id.in_(sql_card_ids)
+            ))
+        if q:
+            query = query.filter(cls.name.ilike(_contains_pattern(q), escape='\\'))
+        query = query.order_by(cls.updated_at.desc(), cls.id)
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @classmethod
+    def created_by(cls, creator_email, collection_ids, limit=None):
+        '''Cards in the given collections created by a user, most recently updated first.'''
+        return _created_by(cls, creator_email, collection_ids, limit)
+
+
+def _has_synced(key):
+    try:
+        return MetabaseSyncState.get_value(key) is not None
+    except SQLAlchemyError:
+        model.Session.rollback()
+        return False
+
+
+def _synced_within(key, max_age):
+    if not max_age:
+        return True
+    try:
+        synced_at = MetabaseSyncState.get_value(key)
+    except SQLAlchemyError:
+        model.Session.rollback()
+        return False
+    if not synced_at:
+        return False
+    age = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(synced_at)
+    return age <= datetime.timedelta(seconds=max_age)
+
+
+def _created_by(cls, creator_email, collection_ids, limit=None):
+    query = model.Session.query(cls).autoflush(False) \
+        .filter(cls.creator_email == creator_email) \
+        .filter(cls.collection_id.in_(collection_ids)) \
+        .order_by(cls.updated_at.desc(), cls.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+class MetabaseCardResource(DomainObject, BaseModel):
+    '''Inverted index from CKAN resource id to the SQL cards that query it.'''
+    __tablename__ = "metabase_card_resource"
+
+    resource_id = Column(types.UnicodeText, primary_key=True)
+    card_id = Column(
+        types.Integer,
+        ForeignKey("metabase_card.id", ondelete="CASCADE"),
+        primary_key=True
+    )
+
+
+class MetabaseDashboard(DomainObject, BaseModel):
+    '''Local copy of the Metabase dashboard metadata used by listing helpers.'''
+    __tablename__ = "metabase_dashboard"
+
+    id = Column(types.Integer, primary_key=True, autoincrement=False)
+    entity_id = Column(types.UnicodeText)
+    name = Column(types.UnicodeText)
+    description = Column(types.UnicodeText)
+    collection_id = Column(types.UnicodeText)
+    created_at = Column(types.UnicodeText)
+    updated_at = Column(types.UnicodeText)
+    creator_id = Column(types.Integer)
+    creator_email = Column(types.UnicodeText)
+
+    __table_args__ = (
+        Index("idx_metabase_dashboard_collection_id", "collection_id"),
+        Index("idx_metabase_dashboard_creator_email", "creator_email"),
+    )
+
+    @classmethod
+    def is_populated(cls):
+        '''
+        Whether a full sync of the dashboard index has completed. Rows upserted
+        before that do not count.
+        '''
+        return _has_synced(DASHBOARD_SYNCED_AT_KEY)
+
+    @classmethod
+    def is_fresh(cls, max_age):
+        '''Whether the dashboard index was synced in the last ``max_age`` seconds, 0 disables the check.'''
+        return _synced_within(DASHBOARD_SYNCED_AT_KEY, max_age)
+
+    @classmethod
+    def created_by(cls, creator_email, collection_ids, limit=None):
+        '''Dashboards in the given collections created by a user, most recently updated first.'''
+        return _created_by(cls, creator_email, collection_ids, limit)
+
+
+class MetabaseSyncState(DomainObject, BaseModel):
+    '''Key/value store for catalog sync watermarks.'''
+    __tablename__ = "metabase_sync_state"
+
+    key = Column(types.UnicodeText, primary_key=True)
+    value = Column(types.UnicodeText)
+    modified = Column(types.DateTime, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def get_value(cls, key):
+        state = model.Session.query(cls).autoflush(False).filter_by(key=key).first()
+        return state.value if state else None
+
+    @classmethod
+    def set_value(cls, key, value):
+        '''Stage a value in the current session, the caller commits.'''
+        model.Session.merge(cls(key=key, value=value, modified=datetime.datetime.utcnow()))
+
 
 def table_dictize(obj, context, **kw):
     '''Get any model object and represent it as a dict'''
@@ -3,6 +3,7 @@ import ckan.plugins.toolkit as toolkit
 import ckan.lib.navl.dictization_functions as df
 import ckanext.in_app_reporting.action as action
 import ckanext.in_app_reporting.auth as auth
+import ckanext.in_app_reporting.cache as cache
 import ckanext.in_app_reporting.cli as cli
 import ckanext.in_app_reporting.utils as utils
 import ckanext.in_app_reporting.blueprint as view
@@ -46,7 +47,14 @@ class InAppReportingPlugin(plugins.SingletonPlugin):
             'metabase_model_create': action.metabase_model_create,
             'metabase_sql_questions_list': action.metabase_sql_questions_list,
             'metabase_user_created_cards_list': action.metabase_user_created_cards_list,
-            'metabase_user_created_dashboards_list': action.metabase_user_created_dashboards_list
+            'metabase_user_created_dashboards_list': action.metabase_user_created_dashboards_list,
+            'metabase_iframe_urls': action.metabase_iframe_urls,
+            'member_create': action.member_create,
+            'member_delete': action.member_delete,
+            'user_update': action.user_update,
+            'user_delete': action.user_delete,
+            'organization_update': action.organization_update,
+            'organization_delete': action.organization_delete
         }
 
     # IAuthFunctions
@@ -75,12 +83,13 @@ class InAppReportingPlugin(plugins.SingletonPlugin):
     # ITemplateHelpers
     def get_helpers(self):
         return {
-            'is_metabase_sso_user': utils.is_metabase_sso_user,
-            'get_metabase_embeddable': utils.get_metabase_embeddable,
-            'get_metabase_collection_id': utils.get_metabase_collection_id,
-            'get_metabase_table_id': utils.get_metabase_table_id,
-            'get_metabase_model_id': utils.get_metabase_model_id,
-            'get_metabase_cards_by_table_id': utils.get_metabase_cards_by_table_id,
+            'is_metabase_sso_user': cache.request_memoize(utils.is_metabase_sso_user),
+            'get_metabase_embeddable': cache.request_memoize(utils.get_metabase_embeddable),
+            'get_metabase_collection_id': cache.request_memoize(utils.get_metabase_collection_id),
+            'get_metabase_table_id': cache.request_memoize(utils.get_metabase_table_id),
+            'get_metabase_model_id': cache.request_memoize(utils.get_metabase_model_id),
+            'get_metabase_cards_by_table_id': cache.request_memoize(utils.get_metabase_cards_by_table_id),
+            'is_metabase_available': utils.is_metabase_available,
         }
 
 
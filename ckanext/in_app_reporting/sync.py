@@ -0,0 +1,378 @@
+import datetime
+import logging
+import re
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+import ckanext.in_app_reporting.utils as utils
+from ckanext.in_app_reporting.model import (
+    CARD_SYNCED_AT_KEY,
+    DASHBOARD_SYNCED_AT_KEY,
+    MetabaseCard,
+    MetabaseCardResource,
+    MetabaseDashboard,
+    MetabaseMappingCollection,
+    MetabaseSyncState
+)
+
+
+log = logging.getLogger(__name__)
+
+# Datastore tables are named after the resource id, so any UUID in a native
+# query is a candidate resource reference
+UUID_PATTERN = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+    re.IGNORECASE
+)
+
+SYNC_PAGE_SIZE = 50
+CARD_WATERMARK_KEY = 'cards:collection:{0}'
+DASHBOARD_WATERMARK_KEY = 'dashboards:collection:{0}'
+
+
+def extract_resource_ids(native_sql):
+    '''Return the distinct, lowercased UUIDs referenced by a SQL query.'''
+    if not native_sql:
+        return set()
+    return {match.lower() for match in UUID_PATTERN.findall(native_sql)}
+
+
+def _card_row(card):
+    collection_id = card.get('collection_id')
+    creator = card.get('creator') or {}
+    return {
+        'id': card.get('id'),
+        'entity_id': card.get('entity_id'),
+        'name': card.get('name'),
+        'type': card.get('type'),
+        'collection_id': str(collection_id) if collection_id is not None else None,
+        'table_id': card.get('table_id'),
+        'updated_at': card.get('updated_at'),
+        'creator_id': card.get('creator_id'),
+        'creator_email': creator.get('email'),
+        'description': card.get('description'),
+        'display': card.get('display'),
+        'created_at': card.get('created_at'),
+    }
+
+
+def _dashboard_row(dashboard, user_emails=None):
+    collection_id = dashboard.get('collection_id')
+    creator_id = dashboard.get('creator_id')
+    # Dashboard details only carry the creator id, lists may hydrate the creator
+    creator_email = (dashboard.get('creator') or {}).get('email') or (user_emails or {}).get(creator_id)
+    return {
+        'id': dashboard.get('id'),
+        'entity_id': dashboard.get('entity_id'),
+        'name': dashboard.get('name'),
+        'description': dashboard.get('description'),
+        'collection_id': str(collection_id) if collection_id is not None else None,
+        'created_at': dashboard.get('created_at'),
+        'updated_at': dashboard.get('updated_at'),
+        'creator_id': creator_id,
+        'creator_email': creator_email,
+    }
+
+
+def _metabase_user_emails():
+    '''Metabase user id -> email, or an empty dict if users cannot be listed.'''
+    users = utils.metabase_get_request(f'{utils.METABASE_SITE_URL}/api/user')
+    if not users:
+        return {}
+    if isinstance(users, dict):
+        users = users.get('data', [])
+    return {user.get('id'): user.get('email') for user in users if user.get('id')}
+
+
+def _card_resource_rows(card):
+    if card.get('table_id'):
+        return []
+    native_sql = utils._extract_native_sql_from_dataset_query(card.get('dataset_query', {}))
+    return [
+        {'resource_id': resource_id, 'card_id': card.get('id')}
+        for resource_id in extract_resource_ids(native_sql)
+    ]
+
+
+def rebuild_card_index():
+    '''
+    Rebuild the local card table and the resource id -> SQL card index
+    from a full scan of the Metabase card catalog.
+
+    Returns:
+        Number of cards indexed
+    '''
+    cards = utils.metabase_get_request(
+        f'{utils.METABASE_SITE_URL}/api/card?f=database&model_id={utils.METABASE_DB_ID}')
+    if cards is None:
+        raise RuntimeError('Failed to fetch the Metabase card catalog')
+
+    card_rows = []
+    card_resource_rows = []
+    for card in cards:
+        if not card.get('id'):
+            continue
+        card_rows.append(_card_row(card))
+        card_resource_rows.extend(_card_resource_rows(card))
+
+    try:
+        model.Session.query(MetabaseCardResource).delete(synchronize_session=False)
+        model.Session.query(MetabaseCard).delete(synchronize_session=False)
+        model.Session.bulk_insert_mappings(MetabaseCard, card_rows)
+        model.Session.bulk_insert_mappings(MetabaseCardResource, card_resource_rows)
+        _set_watermarks(CARD_WATERMARK_KEY, card_rows)
+        _mark_synced(CARD_SYNCED_AT_KEY)
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+    log.info('Indexed %s Metabase cards with %s resource references',
+             len(card_rows), len(card_resource_rows))
+    return len(card_rows)
+
+
+def rebuild_dashboard_index():
+    '''
+    Rebuild the local dashboard table from a full scan of the Metabase
+    dashboards.
+
+    Returns:
+        Number of dashboards indexed
+    '''
+    dashboards = utils.metabase_get_request(f'{utils.METABASE_SITE_URL}/api/dashboard?f=all')
+    if dashboards is None:
+        raise RuntimeError('Failed to fetch the Metabase dashboards')
+
+    user_emails = _metabase_user_emails()
+    dashboard_rows = [
+        _dashboard_row(dashboard, user_emails)
+        for dashboard in dashboards if dashboard.get('id')
+    ]
+
+    try:
+        model.Session.query(MetabaseDashboard).delete(synchronize_session=False)
+        model.Session.bulk_insert_mappings(MetabaseDashboard, dashboard_rows)
+        _set_watermarks(DASHBOARD_WATERMARK_KEY, dashboard_rows)
+        _mark_synced(DASHBOARD_SYNCED_AT_KEY)
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+    log.info('Indexed %s Metabase dashboards', len(dashboard_rows))
+    return len(dashboard_rows)
+
+
+def upsert_card(card):
+    '''Stage one card and its resource references in the current session.'''
+    model.Session.query(MetabaseCardResource) \
+        .filter(MetabaseCardResource.card_id == card.get('id')) \
+        .delete(synchronize_session=False)
+    card_row = _keep_creator_email(MetabaseCard, _card_row(card))
+    model.Session.merge(MetabaseCard(**card_row))
+    model.Session.flush()
+    for row in _card_resource_rows(card):
+        model.Session.add(MetabaseCardResource(**row))
+
+
+def upsert_dashboard(dashboard, user_emails=None):
+    '''Stage one dashboard in the current session.'''
+    row = _keep_creator_email(MetabaseDashboard, _dashboard_row(dashboard, user_emails))
+    model.Session.merge(MetabaseDashboard(**row))
+
+
+def _keep_creator_email(cls, row):
+    '''
+    Keep the mirrored creator email when an item comes without one, as
+    publish responses and dashboard details without the user list do.
+    '''
+    if row['creator_email'] is None:
+        row['creator_email'] = model.Session.query(cls.creator_email) \
+            .filter(cls.id == row['id']) \
+            .scalar()
+    return row
+
+
+def _set_watermarks(key, rows):
+    '''
+    Set the watermark of every synced collection after a full scan to the
+    newest update among its scanned rows, on Metabase's clock like the
+    incremental sync, so that items edited while the scan ran are picked up
+    by the next incremental run. Collections without rows keep their
+    watermark.
+    '''
+    newest = {}
+    for row in rows:
+        updated_at = utils.parse_metabase_datetime(row.get('updated_at'))
+        collection_id = row.get('collection_id')
+        if updated_at and (collection_id not in newest or updated_at > newest[collection_id]):
+            newest[collection_id] = updated_at
+    for collection_id in _sync_collection_ids():
+        if collection_id in newest:
+            MetabaseSyncState.set_value(key.format(collection_id), newest[collection_id].isoformat())
+
+
+def _mark_synced(key):
+    '''
+    Stage the time of a completed sync, which the listing helpers compare
+    against catalog_max_age. Unlike the watermarks this is on CKAN's clock.
+    '''
+    MetabaseSyncState.set_value(key, datetime.datetime.utcnow().isoformat())
+
+
+def _commit_synced(key):
+    try:
+        _mark_synced(key)
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+
+def _sync_collection_ids():
+    '''The configured collections plus every collection mapped to a user.'''
+    collection_ids = set(str(c) for c in utils.collection_ids)
+    mapped = model.Session.query(MetabaseMappingCollection.collection_id).distinct()
+    collection_ids.update(collection_id for (collection_id,) in mapped)
+    return sorted(collection_ids)
+
+
+def _changed_collection_items(collection_id, watermark, models='models=card&models=dataset'):
+    '''
+    Yield items of a collection, most recently edited first, until the
+    first one that was last edited at or before the watermark.
+    '''
+    watermark_dt = utils.parse_metabase_datetime(watermark)
+    offset = 0
+    while True:
+        results = utils.metabase_get_request(
+            f'{utils.METABASE_SITE_URL}/api/collection/{collection_id}/items'
+            f'?{models}&sort_column=last_edited_at&sort_direction=desc'
+            f'&limit={SYNC_PAGE_SIZE}&offset={offset}')
+        if results is None:
+            raise RuntimeError(f'Failed to fetch items of Metabase collection {collection_id}')
+        items = results.get('data', [])
+        for item in items:
+            edited_at = utils.parse_metabase_datetime(
+                (item.get('last-edit-info') or {}).get('timestamp'))
+            if watermark_dt and edited_at and edited_at <= watermark_dt:
+                return
+            yield item, edited_at
+        if len(items) < SYNC_PAGE_SIZE:
+            return
+        offset += SYNC_PAGE_SIZE
+
+
+def _sync_collection(collection_id, key, models, detail_path, upsert):
+    watermark = MetabaseSyncState.get_value(key)
+    newest = None
+    count = 0
+    try:
+        for item, edited_at in _changed_collection_items(collection_id, watermark, models):
+            if edited_at and (newest is None or edited_at > newest):
+                newest = edited_at
+            detail = utils.metabase_get_request(f'{utils.METABASE_SITE_URL}/api/{detail_path}/{item.get("id")}')
+            if not detail:
+                raise RuntimeError(f'Failed to fetch Metabase {detail_path} {item.get("id")}')
+            upsert(detail)
+            count += 1
+        if newest is not None:
+            MetabaseSyncState.set_value(key, newest.isoformat())
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+    return count
+
+
+def sync_collection_cards(collection_id):
+    '''
+    Bring the local card table up to date for one collection, fetching
+    only the cards edited since the collection's last watermark.
+
+    Returns:
+        Number of cards updated
+    '''
+    return _sync_collection(
+        collection_id, CARD_WATERMARK_KEY.format(collection_id),
+        'models=card&models=dataset', 'card', upsert_card)
+
+
+def sync_collection_dashboards(collection_id, user_emails=None):
+    '''
+    Bring the local dashboard table up to date for one collection, fetching
+    only the dashboards edited since the collection's last watermark.
+
+    Returns:
+        Number of dashboards updated
+    '''
+    return _sync_collection(
+        collection_id, DASHBOARD_WATERMARK_KEY.format(collection_id),
+        'models=dashboard', 'dashboard',
+        lambda dashboard: upsert_dashboard(dashboard, user_emails))
+
+
+def sync_cards(full=False):
+    '''
+    Sync the local Metabase card catalog.
+
+    Incremental runs walk each collection ordered by last edit and stop at
+    its watermark. Cards that were deleted, archived or moved out of every
+    synced collection are only dropped by a full run.
+
+    Args:
+        full: Rebuild the whole catalog from a full card scan
+
+    Returns:
+        Number of cards indexed or updated
+    '''
+    if full or not MetabaseCard.is_populated():
+        return rebuild_card_index()
+    count = 0
+    for collection_id in _sync_collection_ids():
+        count += sync_collection_cards(collection_id)
+    _commit_synced(CARD_SYNCED_AT_KEY)
+    log.info('Synced %s changed Metabase cards', count)
+    return count
+
+
+def sync_dashboards(full=False):
+    '''
+    Sync the local Metabase dashboard catalog, the same way as sync_cards.
+
+    Args:
+        full: Rebuild the whole catalog from a full dashboard scan
+
+    Returns:
+        Number of dashboards indexed or updated
+    '''
+    if full or not MetabaseDashboard.is_populated():
+        return rebuild_dashboard_index()
+    user_emails = None
+    count = 0
+    for collection_id in _sync_collection_ids():
+        if user_emails is None:
+            user_emails = _metabase_user_emails()
+        count += sync_collection_dashboards(collection_id, user_emails)
+    _commit_synced(DASHBOARD_SYNCED_AT_KEY)
+    log.info('Synced %s changed Metabase dashboards', count)
+    return count
+
+
+def enqueue_card_sync(full=False):
+    '''Run sync_cards on the background job queue.'''
+    return tk.enqueue_job(
+        sync_cards,
+        kwargs={'full': full},
+        title='Metabase card sync'
+    )
+
+
+def enqueue_dashboard_sync(full=False):
+    '''Run sync_dashboards on the background job queue.'''
+    return tk.enqueue_job(
+        sync_dashboards,
+        kwargs={'full': full},
+        title='Metabase dashboard sync'
+    )
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class TableIndex(object):
+    '''
+    In-process ``table_name -> table_id`` index of the Metabase database.
+
+    The index is loaded on first use and then served from memory. Once it
+    is older than ``ttl`` seconds it is refreshed on a background thread
+    while the stale copy keeps answering lookups. A lookup miss triggers a
+    synchronous refresh, at most once every ``miss_refresh_interval``
+    seconds, so newly synced tables are found without letting lookups for
+    unknown names re-download the database metadata each time.
+
+    ``loader(fresh)`` returns the index as a dict, or None on failure.
+    ``fresh`` is set for refreshes triggered by a miss, when any shared
+    cache in front of Metabase must be bypassed.
+    '''
+
+    def __init__(self, loader, ttl, miss_refresh_interval):
+        self._loader = loader
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self._tables = None
+        self._loaded_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+
+    def lookup(self, table_name):
+        if self._tables is None:
+            if self._can_refresh_on_miss():
+                self.refresh()
+        elif self._is_stale():
+            self.refresh_in_background()
+
+        table_id = (self._tables or {}).get(table_name)
+        if table_id is None and self._can_refresh_on_miss():
+            self.refresh(fresh=True)
+            table_id = (self._tables or {}).get(table_name)
+        return table_id
+
+    def refresh(self, fresh=False):
+        '''Reload the index, unless another thread did so while we waited.'''
+        requested_at = time.monotonic()
+        with self._lock:
+            if self._attempted_at is not None and self._attempted_at >= requested_at:
+                return
+            self._load(fresh)
+
+    def refresh_in_background(self):
+        if self._lock.locked():
+            return
+        thread = threading.Thread(
+            target=self.refresh,
+            name='metabase-table-index-refresh',
+            daemon=True
+        )
+        thread.start()
+
+    def clear(self):
+        with self._lock:
+            self._tables = None
+            self._loaded_at = None
+            self._attempted_at = None
+
+    def _load(self, fresh=False):
+        try:
+            tables = self._loader(fresh=fresh)
+        except Exception:
+            log.exception('Failed to refresh the Metabase table index')
+            tables = None
+        now = time.monotonic()
+        self._attempted_at = now
+        if tables is not None:
+            self._tables = tables
+            self._loaded_at = now
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return True
+        return time.monotonic() - self._loaded_at > self.ttl
+
+    def _can_refresh_on_miss(self):
+        if self._attempted_at is None:
+            return True
+        return time.monotonic() - self._attempted_at > self.miss_refresh_interval
@@ -0,0 +1,156 @@
+"""
+Benchmarks of the Metabase lookups against a local fake Metabase server.
+
+Skipped by the test job in CI (``--benchmark-skip``). The benchmark job
+runs them on the base of a pull request and on its head, and fails when
+the head is slower. See the README for how to do the same locally.
+"""
+import os
+
+import pytest
+from ckantoolkit import url_for
+from ckantoolkit.tests import factories
+
+import ckanext.in_app_reporting.utils as utils
+from ckanext.in_app_reporting.tests.fake_metabase import FakeCatalog, FakeMetabaseServer
+
+pytest.importorskip('pytest_benchmark')
+
+
+# (tables, cards, collections) per catalog size
+CATALOG_SIZES = {
+    'small': (10, 100, 2),
+    'medium': (100, 1000, 5),
+    'large': (500, 5000, 10),
+}
+
+# Seconds the fake server waits before answering each request
+LATENCY = float(os.environ.get('METABASE_BENCHMARK_LATENCY', '0'))
+
+
+@pytest.fixture(scope='module', params=list(CATALOG_SIZES))
+def fake_metabase(request):
+    tables, cards, collections = CATALOG_SIZES[request.param]
+    catalog = FakeCatalog(tables=tables, cards=cards, collections=collections)
+    with FakeMetabaseServer(catalog, latency=LATENCY) as server:
+        yield server
+
+
+@pytest.fixture
+def catalog(fake_metabase, monkeypatch):
+    """Point the extension at the fake server and return its catalog"""
+    catalog = fake_metabase.httpd.catalog
+    monkeypatch.setattr(utils, 'METABASE_SITE_URL', fake_metabase.url)
+    monkeypatch.setattr(utils, 'METABASE_DB_ID', catalog.db_id)
+    monkeypatch.setattr(utils, 'collection_ids', catalog.collection_ids)
+    return catalog
+
+
+def _clear_caches():
+    utils._metadata_cache.clear()
+    utils._table_index.clear()
+    utils._embed_token_cache.clear()
+
+
+def _cold(benchmark, func, *args, **kwargs):
+    """Benchmark func with empty caches on every round"""
+    return benchmark.pedantic(
+        func, args=args, kwargs=kwargs, setup=_clear_caches, rounds=5, warmup_rounds=1)
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestBenchmarkUtils:
+
+    def test_chart_list_cold(self, benchmark, catalog):
+        table = catalog.tables[0]
+        result = _cold(benchmark, utils.get_metabase_chart_list, table['id'], table['name'])
+        assert isinstance(result, list)
+
+    def test_chart_list_warm(self, benchmark, catalog):
+        table = catalog.tables[0]
+        utils.get_metabase_chart_list(table['id'], table['name'])
+        result = benchmark(utils.get_metabase_chart_list, table['id'], table['name'])
+        assert isinstance(result, list)
+
+    def test_sql_questions_cold(self, benchmark, catalog):
+        result = _cold(benchmark, utils.get_metabase_sql_questions, catalog.tables[0]['name'])
+        assert isinstance(result, list)
+
+    def test_sql_questions_warm(self, benchmark, catalog):
+        utils.get_metabase_sql_questions(catalog.tables[0]['name'])
+        result = benchmark(utils.get_metabase_sql_questions, catalog.tables[0]['name'])
+        assert isinstance(result, list)
+
+    def test_user_created_cards(self, benchmark, catalog):
+        result = _cold(benchmark, utils.get_metabase_user_created_cards, catalog.user_emails[0])
+        assert len(result) <= 5
+
+    def test_table_id_cold(self, benchmark, catalog):
+        table = catalog.tables[-1]
+        assert _cold(benchmark, utils.get_metabase_table_id, table['name']) == table['id']
+
+    def test_table_id_warm(self, benchmark, catalog):
+        table = catalog.tables[-1]
+        utils.get_metabase_table_id(table['name'])
+        assert benchmark(utils.get_metabase_table_id, table['name']) == table['id']
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestBenchmarkHelpers:
+
+    def test_get_metabase_embeddable(self, benchmark, catalog):
+        result = _cold(benchmark, utils.get_metabase_embeddable, 'card')
+        assert isinstance(result, list)
+
+    def test_get_metabase_collection_items_cold(self, benchmark, catalog):
+        result = _cold(benchmark, utils.get_metabase_collection_items, 'card', q='card 1', limit=20)
+        assert len(result) <= 20
+
+    def test_get_metabase_collection_items_warm(self, benchmark, catalog):
+        utils.get_metabase_collection_items('card')
+        result = benchmark(utils.get_metabase_collection_items, 'card', q='card 1', limit=20)
+        assert len(result) <= 20
+
+    def test_get_metabase_chart_list_page(self, benchmark, catalog):
+        table = catalog.tables[0]
+        result = _cold(
+            benchmark, utils.get_metabase_chart_list, table['id'], table['name'], q='card', limit=10)
+        assert len(result) <= 10
+
+    def test_get_metabase_iframe_url(self, benchmark, catalog):
+        card = catalog.cards[0]
+        result = _cold(benchmark, utils.get_metabase_iframe_url, 'card', card['id'], True, True, False)
+        assert result
+
+    def test_get_metabase_iframe_urls(self, benchmark, catalog):
+        items = [{'model_type': 'card', 'entity_id': card['id']} for card in catalog.cards[:50]]
+        result = _cold(benchmark, utils.get_metabase_iframe_urls, items)
+        assert len(result) == len(items)
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestBenchmarkBlueprint:
+
+    def test_chart_list_endpoint(self, benchmark, app, catalog, mock_is_metabase_sso_user):
+        table = catalog.tables[0]
+        dataset = factories.Dataset()
+        factories.Resource(package_id=dataset['id'], id=table['name'])
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+        url = url_for('metabase.chart_list', resource_id=table['name'])
+
+        response = _cold(benchmark, app.get, url, extra_environ=env)
+
+        assert response.status_code == 200
+
+    def test_collection_items_endpoint(self, benchmark, app, catalog, mock_is_metabase_sso_user):
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+        url = url_for('metabase.get_metabase_collection_items', model_type='card', q='card 1')
+
+        response = _cold(benchmark, app.get, url, extra_environ=env)
+
+        assert response.status_code == 200
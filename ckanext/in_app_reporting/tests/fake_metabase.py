@@ -0,0 +1,167 @@
+"""
+A local fake Metabase API server with a seedable catalog, for tests and
+benchmarks.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeCatalog:
+    """
+    A deterministic Metabase catalog of tables, cards and collections.
+
+    Cards are spread round-robin over the collections and their creators.
+    Roughly a third are built on a table, the rest are native SQL questions
+    querying one or two datastore tables.
+    """
+
+    def __init__(self, tables=10, cards=100, collections=2, users=10, db_id=4, seed=0):
+        rng = random.Random(seed)
+        self.db_id = db_id
+        self.collection_ids = [str(i + 1) for i in range(collections)]
+        self.user_emails = [f'user{i}@example.com' for i in range(users)]
+        self.tables = [
+            {'id': 1000 + i, 'name': str(uuid.UUID(int=rng.getrandbits(128)))}
+            for i in range(tables)
+        ]
+        self.cards = [self._card(rng, i + 1) for i in range(cards)]
+        self.cards_by_id = {card['id']: card for card in self.cards}
+
+    def _card(self, rng, card_id):
+        table = rng.choice(self.tables)
+        collection_id = self.collection_ids[card_id % len(self.collection_ids)]
+        creator_id = card_id % len(self.user_emails)
+        updated_at = '2025-{0:02d}-{1:02d}T{2:02d}:20:49.005658Z'.format(
+            rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23))
+        card = {
+            'id': card_id,
+            'entity_id': f'entity-{card_id}',
+            'name': f'Card {card_id} on {table["name"][:8]}',
+            'description': f'Benchmark card {card_id}',
+            'type': rng.choice(['question', 'question', 'question', 'model']),
+            'display': rng.choice(['table', 'bar', 'line', 'pie']),
+            'collection_id': int(collection_id),
+            'creator_id': creator_id,
+            'creator': {'id': creator_id, 'email': self.user_emails[creator_id]},
+            'created_at': updated_at,
+            'updated_at': updated_at,
+            'enable_embedding': rng.random() < 0.5,
+        }
+        if card_id % 3 == 0:
+            card['table_id'] = table['id']
+            card['dataset_query'] = {
+                'type': 'query', 'database': self.db_id, 'query': {'source-table': table['id']}
+            }
+        else:
+            other = rng.choice(self.tables)
+            card['table_id'] = None
+            card['dataset_query'] = {
+                'type': 'native',
+                'database': self.db_id,
+                'native': {
+                    'query': (
+                        f'SELECT a.*, b."value"\nFROM "{table["name"]}" a\n'
+                        f'LEFT JOIN "{other["name"]}" b ON a."_id" = b."_id"\n'
+                        f'WHERE a."date" >= {{{{start_date}}}}\nORDER BY a."_id" DESC LIMIT 500'
+                    ),
+                    'template-tags': {}
+                }
+            }
+        return card
+
+    def collection_items(self, collection_id, model_type):
+        items = [
+            {
+                'id': card['id'],
+                'entity_id': card['entity_id'],
+                'name': card['name'],
+                'model': 'card',
+                'last-edit-info': {'timestamp': card['updated_at']},
+            }
+            for card in self.cards
+            if str(card['collection_id']) == collection_id and model_type in ('card', 'dataset')
+        ]
+        items.sort(key=lambda item: item['last-edit-info']['timestamp'], reverse=True)
+        return items
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        parts = urlsplit(self.path)
+        params = parse_qs(parts.query)
+        body = self._route(server.catalog, parts.path.rstrip('/').split('/'), params)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _route(self, catalog, path, params):
+        # path is ['', 'api', <model>, ...]
+        if path[1:3] == ['api', 'database'] and len(path) == 4:
+            return {'id': catalog.db_id, 'tables': catalog.tables}
+        if path[1:3] == ['api', 'card'] and len(path) == 3:
+            if params.get('f') == ['table']:
+                table_id = int(params.get('model_id', ['0'])[0])
+                return [card for card in catalog.cards if card['table_id'] == table_id]
+            return catalog.cards
+        if path[1:] in (['api', 'card', 'embeddable'], ['api', 'dashboard', 'embeddable']):
+            return [
+                {'id': card['id'], 'name': card['name']}
+                for card in catalog.cards if card['enable_embedding']
+            ]
+        if path[1:3] == ['api', 'card'] and len(path) == 4 and path[3].isdigit():
+            return catalog.cards_by_id.get(int(path[3]))
+        if path[1:3] == ['api', 'collection'] and len(path) == 5 and path[4] == 'items':
+            items = catalog.collection_items(path[3], params.get('models', ['card'])[0])
+            offset = int(params.get('offset', ['0'])[0])
+            limit = int(params.get('limit', [str(len(items))])[0])
+            return {'data': items[offset:offset + limit], 'total': len(items)}
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Batches open many connections at once. With the default backlog of 5
+    # the overflowing connection attempts are only retried about 1s later.
+    request_queue_size = 64
+
+
+class FakeMetabaseServer:
+    """
+    Serve a FakeCatalog on a local port, answering each request after
+    ``latency`` seconds.
+    """
+
+    def __init__(self, catalog, latency=0.0):
+        self.httpd = _Server(('127.0.0.1', 0), _Handler)
+        self.httpd.catalog = catalog
+        self.httpd.latency = latency
+        self.url = 'http://127.0.0.1:{0}'.format(self.httpd.server_address[1])
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -11,6 +11,25 @@ def clean_db(reset_db, migrate_db_for):
     migrate_db_for("in_app_reporting")
 
 
+@pytest.fixture(autouse=True)
+def reset_caches():
+    """Start every test with empty in-process caches"""
+    # Imported here, not at module level: this plugin module is loaded before
+    # CKAN reads the test ini, and utils reads its settings on import
+    import ckanext.in_app_reporting.client as client
+    import ckanext.in_app_reporting.metrics as metrics
+    import ckanext.in_app_reporting.utils as utils
+
+    utils._role_cache.clear()
+    utils._table_index.clear()
+    utils._embed_token_cache.clear()
+    utils._metadata_cache.clear()
+    utils._mapping_cache.clear()
+    client.reset_circuits()
+    metrics.reset()
+    yield
+
+
 @pytest.fixture
 def metabase_mapping_factory():
     """Factory for creating MetabaseMapping objects"""
@@ -27,6 +46,7 @@ def metabase_mapping_factory():
 
         mapping = MetabaseMapping(**defaults)
         model.Session.add(mapping)
+        mapping.save_memberships()
         model.Session.commit()
         return mapping
     return create_mapping
@@ -46,9 +66,9 @@ def mock_metabase_config():
 @pytest.fixture
 def mock_requests():
     """Mock requests module for Metabase API calls"""
-    with mock.patch('requests.get') as mock_get, \
-         mock.patch('requests.post') as mock_post, \
-         mock.patch('requests.put') as mock_put:
+    with mock.patch('requests.Session.get') as mock_get, \
+         mock.patch('requests.Session.post') as mock_post, \
+         mock.patch('requests.Session.put') as mock_put:
 
         # Default successful responses
         mock_get.return_value.status_code = 200
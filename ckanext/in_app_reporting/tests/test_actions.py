@@ -3,11 +3,23 @@ Tests for action.py functions.
 """
 import pytest
 from unittest import mock
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 from ckan.tests import factories
 from ckan.tests.helpers import call_action
 
 import ckanext.in_app_reporting.action as action
+from ckanext.in_app_reporting.model import CARD_SYNCED_AT_KEY, MetabaseCard, MetabaseSyncState
+
+
+PUBLISHED_CARD = {
+    'id': 123,
+    'name': 'Published card',
+    'type': 'question',
+    'collection_id': 1,
+    'table_id': 5,
+    'updated_at': '2025-08-01T18:20:49.005658Z'
+}
 
 
 @pytest.mark.usefixtures("with_plugins", "clean_db")
@@ -124,8 +136,34 @@ class TestMetabaseMappingActions:
         assert result['user_id'] == user['id']
         assert result['email'] == user['email']
 
+    def test_metabase_mapping_show_with_email_ignores_case(self, metabase_mapping_factory):
+        """Test that the email lookup is case-insensitive"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'], email='Jane.Doe@Example.com')
+
+        context = {'user': user['name']}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            result = call_action('metabase_mapping_show', context, email='jane.doe@example.COM')
+
+        assert result['user_id'] == user['id']
+
+    def test_metabase_mapping_show_with_platform_uuid(self, metabase_mapping_factory):
+        """Test showing metabase mapping by OpenGov platform UUID"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=factories.User()['id'])
+        metabase_mapping_factory(user_id=user['id'], platform_uuid='87654321-4321-4321-4321-210987654321')
+
+        context = {'user': user['name']}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            result = call_action(
+                'metabase_mapping_show', context, platform_uuid='87654321-4321-4321-4321-210987654321')
+
+        assert result['user_id'] == user['id']
+
     def test_metabase_mapping_show_validation_error(self):
-        """Test metabase mapping show without user_id or email"""
+        """Test metabase mapping show without user_id, email or platform_uuid"""
         user = factories.User()
 
         context = {'user': user['name']}
@@ -135,7 +173,7 @@ class TestMetabaseMappingActions:
              pytest.raises(toolkit.ValidationError) as exc_info:
             call_action('metabase_mapping_show', context, **data_dict)
 
-        assert 'Provide either user id or email' in str(exc_info.value)
+        assert 'Provide either user id, email or platform uuid' in str(exc_info.value)
 
     def test_metabase_mapping_show_not_found(self):
         """Test metabase mapping show when mapping doesn't exist"""
@@ -167,6 +205,82 @@ class TestMetabaseMappingActions:
         assert all('user_id' in mapping for mapping in result)
         assert all('email' in mapping for mapping in result)
 
+    def test_metabase_mapping_list_filters_by_membership(self, metabase_mapping_factory):
+        """Test listing the mappings of a collection or a group"""
+        user1 = factories.User()
+        user2 = factories.User()
+        metabase_mapping_factory(user_id=user1['id'], collection_ids='1;2', group_ids='group1')
+        metabase_mapping_factory(user_id=user2['id'], collection_ids='2', group_ids='group2')
+
+        context = {'user': user1['name']}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            in_collection = call_action('metabase_mapping_list', context, collection_id='1')
+            in_both = call_action('metabase_mapping_list', context, collection_id='2', group_id='group2')
+
+        assert [mapping['user_id'] for mapping in in_collection] == [user1['id']]
+        assert [mapping['user_id'] for mapping in in_both] == [user2['id']]
+
+    def test_metabase_mapping_list_pages(self, metabase_mapping_factory):
+        """Test limit/offset and keyset pagination in user id order"""
+        user_ids = sorted(factories.User()['id'] for _ in range(3))
+        for user_id in user_ids:
+            metabase_mapping_factory(user_id=user_id)
+
+        context = {'user': 'test-user'}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            first_page = call_action('metabase_mapping_list', context, limit=2)
+            offset_page = call_action('metabase_mapping_list', context, limit=2, offset=2)
+            next_page = call_action(
+                'metabase_mapping_list', context, limit=2, after_user_id=first_page[-1]['user_id'])
+
+        assert [mapping['user_id'] for mapping in first_page] == user_ids[:2]
+        assert [mapping['user_id'] for mapping in offset_page] == user_ids[2:]
+        assert next_page == offset_page
+
+    @pytest.mark.ckan_config("ckanext.in_app_reporting.mapping_list_limit", "2")
+    @pytest.mark.ckan_config("ckanext.in_app_reporting.mapping_list_max_limit", "3")
+    def test_metabase_mapping_list_limits(self, metabase_mapping_factory):
+        """Test the default page size and that larger limits are lowered to the maximum"""
+        user_ids = sorted(factories.User()['id'] for _ in range(4))
+        for user_id in user_ids:
+            metabase_mapping_factory(user_id=user_id)
+
+        context = {'user': 'test-user'}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            default_page = call_action('metabase_mapping_list', context)
+            capped_page = call_action('metabase_mapping_list', context, limit=10)
+
+        assert [mapping['user_id'] for mapping in default_page] == user_ids[:2]
+        assert [mapping['user_id'] for mapping in capped_page] == user_ids[:3]
+
+    def test_metabase_mapping_list_fields(self, metabase_mapping_factory):
+        """Test that only the requested fields, and the user id, are returned"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'], collection_ids='1;2')
+
+        context = {'user': 'test-user'}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            result = call_action('metabase_mapping_list', context, fields='collection_ids')
+
+        assert result == [{'user_id': user['id'], 'collection_ids': ['1', '2']}]
+
+    @pytest.mark.parametrize('data_dict', [
+        {'fields': 'user_id,password'},
+        {'limit': 'ten'},
+        {'offset': -1},
+    ])
+    def test_metabase_mapping_list_validation_error(self, data_dict):
+        """Test invalid fields and page arguments are rejected"""
+        context = {'user': 'test-user'}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'), \
+             pytest.raises(toolkit.ValidationError):
+            call_action('metabase_mapping_list', context, **data_dict)
+
 
 @pytest.mark.usefixtures("with_plugins", "clean_db")
 @pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
@@ -187,6 +301,45 @@ class TestMetabaseCardPublish:
         assert result['success'] is True
         mock_requests['put'].assert_called_once()
 
+    def test_metabase_card_publish_adds_card_to_catalog(self, mock_requests, mock_metabase_config):
+        """Test that a published card is upserted into the local card catalog"""
+        user = factories.User()
+        MetabaseSyncState.set_value(CARD_SYNCED_AT_KEY, '2025-08-01T00:00:00')
+        model.Session.commit()
+        mock_requests['put'].return_value.status_code = 200
+        mock_requests['put'].return_value.json.return_value = PUBLISHED_CARD
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            call_action('metabase_card_publish', {'user': user['name']}, id='123')
+
+        card = model.Session.query(MetabaseCard).get(123)
+        assert card.name == 'Published card'
+        assert card.collection_id == '1'
+
+    def test_metabase_card_publish_drops_collection_listing(self, mock_requests, mock_metabase_config):
+        """Test that publishing a card drops the cached listing of its collection"""
+        user = factories.User()
+        mock_requests['put'].return_value.status_code = 200
+        mock_requests['put'].return_value.json.return_value = PUBLISHED_CARD
+
+        with mock.patch('ckan.plugins.toolkit.check_access'), \
+             mock.patch('ckanext.in_app_reporting.utils.invalidate_collection_items') as mock_invalidate:
+            call_action('metabase_card_publish', {'user': user['name']}, id='123')
+
+        mock_invalidate.assert_called_once_with(1)
+
+    def test_metabase_card_publish_skips_unsynced_catalog(self, mock_requests, mock_metabase_config):
+        """Test that a card is not upserted before the first full sync, which would then be skipped"""
+        user = factories.User()
+        mock_requests['put'].return_value.status_code = 200
+        mock_requests['put'].return_value.json.return_value = PUBLISHED_CARD
+
+        with mock.patch('ckan.plugins.toolkit.check_access'):
+            call_action('metabase_card_publish', {'user': user['name']}, id='123')
+
+        assert model.Session.query(MetabaseCard).count() == 0
+        assert not MetabaseCard.is_populated()
+
     def test_metabase_card_publish_missing_id(self, mock_metabase_config):
         """Test card publishing without card ID"""
         user = factories.User()
@@ -690,4 +843,44 @@ class TestMetabaseUserCreatedDashboardsList:
              pytest.raises(toolkit.ValidationError) as exc_info:
             call_action('metabase_user_created_dashboards_list', context, **data_dict)
 
-        assert 'User email not found' in str(exc_info.value) 
\ No newline at end of file
+        assert 'User email not found' in str(exc_info.value) 
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestMetabaseIframeUrls:
+    """Test batch iframe URL generation"""
+
+    def test_metabase_iframe_urls_success(self, mock_metabase_config):
+        """Test that URLs are returned keyed by entity id"""
+        user = factories.User()
+        context = {'user': user['name']}
+        items = [
+            {'model_type': 'question', 'entity_id': 'card-1'},
+            {'model_type': 'dashboard', 'entity_id': 'dash-1'}
+        ]
+        expected_urls = {'card-1': 'https://example.com/embed/question/t1', 'dash-1': 'https://example.com/embed/dashboard/t2'}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'), \
+             mock.patch('ckanext.in_app_reporting.utils.get_metabase_iframe_urls', return_value=expected_urls) as mock_urls:
+            result = call_action('metabase_iframe_urls', context, items=items)
+
+        assert result == expected_urls
+        mock_urls.assert_called_once_with(items)
+
+    def test_metabase_iframe_urls_invalid_items(self, mock_metabase_config):
+        """Test that items without a valid model type are rejected"""
+        user = factories.User()
+        context = {'user': user['name']}
+
+        with mock.patch('ckan.plugins.toolkit.check_access'), \
+             pytest.raises(toolkit.ValidationError):
+            call_action('metabase_iframe_urls', context, items=[{'model_type': 'table', 'entity_id': '1'}])
+
+    def test_metabase_iframe_urls_not_authorized(self, mock_metabase_config):
+        """Test that non SSO users cannot mint embedding tokens"""
+        user = factories.User()
+        context = {'user': user['name'], 'ignore_auth': False}
+
+        with pytest.raises(toolkit.NotAuthorized):
+            call_action('metabase_iframe_urls', context, items=[])
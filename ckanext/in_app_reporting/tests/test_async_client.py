@@ -0,0 +1,125 @@
+"""
+Tests for async_client.py asyncio Metabase client.
+"""
+import threading
+import time
+
+import pytest
+from unittest import mock
+
+import ckanext.in_app_reporting.async_client as async_client
+import ckanext.in_app_reporting.client as client
+import ckanext.in_app_reporting.utils as utils
+from ckanext.in_app_reporting.tests.fake_metabase import FakeCatalog, FakeMetabaseServer
+
+pytest.importorskip('httpx')
+
+
+@pytest.fixture
+def fake_metabase():
+    with FakeMetabaseServer(FakeCatalog(tables=2, cards=30, collections=1), latency=0.05) as server:
+        yield server
+
+
+@pytest.fixture(autouse=True)
+def reset_circuits():
+    client.reset_circuits()
+    yield
+    client.reset_circuits()
+
+
+class TestGetJsonMany:
+    """Test concurrent GETs on an event loop"""
+
+    def test_results_in_url_order(self, fake_metabase):
+        """Test that results follow the URLs and failures are None"""
+        urls = [f'{fake_metabase.url}/api/card/{card_id}' for card_id in (3, 1, 999)]
+
+        results = async_client.run(async_client.get_json_many(urls))
+
+        assert results[0]['id'] == 3
+        assert results[1]['id'] == 1
+        assert results[2] is None
+
+    def test_requests_overlap(self, fake_metabase):
+        """Test that requests run concurrently rather than one after another"""
+        urls = [f'{fake_metabase.url}/api/card/{card_id}' for card_id in range(1, 31)]
+
+        started = time.monotonic()
+        results = async_client.run(async_client.get_json_many(urls, concurrency=30))
+        elapsed = time.monotonic() - started
+
+        assert [card['id'] for card in results] == list(range(1, 31))
+        assert elapsed < 30 * 0.05 / 2
+
+    def test_client_reused_across_batches(self, fake_metabase):
+        """Test that batches share one client and event loop"""
+        url = f'{fake_metabase.url}/api/card/1'
+
+        async_client.run(async_client.get_json_many([url]))
+        state = async_client._state()
+        async_client.run(async_client.get_json_many([url]))
+
+        assert async_client._state() is state
+        assert not state.http.is_closed
+
+    def test_threads_share_one_loop(self, fake_metabase):
+        """Test that batches from other threads run on the same loop instead of each leaking one"""
+        url = f'{fake_metabase.url}/api/card/1'
+        async_client.run(async_client.get_json_many([url]))
+        state = async_client._state()
+        results = []
+
+        thread = threading.Thread(
+            target=lambda: results.append(async_client.run(async_client.get_json_many([url]))))
+        thread.start()
+        thread.join()
+
+        assert results[0][0]['id'] == 1
+        assert async_client._state() is state
+
+    def test_duplicate_urls_fetched_once(self, fake_metabase):
+        """Test that a URL already in flight is not requested again"""
+        url = f'{fake_metabase.url}/api/card/2'
+        with mock.patch('ckanext.in_app_reporting.async_client.get_json',
+                        wraps=async_client.get_json) as get_json:
+            results = async_client.run(async_client.get_json_many([url, url, url]))
+
+        assert [card['id'] for card in results] == [2, 2, 2]
+        get_json.assert_called_once()
+
+    def test_open_circuit_fails_fast(self, fake_metabase):
+        """Test that no request is sent while the circuit of the host is open"""
+        url = f'{fake_metabase.url}/api/card/1'
+        with mock.patch.object(client.CircuitBreaker, 'allow', return_value=False), \
+             mock.patch('httpx.AsyncClient.get') as mock_get:
+            results = async_client.run(async_client.get_json_many([url]))
+
+        assert results == [None]
+        mock_get.assert_not_called()
+
+
+class TestMetabaseGetMany:
+    """Test utils.metabase_get_many with and without the async client"""
+
+    def test_async_client_enabled(self, fake_metabase):
+        """Test that batches run on the event loop when enabled"""
+        urls = [f'{fake_metabase.url}/api/card/{card_id}' for card_id in (1, 2)]
+        with mock.patch('ckanext.in_app_reporting.config.async_client_enabled', return_value=True), \
+             mock.patch('ckanext.in_app_reporting.utils.metabase_get_request') as mock_get_request:
+            results = dict(utils.metabase_get_many(urls))
+
+        mock_get_request.assert_not_called()
+        assert results[urls[0]]['id'] == 1
+        assert results[urls[1]]['id'] == 2
+
+    def test_async_client_disabled(self):
+        """Test that batches fall back to the thread fan-out"""
+        urls = ['https://example.com/api/card/1', 'https://example.com/api/card/2']
+        with mock.patch('ckanext.in_app_reporting.config.async_client_enabled', return_value=False), \
+             mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        side_effect=lambda url: {'url': url}) as mock_get_request:
+            results = dict(utils.metabase_get_many(urls))
+
+        assert mock_get_request.call_count == 2
+        assert results == {url: {'url': url} for url in urls}
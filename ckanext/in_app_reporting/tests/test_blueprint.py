@@ -1,4 +1,6 @@
 import pytest
+import json
+from unittest import mock
 
 from ckantoolkit import url_for
 from ckantoolkit.tests import factories
@@ -61,6 +63,23 @@ class TestBlueprint:
         assert 'Datastore Table ID:' in response.body
         assert resource['id'] in response.body
 
+    def test_metabase_data_page_metabase_unavailable(self, app, mock_is_metabase_sso_user, monkeypatch):
+        """Test metabase_data renders a degraded state without calling Metabase while its circuit is open"""
+        dataset = factories.Dataset(title='Test Dataset')
+        resource = factories.Resource(package_id=dataset['id'], name='Test Resource')
+        table_lookup = mock.Mock(return_value=123)
+        monkeypatch.setattr('ckanext.in_app_reporting.client.is_available', lambda url: False)
+        monkeypatch.setattr('ckanext.in_app_reporting.utils._table_index.lookup', table_lookup)
+
+        url = url_for('metabase.metabase_data', id=dataset['id'], resource_id=resource['id'])
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+
+        response = app.get(url, extra_environ=env)
+
+        assert 'Insights are temporarily unavailable' in response.body
+        table_lookup.assert_not_called()
+
     def test_metabase_data_not_authorized(self, app, mock_is_metabase_sso_user, monkeypatch):
         """Test metabase_data returns 404 when user is not authorized"""
         dataset = factories.Dataset(title='Test Dataset')
@@ -203,11 +222,15 @@ class TestBlueprint:
         # Stub utils to avoid external calls
         monkeypatch.setattr(
             'ckanext.in_app_reporting.utils.get_metabase_collection_items',
-            lambda model_type: [
+            lambda model_type, **kwargs: [
                 {'id': 1, 'name': 'Card 1', 'type': 'card'},
                 {'id': 2, 'name': 'Card 2', 'type': 'card'},
             ]
         )
+        monkeypatch.setattr(
+            'ckanext.in_app_reporting.utils.get_metabase_embeddable_ids',
+            lambda model_type: frozenset([2])
+        )
 
         url = url_for('metabase.get_metabase_collection_items', model_type='card')
         sysadmin = factories.Sysadmin()
@@ -217,15 +240,43 @@ class TestBlueprint:
 
         assert response.json == {
             'results': [
-                {'id': 1, 'name': 'Card 1', 'type': 'card'},
-                {'id': 2, 'name': 'Card 2', 'type': 'card'},
-            ]
+                {'id': 1, 'name': 'Card 1', 'type': 'card', 'embeddable': False},
+                {'id': 2, 'name': 'Card 2', 'type': 'card', 'embeddable': True},
+            ],
+            'more': False
         }
 
+    def test_collection_items_list_pages_results(self, app, mock_is_metabase_sso_user, monkeypatch):
+        captured = {}
+
+        def fake_get_items(model_type, q=None, limit=None, offset=0):
+            captured.update(q=q, limit=limit, offset=offset)
+            return [{'id': i, 'name': f'Card {i}', 'type': 'card'} for i in range(limit)]
+
+        monkeypatch.setattr(
+            'ckanext.in_app_reporting.utils.get_metabase_collection_items',
+            fake_get_items
+        )
+        monkeypatch.setattr(
+            'ckanext.in_app_reporting.utils.get_metabase_embeddable_ids',
+            lambda model_type: frozenset()
+        )
+
+        url = url_for('metabase.get_metabase_collection_items', model_type='card', q='sales', limit=2, offset=4)
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+
+        response = app.get(url, extra_environ=env)
+
+        # One extra item is requested to tell whether another page exists
+        assert captured == {'q': 'sales', 'limit': 3, 'offset': 4}
+        assert len(response.json['results']) == 2
+        assert response.json['more'] is True
+
     def test_collection_items_list_question_type_maps_to_card(self, app, mock_is_metabase_sso_user, monkeypatch):
         captured = {'model_type': None}
 
-        def fake_get_items(model_type):
+        def fake_get_items(model_type, **kwargs):
             captured['model_type'] = model_type
             return []
 
@@ -233,6 +284,10 @@ class TestBlueprint:
             'ckanext.in_app_reporting.utils.get_metabase_collection_items',
             fake_get_items
         )
+        monkeypatch.setattr(
+            'ckanext.in_app_reporting.utils.get_metabase_embeddable_ids',
+            lambda model_type: frozenset()
+        )
 
         url = url_for('metabase.get_metabase_collection_items', model_type='question')
         sysadmin = factories.Sysadmin()
@@ -573,10 +628,14 @@ class TestBlueprint:
         
         monkeypatch.setattr('ckanext.in_app_reporting.blueprint.tk.get_action', fake_get_action)
         monkeypatch.setattr('ckanext.in_app_reporting.utils.get_metabase_table_id', lambda rid: 123)
-        monkeypatch.setattr('ckanext.in_app_reporting.utils.get_metabase_chart_list', lambda tid, rid: [
+        monkeypatch.setattr('ckanext.in_app_reporting.utils.get_metabase_chart_list', lambda tid, rid, **kwargs: [
             {'id': 1, 'name': 'Chart 1', 'type': 'question'},
             {'id': 2, 'name': 'Chart 2', 'type': 'question'}
         ])
+        monkeypatch.setattr(
+            'ckanext.in_app_reporting.utils.get_metabase_embeddable_ids',
+            lambda model_type: frozenset([1]) if model_type == 'card' else frozenset()
+        )
         
         url = url_for('metabase.chart_list', resource_id=resource['id'])
         sysadmin = factories.Sysadmin()
@@ -587,9 +646,10 @@ class TestBlueprint:
         assert response.status_code == 200
         assert response.json == {
             'results': [
-                {'id': 1, 'name': 'Chart 1', 'type': 'question'},
-                {'id': 2, 'name': 'Chart 2', 'type': 'question'}
-            ]
+                {'id': 1, 'name': 'Chart 1', 'type': 'question', 'embeddable': True},
+                {'id': 2, 'name': 'Chart 2', 'type': 'question', 'embeddable': False}
+            ],
+            'more': False
         }
 
     def test_chart_list_not_sso_user(self, app, mock_check_access, monkeypatch):
@@ -771,3 +831,81 @@ class TestBlueprint:
         
         assert 'id="metabase-interactive-embed"' in response.body
         assert 'return_to=/collection/1' in response.body
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestMetricsEndpoint:
+
+    def test_metrics_disabled(self, app):
+        """Test the metrics endpoint is hidden unless enabled"""
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+
+        response = app.get(url_for('metabase.metabase_metrics'), extra_environ=env, expect_errors=True)
+
+        assert response.status_code == 404
+
+    @pytest.mark.ckan_config("ckanext.in_app_reporting.metrics_enabled", "true")
+    def test_metrics_sysadmin(self, app):
+        """Test sysadmins can read the metrics"""
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+
+        response = app.get(url_for('metabase.metabase_metrics'), extra_environ=env)
+
+        assert response.status_code == 200
+        assert '# TYPE metabase_request_duration_seconds histogram' in response.body
+
+    @pytest.mark.ckan_config("ckanext.in_app_reporting.metrics_enabled", "true")
+    @pytest.mark.ckan_config("ckanext.in_app_reporting.metrics_token", "s3cret")
+    def test_metrics_token(self, app):
+        """Test scrapers authenticate with the bearer token"""
+        url = url_for('metabase.metabase_metrics')
+
+        allowed = app.get(url, headers={'Authorization': 'Bearer s3cret'})
+        denied = app.get(url, headers={'Authorization': 'Bearer wrong'}, expect_errors=True)
+
+        assert allowed.status_code == 200
+        assert denied.status_code == 404
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestMappingExportEndpoint:
+
+    def test_export_streams_ndjson(self, app, metabase_mapping_factory):
+        """Test sysadmins get one JSON mapping per line"""
+        user_ids = sorted(factories.User()['id'] for _ in range(2))
+        for user_id in user_ids:
+            metabase_mapping_factory(user_id=user_id, collection_ids='1')
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+
+        response = app.get(
+            url_for('metabase.metabase_mapping_export', fields='email'), extra_environ=env)
+
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('application/x-ndjson')
+        lines = [json.loads(line) for line in response.body.splitlines()]
+        assert lines == [{'user_id': user_id, 'email': 'test@example.com'} for user_id in user_ids]
+
+    def test_export_not_sysadmin(self, app):
+        """Test other users cannot export the mappings"""
+        user = factories.User()
+        env = {"REMOTE_USER": user['name'].encode('ascii')}
+
+        response = app.get(
+            url_for('metabase.metabase_mapping_export'), extra_environ=env, expect_errors=True)
+
+        assert response.status_code == 404
+
+    def test_export_invalid_arguments(self, app):
+        """Test invalid arguments are rejected before streaming"""
+        sysadmin = factories.Sysadmin()
+        env = {"REMOTE_USER": sysadmin['name'].encode('ascii')}
+
+        response = app.get(
+            url_for('metabase.metabase_mapping_export', limit='ten'), extra_environ=env, expect_errors=True)
+
+        assert response.status_code == 400
@@ -0,0 +1,302 @@
+"""
+Tests for cache.py caching helpers.
+"""
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from flask import Flask
+
+import ckanext.in_app_reporting.cache as cache
+
+
+class TestRequestMemoize:
+    """Test the request scoped memoization decorator"""
+
+    def test_repeated_calls_hit_cache_within_request(self):
+        """Test that a helper only runs once per request for the same args"""
+        func = mock.Mock(return_value=['card'], __name__='func', __qualname__='func')
+        memoized = cache.request_memoize(func)
+
+        with Flask(__name__).test_request_context():
+            assert memoized('123') == ['card']
+            assert memoized('123') == ['card']
+            assert memoized('456') == ['card']
+
+        assert func.call_count == 2
+
+    def test_cache_is_not_shared_between_requests(self):
+        """Test that a new request starts with an empty cache"""
+        func = mock.Mock(return_value=True, __name__='func', __qualname__='func')
+        memoized = cache.request_memoize(func)
+        app = Flask(__name__)
+
+        with app.test_request_context():
+            memoized('user')
+        with app.test_request_context():
+            memoized('user')
+
+        assert func.call_count == 2
+
+    def test_outside_request_calls_through(self):
+        """Test that calls without a request context are not cached"""
+        func = mock.Mock(return_value=1, __name__='func', __qualname__='func')
+        memoized = cache.request_memoize(func)
+
+        memoized('a')
+        memoized('a')
+
+        assert func.call_count == 2
+
+    def test_app_context_without_request_calls_through(self):
+        """Test that calls in a bare app context, as in CLI commands and jobs, are not cached"""
+        func = mock.Mock(return_value=1, __name__='func', __qualname__='func')
+        memoized = cache.request_memoize(func)
+
+        with Flask(__name__).app_context():
+            memoized('a')
+            memoized('a')
+
+        assert func.call_count == 2
+
+    def test_unhashable_args_call_through(self):
+        """Test that unhashable arguments bypass the cache"""
+        func = mock.Mock(return_value=1, __name__='func', __qualname__='func')
+        memoized = cache.request_memoize(func)
+
+        with Flask(__name__).test_request_context():
+            memoized(['a'])
+            memoized(['a'])
+
+        assert func.call_count == 2
+
+
+class TestTTLCache:
+    """Test the bounded TTL cache"""
+
+    def test_get_and_set(self):
+        """Test that stored values are returned until they expire"""
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=60)
+        ttl_cache.set('a', 1)
+
+        assert ttl_cache.get('a') == 1
+        assert 'a' in ttl_cache
+        assert ttl_cache.get('b', 'default') == 'default'
+
+    def test_expired_entries_are_dropped(self):
+        """Test that entries are not returned after their ttl"""
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=60)
+        with mock.patch('time.monotonic', return_value=100):
+            ttl_cache.set('a', 1)
+        with mock.patch('time.monotonic', return_value=161):
+            assert ttl_cache.get('a') is None
+        assert len(ttl_cache) == 0
+
+    def test_least_recently_used_is_evicted(self):
+        """Test that the cache stays within maxsize"""
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60)
+        ttl_cache.set('a', 1)
+        ttl_cache.set('b', 2)
+        ttl_cache.get('a')
+        ttl_cache.set('c', 3)
+
+        assert 'a' in ttl_cache
+        assert 'b' not in ttl_cache
+        assert 'c' in ttl_cache
+
+    def test_zero_ttl_disables_cache(self):
+        """Test that a ttl of zero never stores values"""
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=0)
+        ttl_cache.set('a', 1)
+
+        assert ttl_cache.get('a') is None
+
+    def test_per_entry_ttl(self):
+        """Test that set can override the ttl of a single entry"""
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=60)
+        with mock.patch('time.monotonic', return_value=100):
+            ttl_cache.set('a', 1, ttl=5)
+            ttl_cache.set('b', 2, ttl=-1)
+        with mock.patch('time.monotonic', return_value=106):
+            assert ttl_cache.get('a') is None
+        assert 'b' not in ttl_cache
+
+    def test_delete_and_clear(self):
+        """Test explicit invalidation"""
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=60)
+        ttl_cache.set('a', 1)
+        ttl_cache.set('b', 2)
+        ttl_cache.delete('a')
+
+        assert 'a' not in ttl_cache
+        ttl_cache.clear()
+        assert len(ttl_cache) == 0
+
+
+class TestSingleFlight:
+    """Test collapsing of concurrent calls"""
+
+    def test_concurrent_calls_share_one_result(self):
+        """Test that callers arriving mid-flight wait for the leader"""
+        flight = cache.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def mint():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'token'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', mint)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', mint))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        # Give the followers time to join the in-flight call
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        assert results == ['token'] * 4
+        assert len(calls) == 1
+
+    def test_sequential_calls_run_again(self):
+        """Test that a finished flight is not cached"""
+        flight = cache.SingleFlight()
+        func = mock.Mock(side_effect=['a', 'b'])
+
+        assert flight.do('key', func) == 'a'
+        assert flight.do('key', func) == 'b'
+
+    def test_error_is_raised(self):
+        """Test that the leader's exception propagates"""
+        flight = cache.SingleFlight()
+
+        with pytest.raises(ValueError):
+            flight.do('key', mock.Mock(side_effect=ValueError('boom')))
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def backend(request):
+    """Run metadata cache tests against both backends"""
+    if request.param == 'redis':
+        fakeredis = pytest.importorskip('fakeredis')
+        return cache.RedisBackend('test:metadata:', connection=fakeredis.FakeRedis())
+    return cache.TTLCache(maxsize=100, ttl=60)
+
+
+class TestMetadataCache:
+    """Test the read-through metadata cache"""
+
+    def test_get_or_compute_caches_value(self, backend):
+        """Test that the value is computed once and then read from the backend"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        compute = mock.Mock(return_value={'tables': [1, 2]})
+
+        assert metadata_cache.get_or_compute('tables', compute) == {'tables': [1, 2]}
+        assert metadata_cache.get_or_compute('tables', compute) == {'tables': [1, 2]}
+        compute.assert_called_once()
+
+    def test_fresh_bypasses_cache(self, backend):
+        """Test that fresh recomputes and stores the new value"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        metadata_cache.get_or_compute('tables', lambda: 'old')
+
+        assert metadata_cache.get_or_compute('tables', lambda: 'new', fresh=True) == 'new'
+        assert metadata_cache.get_or_compute('tables', lambda: 'other') == 'new'
+
+    def test_set_stores_value(self, backend):
+        """Test that set writes a value that is then read without computing"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        metadata_cache.get_or_compute('mapping', lambda: 'old')
+
+        metadata_cache.set('mapping', 'new')
+
+        assert metadata_cache.get_or_compute('mapping', lambda: 'computed') == 'new'
+
+    def test_update_keeps_expiry(self, backend):
+        """Test that update rewrites a cached value and ignores missing keys"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        metadata_cache.get_or_compute('ids', lambda: [1])
+        expiry = backend.get('ids')['expiry']
+
+        metadata_cache.update('ids', lambda ids: ids + [2])
+        metadata_cache.update('missing', lambda ids: ids + [2])
+
+        assert backend.get('ids')['value'] == [1, 2]
+        assert backend.get('ids')['expiry'] == expiry
+        assert backend.get('missing') is None
+
+    def test_failures_are_not_cached(self, backend):
+        """Test that a None result is not stored"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        compute = mock.Mock(side_effect=[None, 'value'])
+
+        assert metadata_cache.get_or_compute('key', compute) is None
+        assert metadata_cache.get_or_compute('key', compute) == 'value'
+
+    def test_early_refresh_near_expiry(self, backend):
+        """Test that an entry close to expiry is recomputed ahead of time"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        with mock.patch('time.time', return_value=1000):
+            metadata_cache.get_or_compute('key', lambda: 'old')
+        backend.set('key', {'value': 'old', 'delta': 5, 'expiry': 1059}, 60)
+
+        with mock.patch('time.time', return_value=1050), \
+             mock.patch('random.random', return_value=0.5):
+            # A 5s computation with ~3.5s head start is not yet due at 1050
+            assert metadata_cache.get_or_compute('key', lambda: 'new') == 'old'
+        with mock.patch('time.time', return_value=1056), \
+             mock.patch('random.random', return_value=0.5):
+            assert metadata_cache.get_or_compute('key', lambda: 'new') == 'new'
+
+    def test_failed_early_refresh_serves_stale_value(self, backend):
+        """Test that the previous value is kept when an early refresh fails"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        backend.set('key', {'value': 'old', 'delta': 5, 'expiry': time.time() + 1}, 60)
+
+        with mock.patch('random.random', return_value=0.99):
+            assert metadata_cache.get_or_compute('key', lambda: None) == 'old'
+
+    def test_delete_and_clear(self, backend):
+        """Test explicit invalidation"""
+        metadata_cache = cache.MetadataCache(backend, ttl=60)
+        metadata_cache.get_or_compute('a', lambda: 1)
+        metadata_cache.get_or_compute('b', lambda: 2)
+        metadata_cache.delete('a')
+
+        assert metadata_cache.get_or_compute('a', lambda: 3) == 3
+        metadata_cache.clear()
+        assert metadata_cache.get_or_compute('b', lambda: 4) == 4
+
+
+class TestRedisBackend:
+    """Test the Redis cache backend"""
+
+    def test_redis_errors_are_cache_misses(self):
+        """Test that an unreachable Redis does not break callers"""
+        connection = mock.Mock()
+        connection.get.side_effect = Exception('connection refused')
+        connection.set.side_effect = Exception('connection refused')
+        backend = cache.RedisBackend('test:', connection=connection)
+
+        backend.set('key', 'value', 60)
+        assert backend.get('key') is None
+
+    def test_values_expire_in_redis(self):
+        """Test that entries are written with the ttl as their Redis expiry"""
+        fakeredis = pytest.importorskip('fakeredis')
+        connection = fakeredis.FakeRedis()
+        backend = cache.RedisBackend('test:', connection=connection)
+
+        backend.set('key', {'value': 1}, 60)
+
+        assert 0 < connection.pttl('test:key') <= 60000
+        assert backend.get('key') == {'value': 1}
@@ -83,4 +83,37 @@ class TestMetabaseCli:
 
     def test_metabase_remove_not_found(self, cli):
         result = cli.invoke(ckan, ["metabase", "remove", "non-existent-id"])  # no mapping exists
-        assert result.exit_code != 0 
\ No newline at end of file
+        assert result.exit_code != 0 
+
+    def test_metabase_index_cards_success(self, cli):
+        with mock.patch("ckanext.in_app_reporting.sync.rebuild_card_index", return_value=3):
+            result = cli.invoke(ckan, ["metabase", "index-cards"])
+        assert result.exit_code == 0
+        assert "Indexed 3 Metabase cards" in result.output
+
+    def test_metabase_index_cards_failure(self, cli):
+        with mock.patch("ckanext.in_app_reporting.sync.rebuild_card_index", side_effect=RuntimeError("boom")):
+            result = cli.invoke(ckan, ["metabase", "index-cards"])
+        assert result.exit_code != 0
+
+    def test_metabase_sync_cards_success(self, cli):
+        with mock.patch("ckanext.in_app_reporting.sync.sync_cards", return_value=2) as mock_sync:
+            result = cli.invoke(ckan, ["metabase", "sync-cards"])
+        assert result.exit_code == 0
+        assert "Synced 2 Metabase cards" in result.output
+        mock_sync.assert_called_once_with(full=False)
+
+    def test_metabase_sync_cards_enqueue(self, cli):
+        job = mock.Mock(id="job-1")
+        with mock.patch("ckanext.in_app_reporting.sync.enqueue_card_sync", return_value=job) as mock_enqueue:
+            result = cli.invoke(ckan, ["metabase", "sync-cards", "--full", "--enqueue"])
+        assert result.exit_code == 0
+        assert "job-1" in result.output
+        mock_enqueue.assert_called_once_with(full=True)
+
+    def test_metabase_sync_dashboards_success(self, cli):
+        with mock.patch("ckanext.in_app_reporting.sync.sync_dashboards", return_value=4) as mock_sync:
+            result = cli.invoke(ckan, ["metabase", "sync-dashboards", "--full"])
+        assert result.exit_code == 0
+        assert "Synced 4 Metabase dashboards" in result.output
+        mock_sync.assert_called_once_with(full=True)
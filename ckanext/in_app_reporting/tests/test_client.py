@@ -0,0 +1,279 @@
+"""
+Tests for client.py Metabase HTTP client.
+"""
+import time
+
+import pytest
+import requests
+from unittest import mock
+
+import ckanext.in_app_reporting.client as client
+import ckanext.in_app_reporting.metrics as metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_session():
+    client.close_session()
+    client.reset_circuits()
+    metrics.reset()
+    yield
+    client.close_session()
+    client.reset_circuits()
+
+
+class TestMetabaseSession:
+    """Test the pooled Metabase session"""
+
+    def test_get_session_is_reused(self):
+        """Test that the same session is returned within a process"""
+        assert client.get_session() is client.get_session()
+
+    def test_get_session_rebuilt_after_fork(self):
+        """Test that a new session is built when the process id changes"""
+        session = client.get_session()
+        with mock.patch('os.getpid', return_value=-1):
+            assert client.get_session() is not session
+
+    def test_get_session_uses_configured_pool(self):
+        """Test that the adapter is built from the pool settings"""
+        with mock.patch('ckanext.in_app_reporting.config.http_pool_connections', return_value=2), \
+             mock.patch('ckanext.in_app_reporting.config.http_pool_maxsize', return_value=7), \
+             mock.patch('ckanext.in_app_reporting.config.http_pool_block', return_value=True):
+            session = client.get_session()
+
+        adapter = session.get_adapter('https://example.com')
+        assert adapter._pool_connections == 2
+        assert adapter._pool_maxsize == 7
+        assert adapter._pool_block is True
+        assert session.headers['Connection'] == 'keep-alive'
+
+    def test_close_session(self):
+        """Test that closing the session forces a new one"""
+        session = client.get_session()
+        client.close_session()
+        assert client.get_session() is not session
+
+    @mock.patch('requests.Session.get')
+    def test_get_uses_session(self, mock_get):
+        """Test that module level get goes through the pooled session"""
+        client.get('https://example.com/api/test', headers={'x-api-key': 'test-key'})
+
+        mock_get.assert_called_once_with(
+            'https://example.com/api/test',
+            timeout=(3.05, 30.0),
+            headers={'x-api-key': 'test-key'}
+        )
+
+
+def _response(status_code):
+    response = mock.Mock()
+    response.status_code = status_code
+    return response
+
+
+@mock.patch('time.sleep')
+class TestMetabaseRequest:
+    """Test timeouts, retries and deadlines of Metabase requests"""
+
+    @mock.patch('requests.Session.post')
+    def test_call_class_read_timeout(self, mock_post, mock_sleep):
+        """Test that each call class uses its own read timeout"""
+        mock_post.return_value = _response(200)
+        with mock.patch('ckanext.in_app_reporting.config.http_connect_timeout', return_value=2), \
+             mock.patch('ckanext.in_app_reporting.config.token_read_timeout', return_value=5):
+            client.post('https://example.com/api/v1/token', call_class=client.TOKEN)
+
+        assert mock_post.call_args.kwargs['timeout'] == (2, 5)
+
+    @mock.patch('requests.Session.get')
+    def test_get_retries_transient_failures(self, mock_get, mock_sleep):
+        """Test that GETs are retried on connection errors and transient statuses"""
+        mock_get.side_effect = [requests.ConnectionError('reset'), _response(503), _response(200)]
+
+        response = client.get('https://example.com/api/card')
+
+        assert response.status_code == 200
+        assert mock_get.call_count == 3
+        assert mock_sleep.call_count == 2
+
+    @mock.patch('requests.Session.get')
+    def test_get_gives_up_after_retries(self, mock_get, mock_sleep):
+        """Test that the last error is raised once retries are exhausted"""
+        mock_get.side_effect = requests.Timeout('slow')
+
+        with mock.patch('ckanext.in_app_reporting.config.http_retries', return_value=1), \
+             pytest.raises(requests.Timeout):
+            client.get('https://example.com/api/card')
+
+        assert mock_get.call_count == 2
+
+    @mock.patch('requests.Session.get')
+    def test_get_returns_last_transient_response(self, mock_get, mock_sleep):
+        """Test that a persistent transient status is returned, not raised"""
+        mock_get.return_value = _response(502)
+
+        response = client.get('https://example.com/api/card')
+
+        assert response.status_code == 502
+        assert mock_get.call_count == 3
+
+    @mock.patch('requests.Session.put')
+    def test_writes_are_not_retried(self, mock_put, mock_sleep):
+        """Test that non idempotent requests are sent once"""
+        mock_put.side_effect = requests.ConnectionError('reset')
+
+        with pytest.raises(requests.ConnectionError):
+            client.put('https://example.com/api/card/1')
+
+        mock_put.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @mock.patch('requests.Session.get')
+    def test_deadline_stops_retries(self, mock_get, mock_sleep):
+        """Test that no retry is attempted past the request deadline"""
+        mock_get.return_value = _response(503)
+
+        with mock.patch('ckanext.in_app_reporting.config.http_request_deadline', return_value=0.01), \
+             mock.patch('ckanext.in_app_reporting.config.http_retry_backoff', return_value=100), \
+             mock.patch('random.uniform', return_value=50):
+            response = client.get('https://example.com/api/card')
+
+        assert response.status_code == 503
+        mock_get.assert_called_once()
+        assert mock_get.call_args.kwargs['timeout'][1] <= 0.01
+
+
+class TestCircuitBreaker:
+    """Test the consecutive failure circuit breaker"""
+
+    def test_opens_after_threshold(self):
+        """Test that the circuit opens after N consecutive failures"""
+        breaker = client.CircuitBreaker(failure_threshold=3, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+
+        assert breaker.is_open
+        assert not breaker.allow()
+
+    def test_success_resets_failures(self):
+        """Test that failures must be consecutive"""
+        breaker = client.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        assert not breaker.is_open
+
+    def test_half_open_allows_one_trial(self):
+        """Test that a single trial call is let through after the reset timeout"""
+        breaker = client.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        with mock.patch('time.monotonic', return_value=100):
+            breaker.record_failure()
+        with mock.patch('time.monotonic', return_value=131):
+            assert not breaker.is_open
+            assert breaker.allow()
+            assert not breaker.allow()
+            breaker.record_failure()
+            assert breaker.is_open
+        with mock.patch('time.monotonic', return_value=162):
+            assert breaker.allow()
+            breaker.record_success()
+            assert breaker.allow()
+
+    def test_zero_threshold_disables_breaker(self):
+        """Test that a threshold of zero never opens the circuit"""
+        breaker = client.CircuitBreaker(failure_threshold=0, reset_timeout=30)
+        for _ in range(10):
+            breaker.record_failure()
+
+        assert breaker.allow()
+
+
+@mock.patch('time.sleep')
+class TestMetabaseRequestCircuit:
+    """Test that Metabase requests fail fast while the circuit is open"""
+
+    @mock.patch('requests.Session.get')
+    def test_open_circuit_fails_fast(self, mock_get, mock_sleep):
+        """Test that requests are not sent once the circuit has tripped"""
+        mock_get.side_effect = requests.ConnectionError('refused')
+
+        with mock.patch('ckanext.in_app_reporting.config.circuit_failure_threshold', return_value=2), \
+             mock.patch('ckanext.in_app_reporting.config.http_retries', return_value=0):
+            for _ in range(2):
+                with pytest.raises(requests.ConnectionError):
+                    client.get('https://metabase.example.com/api/card')
+            with pytest.raises(client.CircuitOpenError):
+                client.get('https://metabase.example.com/api/card')
+
+        assert mock_get.call_count == 2
+        assert not client.is_available('https://metabase.example.com')
+        assert client.is_available('https://other.example.com')
+
+    @mock.patch('requests.Session.get')
+    def test_server_errors_count_as_failures(self, mock_get, mock_sleep):
+        """Test that gateway errors trip the circuit but 4xx and 500 do not"""
+        mock_get.return_value.status_code = 404
+        with mock.patch('ckanext.in_app_reporting.config.circuit_failure_threshold', return_value=1), \
+             mock.patch('ckanext.in_app_reporting.config.http_retries', return_value=0):
+            client.get('https://metabase.example.com/api/card/1')
+            assert client.is_available('https://metabase.example.com')
+
+            mock_get.return_value.status_code = 500
+            client.get('https://metabase.example.com/api/card/1')
+            assert client.is_available('https://metabase.example.com')
+
+            mock_get.return_value.status_code = 503
+            client.get('https://metabase.example.com/api/card/1')
+            assert not client.is_available('https://metabase.example.com')
+
+
+@mock.patch('time.sleep')
+class TestMetabaseRequestMetrics:
+    """Test that Metabase requests are instrumented"""
+
+    @mock.patch('requests.Session.get')
+    def test_request_is_recorded(self, mock_get, mock_sleep):
+        """Test that status, bytes and retries are recorded per endpoint"""
+        retry = _response(503)
+        success = _response(200)
+        success.headers = {'Content-Length': '2048'}
+        mock_get.side_effect = [retry, success]
+
+        client.get('https://metabase.example.com/api/card/42')
+
+        output = metrics.render_prometheus()
+        labels = 'method="GET",endpoint="/api/card/{id}"'
+        assert 'metabase_requests_total{%s,status="200"} 1' % labels in output
+        assert 'metabase_response_bytes_total{%s} 2048' % labels in output
+        assert 'metabase_request_retries_total{%s} 1' % labels in output
+
+    @mock.patch('requests.Session.get')
+    def test_streamed_bytes_recorded_on_close(self, mock_get, mock_sleep):
+        """Test that a chunked streamed response is counted once it is read and closed"""
+        response = _response(200)
+        response.headers = {}
+        response._content = False
+        response.raw.tell.return_value = 4096
+        mock_get.return_value = response
+
+        streamed = client.get('https://metabase.example.com/api/card', stream=True)
+        labels = 'method="GET",endpoint="/api/card"'
+        assert 'metabase_response_bytes_total{%s}' % labels not in metrics.render_prometheus()
+
+        streamed.close()
+        streamed.close()
+
+        assert 'metabase_response_bytes_total{%s} 4096' % labels in metrics.render_prometheus()
+
+    def test_slow_request_is_logged(self, mock_sleep):
+        """Test that requests above the threshold log a warning"""
+        with mock.patch('ckanext.in_app_reporting.config.slow_call_threshold', return_value=0.5), \
+             mock.patch.object(client.log, 'warning') as mock_warning:
+            client._observe('GET', '/api/card/{id}', 200, time.monotonic() - 3)
+            client._observe('GET', '/api/card/{id}', 200, time.monotonic())
+
+        mock_warning.assert_called_once()
+        assert 'Slow Metabase request' in mock_warning.call_args.args[0]
@@ -0,0 +1,97 @@
+"""
+Tests for fanout.py shared Metabase fan-out executor.
+"""
+import contextlib
+import threading
+import time
+
+import pytest
+from unittest import mock
+
+import ckanext.in_app_reporting.fanout as fanout
+import ckanext.in_app_reporting.metrics as metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_executor():
+    fanout.shutdown()
+    yield
+    fanout.shutdown()
+
+
+class TestFanOut:
+    """Test running calls on the shared executor"""
+
+    def test_fan_out_returns_every_result(self):
+        """Test that every item is yielded with its future"""
+        results = {item: future.result() for item, future in fanout.fan_out(lambda x: x * 2, range(25))}
+
+        assert results == {x: x * 2 for x in range(25)}
+
+    def test_fan_out_reuses_the_executor(self):
+        """Test that fan-outs share one executor per process"""
+        executor = fanout.get_executor()
+        list(fanout.fan_out(str, [1, 2]))
+
+        assert fanout.get_executor() is executor
+
+    def test_fan_out_caps_request_concurrency(self):
+        """Test that one fan-out never runs more calls at a time than its quota"""
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def work(item):
+            with lock:
+                running.append(item)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(item)
+            return item
+
+        results = [future.result() for item, future in fanout.fan_out(work, range(12), concurrency=3)]
+
+        assert sorted(results) == list(range(12))
+        assert max(peak) <= 3
+
+    def test_fan_out_surfaces_errors(self):
+        """Test that a failing call only fails its own future"""
+        def work(item):
+            if item == 2:
+                raise ValueError('boom')
+            return item
+
+        futures = dict(fanout.fan_out(work, [1, 2, 3]))
+
+        assert futures[1].result() == 1
+        with pytest.raises(ValueError):
+            futures[2].result()
+
+    def test_closing_cancels_remaining_calls(self):
+        """Test that closing the fan-out early leaves the other calls unstarted"""
+        calls = []
+
+        def work(item):
+            calls.append(item)
+            return item
+
+        with contextlib.closing(fanout.fan_out(work, range(100), concurrency=2)) as results:
+            next(results)
+
+        time.sleep(0.05)
+        assert len(calls) <= 3
+        assert fanout.queue_depth() == 0
+        assert fanout.active_tasks() == 0
+
+    def test_executor_size_is_configurable(self):
+        """Test the worker count comes from config"""
+        with mock.patch('ckanext.in_app_reporting.config.fanout_workers', return_value=3):
+            assert fanout.get_executor()._max_workers == 3
+
+    def test_queue_metrics_are_exported(self):
+        """Test queue depth and active tasks are rendered as gauges"""
+        output = metrics.render_prometheus()
+
+        assert '# TYPE metabase_fanout_queued_tasks gauge' in output
+        assert 'metabase_fanout_active_tasks 0' in output
@@ -0,0 +1,63 @@
+"""
+Tests for metrics.py Metabase client metrics.
+"""
+import pytest
+
+import ckanext.in_app_reporting.metrics as metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+class TestEndpointTemplate:
+    """Test grouping of URLs per endpoint"""
+
+    def test_ids_are_replaced(self):
+        """Test that numeric ids and UUIDs become placeholders and the query is dropped"""
+        assert metrics.endpoint_template('https://mb.example.com/api/card/12?f=x') == '/api/card/{id}'
+        assert metrics.endpoint_template(
+            'https://mb.example.com/api/collection/3/items?models=card') == '/api/collection/{id}/items'
+        assert metrics.endpoint_template(
+            'https://mb.example.com/api/search/0829999d-80a1-4207-a921-66796079a05e') == '/api/search/{uuid}'
+
+    def test_named_endpoints_are_kept(self):
+        """Test that named path segments are kept as is"""
+        assert metrics.endpoint_template('https://mb.example.com/api/card/embeddable') == '/api/card/embeddable'
+
+
+class TestRenderPrometheus:
+    """Test the Prometheus text format output"""
+
+    def test_request_metrics(self):
+        """Test latency buckets, status counters and bytes per endpoint"""
+        metrics.observe_request('GET', '/api/card/{id}', 200, 0.3, received=1024)
+        metrics.observe_request('GET', '/api/card/{id}', 503, 7.0)
+        metrics.observe_retry('GET', '/api/card/{id}')
+
+        output = metrics.render_prometheus()
+
+        labels = 'method="GET",endpoint="/api/card/{id}"'
+        assert 'metabase_request_duration_seconds_bucket{%s,le="0.25"} 0' % labels in output
+        assert 'metabase_request_duration_seconds_bucket{%s,le="0.5"} 1' % labels in output
+        assert 'metabase_request_duration_seconds_bucket{%s,le="10.0"} 2' % labels in output
+        assert 'metabase_request_duration_seconds_bucket{%s,le="+Inf"} 2' % labels in output
+        assert 'metabase_request_duration_seconds_count{%s} 2' % labels in output
+        assert 'metabase_requests_total{%s,status="200"} 1' % labels in output
+        assert 'metabase_requests_total{%s,status="503"} 1' % labels in output
+        assert 'metabase_response_bytes_total{%s} 1024' % labels in output
+        assert 'metabase_request_retries_total{%s} 1' % labels in output
+
+    def test_cache_metrics(self):
+        """Test cache hit and miss counters"""
+        metrics.observe_cache('metadata', hit=True)
+        metrics.observe_cache('metadata', hit=True)
+        metrics.observe_cache('metadata', hit=False)
+
+        output = metrics.render_prometheus()
+
+        assert 'metabase_cache_requests_total{cache="metadata",result="hit"} 2' in output
+        assert 'metabase_cache_requests_total{cache="metadata",result="miss"} 1' in output
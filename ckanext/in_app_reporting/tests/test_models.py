@@ -7,7 +7,7 @@ from unittest import mock
 import ckan.model as model
 from ckan.tests import factories
 
-from ckanext.in_app_reporting.model import MetabaseMapping, table_dictize
+from ckanext.in_app_reporting.model import MetabaseMapping, split_ids, table_dictize
 
 
 class TestMetabaseMappingModel:
@@ -255,6 +255,61 @@ class TestMetabaseMappingModel:
         assert retrieved_mapping.collection_ids is None
 
 
+    @pytest.mark.usefixtures('with_plugins', 'clean_db')
+    @pytest.mark.ckan_config('ckan.plugins', 'in_app_reporting')
+    def test_metabase_mapping_memberships(self):
+        """Test that memberships follow the mapping's ids and can be queried"""
+        user1 = factories.User()
+        user2 = factories.User()
+        for user, collection_ids in ((user1, 'col1;col2; col2'), (user2, 'col2')):
+            mapping = MetabaseMapping(
+                user_id=user['id'],
+                platform_uuid='12345678-1234-1234-1234-123456789012',
+                email=user['email'],
+                group_ids='group1',
+                collection_ids=collection_ids
+            )
+            model.Session.add(mapping)
+            mapping.save_memberships()
+        model.Session.commit()
+
+        assert sorted(m.user_id for m in MetabaseMapping.members_of(collection_id='col2')) == \
+            sorted([user1['id'], user2['id']])
+        assert [m.user_id for m in MetabaseMapping.members_of(collection_id='col1')] == [user1['id']]
+        assert MetabaseMapping.members_of(collection_id='col1', group_id='other').count() == 0
+
+        mapping = MetabaseMapping.get(user_id=user1['id'])
+        mapping.collection_ids = 'col3'
+        mapping.save_memberships()
+        model.Session.commit()
+
+        assert MetabaseMapping.members_of(collection_id='col1').count() == 0
+        assert [m.user_id for m in MetabaseMapping.members_of(collection_id='col3')] == [user1['id']]
+
+    @pytest.mark.usefixtures('with_plugins', 'clean_db')
+    @pytest.mark.ckan_config('ckan.plugins', 'in_app_reporting')
+    def test_metabase_mapping_lookup_shared_uuid(self):
+        """Test that a UUID shared by several mappings always resolves to the lowest user id"""
+        user_ids = sorted(factories.User()['id'] for _ in range(3))
+        for user_id in reversed(user_ids):
+            model.Session.add(MetabaseMapping(
+                user_id=user_id,
+                platform_uuid='12345678-1234-1234-1234-123456789012',
+                email='Shared@example.com',
+                group_ids='group1',
+                collection_ids='col1'
+            ))
+        model.Session.commit()
+
+        assert MetabaseMapping.lookup(platform_uuid='12345678-1234-1234-1234-123456789012').user_id == user_ids[0]
+        assert MetabaseMapping.lookup(email='shared@example.com').user_id == user_ids[0]
+
+    def test_split_ids(self):
+        """Test that blank and repeated ids are dropped"""
+        assert split_ids('1; 2;;1;') == ['1', '2']
+        assert split_ids(None) == []
+
+
 class TestTableDictize:
     """Test the table_dictize utility function"""
 
@@ -51,7 +51,8 @@ class TestInAppReportingPlugin:
             'metabase_card_publish',
             'metabase_dashboard_publish',
             'metabase_model_create',
-            'metabase_sql_questions_list'
+            'metabase_sql_questions_list',
+            'metabase_iframe_urls'
         ]
 
         for action_name in expected_actions:
@@ -261,7 +262,8 @@ class TestPluginIntegration:
             'metabase_card_publish',
             'metabase_dashboard_publish',
             'metabase_model_create',
-            'metabase_sql_questions_list'
+            'metabase_sql_questions_list',
+            'metabase_iframe_urls'
         ]
 
         for action_name in expected_actions:
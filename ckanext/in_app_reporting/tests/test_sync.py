@@ -0,0 +1,384 @@
+"""
+Tests for sync.py local Metabase catalog index.
+"""
+import pytest
+from unittest import mock
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.in_app_reporting.sync as sync
+import ckanext.in_app_reporting.utils as utils
+from ckanext.in_app_reporting.model import (
+    MetabaseCard,
+    MetabaseCardResource,
+    MetabaseDashboard,
+    MetabaseSyncState
+)
+
+
+RESOURCE_ID = '0829999d-80a1-4207-a921-66796079a05e'
+OTHER_RESOURCE_ID = '7bd0b918-0559-4fa2-a642-fee6793eb854'
+
+CARD_CATALOG = [
+    {
+        'id': 1,
+        'entity_id': 'card-1',
+        'name': 'SQL on resource',
+        'type': 'question',
+        'updated_at': '2025-08-01T18:20:49.005658Z',
+        'collection_id': 1,
+        'table_id': None,
+        'dataset_query': {
+            'native': {'query': f'SELECT * FROM "{RESOURCE_ID}" JOIN "{OTHER_RESOURCE_ID}" USING (id)'}
+        }
+    },
+    {
+        'id': 2,
+        'entity_id': 'card-2',
+        'name': 'Question on table',
+        'type': 'question',
+        'updated_at': '2025-08-02T18:20:49.005658Z',
+        'collection_id': 1,
+        'table_id': 123,
+        'dataset_query': {'query': {'source-table': 123}}
+    },
+    {
+        'id': 3,
+        'entity_id': 'card-3',
+        'name': 'SQL in other collection',
+        'type': 'question',
+        'updated_at': '2025-08-03T18:20:49.005658Z',
+        'collection_id': 9,
+        'table_id': None,
+        'dataset_query': {
+            'lib/type': 'mbql/query',
+            'stages': [{'lib/type': 'mbql.stage/native', 'native': f'SELECT * FROM "{RESOURCE_ID}"'}]
+        }
+    }
+]
+
+DASHBOARDS = [
+    {
+        'id': 10,
+        'entity_id': 'dashboard-10',
+        'name': 'Budget overview',
+        'description': 'Budget',
+        'collection_id': 1,
+        'creator_id': 7,
+        'created_at': '2025-08-01T18:20:49.005658Z',
+        'updated_at': '2025-08-04T18:20:49.005658Z'
+    },
+    {
+        'id': 11,
+        'entity_id': 'dashboard-11',
+        'name': 'Permits',
+        'collection_id': 9,
+        'creator_id': 8,
+        'creator': {'id': 8, 'email': 'other@example.com'},
+        'created_at': '2025-08-02T18:20:49.005658Z',
+        'updated_at': '2025-08-02T18:20:49.005658Z'
+    }
+]
+
+METABASE_USERS = {'data': [{'id': 7, 'email': 'jdoe@example.com'}, {'id': 8, 'email': 'other@example.com'}]}
+
+
+class TestExtractResourceIds:
+    """Test UUID extraction from native SQL"""
+
+    def test_extract_resource_ids(self):
+        """Test that every UUID shaped table reference is returned lowercased"""
+        sql = f'SELECT * FROM "{RESOURCE_ID.upper()}" JOIN "{OTHER_RESOURCE_ID}" ON 1=1'
+
+        assert sync.extract_resource_ids(sql) == {RESOURCE_ID, OTHER_RESOURCE_ID}
+
+    def test_extract_resource_ids_empty(self):
+        """Test extraction with no SQL"""
+        assert sync.extract_resource_ids('') == set()
+        assert sync.extract_resource_ids(None) == set()
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestRebuildCardIndex:
+    """Test building the card index and reading from it"""
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG)
+    def test_rebuild_card_index(self, mock_get_request):
+        """Test that cards and their resource references are stored"""
+        assert sync.rebuild_card_index() == 3
+
+        assert model.Session.query(MetabaseCard).count() == 3
+        refs = model.Session.query(MetabaseCardResource).filter_by(resource_id=RESOURCE_ID).all()
+        assert sorted(ref.card_id for ref in refs) == [1, 3]
+        assert model.Session.query(MetabaseCardResource).filter_by(card_id=2).count() == 0
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG)
+    def test_rebuild_card_index_replaces_previous_index(self, mock_get_request):
+        """Test that a rebuild drops cards that no longer exist"""
+        sync.rebuild_card_index()
+        mock_get_request.return_value = CARD_CATALOG[1:]
+        sync.rebuild_card_index()
+
+        assert model.Session.query(MetabaseCard).get(1) is None
+        assert model.Session.query(MetabaseCardResource).filter_by(card_id=1).count() == 0
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG)
+    def test_rebuild_card_index_sets_watermarks_from_metabase(self, mock_get_request):
+        """Test that each collection's watermark is its newest scanned card"""
+        with mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1', '9', '5']):
+            sync.rebuild_card_index()
+
+        assert MetabaseSyncState.get_value(sync.CARD_WATERMARK_KEY.format('1')) == \
+            utils.parse_metabase_datetime('2025-08-02T18:20:49.005658Z').isoformat()
+        assert MetabaseSyncState.get_value(sync.CARD_WATERMARK_KEY.format('9')) == \
+            utils.parse_metabase_datetime('2025-08-03T18:20:49.005658Z').isoformat()
+        assert MetabaseSyncState.get_value(sync.CARD_WATERMARK_KEY.format('5')) is None
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=None)
+    def test_rebuild_card_index_failure(self, mock_get_request):
+        """Test that a failed catalog fetch raises"""
+        with pytest.raises(RuntimeError):
+            sync.rebuild_card_index()
+
+    def test_sql_questions_use_index(self):
+        """Test get_metabase_sql_questions reads from the index once built"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG):
+            sync.rebuild_card_index()
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request') as mock_get_request, \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']), \
+             mock.patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            mock_get_action.return_value.side_effect = toolkit.ObjectNotFound()
+            result = utils.get_metabase_sql_questions(RESOURCE_ID)
+
+        mock_get_request.assert_not_called()
+        assert result == [
+            {'id': 1, 'name': 'SQL on resource', 'type': 'question', 'updated_at': '2025-08-01T18:20:49.005658Z'}
+        ]
+
+    def test_chart_list_uses_index(self):
+        """Test get_metabase_chart_list reads from the index once built"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG):
+            sync.rebuild_card_index()
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request') as mock_get_request, \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']), \
+             mock.patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            mock_get_action.return_value.side_effect = toolkit.ObjectNotFound()
+            result = utils.get_metabase_chart_list(123, RESOURCE_ID)
+
+        mock_get_request.assert_not_called()
+        assert [card['id'] for card in result] == [2, 1]
+        assert result[0]['text'] == 'Question on table'
+        assert result[0]['entity_id'] == 'card-2'
+
+    def test_chart_list_search_uses_index(self):
+        """Test get_metabase_chart_list filters and pages in the index query"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG):
+            sync.rebuild_card_index()
+
+        with mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']), \
+             mock.patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            mock_get_action.return_value.side_effect = toolkit.ObjectNotFound()
+            searched = utils.get_metabase_chart_list(123, RESOURCE_ID, q='sql')
+            paged = utils.get_metabase_chart_list(123, RESOURCE_ID, limit=1, offset=1)
+
+        assert [card['id'] for card in searched] == [1]
+        assert [card['id'] for card in paged] == [1]
+
+
+def _fake_metabase(collection_items, cards):
+    """Build a metabase_get_request replacement serving collection items and card details"""
+    def fake_get_request(url):
+        if '/items?' in url:
+            offset = int(url.split('offset=')[1])
+            return {'data': collection_items[offset:offset + sync.SYNC_PAGE_SIZE]}
+        card_id = int(url.rsplit('/', 1)[1])
+        return cards.get(card_id)
+    return fake_get_request
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestIncrementalCardSync:
+    """Test watermark based incremental card sync"""
+
+    def test_sync_collection_cards_fetches_only_changed_cards(self):
+        """Test that the sync stops at the collection watermark"""
+        MetabaseSyncState.set_value(sync.CARD_WATERMARK_KEY.format('1'), '2025-08-02T00:00:00+00:00')
+        model.Session.commit()
+        items = [
+            {'id': 3, 'last-edit-info': {'timestamp': '2025-08-03T18:20:49.005658Z'}},
+            {'id': 2, 'last-edit-info': {'timestamp': '2025-08-01T18:20:49.005658Z'}},
+        ]
+        cards = {card['id']: dict(card, creator={'email': 'jdoe@example.com'}) for card in CARD_CATALOG}
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        side_effect=_fake_metabase(items, cards)) as mock_get_request:
+            assert sync.sync_collection_cards('1') == 1
+
+        fetched = [call.args[0] for call in mock_get_request.call_args_list if '/api/card/' in call.args[0]]
+        assert len(fetched) == 1 and fetched[0].endswith('/api/card/3')
+        card = model.Session.query(MetabaseCard).get(3)
+        assert card.creator_email == 'jdoe@example.com'
+        assert model.Session.query(MetabaseCardResource).filter_by(card_id=3).count() == 1
+        assert MetabaseSyncState.get_value(sync.CARD_WATERMARK_KEY.format('1')) == '2025-08-03T18:20:49.005658+00:00'
+
+    def test_sync_collection_cards_updates_existing_card(self):
+        """Test that a changed card replaces its previous row and references"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG):
+            sync.rebuild_card_index()
+        MetabaseSyncState.set_value(sync.CARD_WATERMARK_KEY.format('1'), '2025-08-02T00:00:00+00:00')
+        model.Session.commit()
+        changed = dict(CARD_CATALOG[0], name='Renamed', updated_at='2025-09-01T00:00:00Z',
+                       dataset_query={'native': {'query': f'SELECT * FROM "{OTHER_RESOURCE_ID}"'}})
+        items = [{'id': 1, 'last-edit-info': {'timestamp': '2025-09-01T00:00:00Z'}}]
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        side_effect=_fake_metabase(items, {1: changed})):
+            sync.sync_collection_cards('1')
+
+        assert model.Session.query(MetabaseCard).get(1).name == 'Renamed'
+        refs = model.Session.query(MetabaseCardResource).filter_by(card_id=1).all()
+        assert [ref.resource_id for ref in refs] == [OTHER_RESOURCE_ID]
+
+    def test_sync_cards_builds_full_index_first(self):
+        """Test that the first sync falls back to a full rebuild"""
+        with mock.patch('ckanext.in_app_reporting.sync.rebuild_card_index', return_value=3) as mock_rebuild:
+            assert sync.sync_cards() == 3
+        mock_rebuild.assert_called_once()
+
+    def test_sync_cards_records_sync_time(self):
+        """Test that incremental and full syncs mark the catalog as fresh"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=CARD_CATALOG):
+            sync.rebuild_card_index()
+        assert MetabaseCard.is_fresh(60)
+
+        MetabaseSyncState.set_value(sync.CARD_SYNCED_AT_KEY, '2025-01-01T00:00:00')
+        model.Session.commit()
+        assert not MetabaseCard.is_fresh(60)
+
+        with mock.patch('ckanext.in_app_reporting.sync.sync_collection_cards', return_value=0), \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']):
+            sync.sync_cards()
+        assert MetabaseCard.is_fresh(60)
+
+    def test_upsert_card_keeps_creator_email(self):
+        """Test that an item without a creator does not clear the mirrored one"""
+        card = dict(CARD_CATALOG[1], creator={'email': 'jdoe@example.com'})
+        sync.upsert_card(card)
+        model.Session.commit()
+
+        sync.upsert_card(dict(CARD_CATALOG[1], name='Published'))
+        model.Session.commit()
+
+        stored = model.Session.query(MetabaseCard).get(2)
+        assert stored.name == 'Published'
+        assert stored.creator_email == 'jdoe@example.com'
+
+    def test_sync_collection_cards_failure_keeps_watermark(self):
+        """Test that a failed sync does not move the watermark"""
+        items = [{'id': 3, 'last-edit-info': {'timestamp': '2025-08-03T18:20:49.005658Z'}}]
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        side_effect=_fake_metabase(items, {})):
+            with pytest.raises(RuntimeError):
+                sync.sync_collection_cards('1')
+
+        assert MetabaseSyncState.get_value(sync.CARD_WATERMARK_KEY.format('1')) is None
+
+
+def _fake_dashboards(dashboards, users=METABASE_USERS, collection_items=()):
+    """Build a metabase_get_request replacement serving dashboards and users"""
+    by_id = {dashboard['id']: dashboard for dashboard in dashboards}
+
+    def fake_get_request(url):
+        if url.endswith('/api/user'):
+            return users
+        if url.endswith('/api/dashboard?f=all'):
+            return dashboards
+        if '/items?' in url:
+            offset = int(url.split('offset=')[1])
+            return {'data': list(collection_items)[offset:offset + sync.SYNC_PAGE_SIZE]}
+        return by_id.get(int(url.rsplit('/', 1)[1]))
+    return fake_get_request
+
+
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestCreatorIndex:
+    """Test the dashboard mirror and the creator lookups"""
+
+    def test_rebuild_dashboard_index(self):
+        """Test that dashboards are stored with their creator email"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        side_effect=_fake_dashboards(DASHBOARDS)):
+            assert sync.rebuild_dashboard_index() == 2
+
+        assert model.Session.query(MetabaseDashboard).get(10).creator_email == 'jdoe@example.com'
+        assert model.Session.query(MetabaseDashboard).get(11).creator_email == 'other@example.com'
+
+    def test_sync_collection_dashboards(self):
+        """Test that the dashboard sync stops at the collection watermark"""
+        MetabaseSyncState.set_value(sync.DASHBOARD_WATERMARK_KEY.format('1'), '2025-08-03T00:00:00+00:00')
+        model.Session.commit()
+        items = [
+            {'id': 10, 'last-edit-info': {'timestamp': '2025-08-04T18:20:49.005658Z'}},
+            {'id': 11, 'last-edit-info': {'timestamp': '2025-08-02T18:20:49.005658Z'}},
+        ]
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        side_effect=_fake_dashboards(DASHBOARDS, collection_items=items)):
+            assert sync.sync_collection_dashboards('1', {7: 'jdoe@example.com'}) == 1
+
+        assert model.Session.query(MetabaseDashboard).get(10).creator_email == 'jdoe@example.com'
+        assert model.Session.query(MetabaseDashboard).get(11) is None
+
+    def test_user_created_cards_use_index(self):
+        """Test get_metabase_user_created_cards reads from the index once built"""
+        cards = [dict(card, creator={'email': 'jdoe@example.com'}) for card in CARD_CATALOG[:2]] + CARD_CATALOG[2:]
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=cards):
+            sync.rebuild_card_index()
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request') as mock_get_request, \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']):
+            result = utils.get_metabase_user_created_cards('jdoe@example.com')
+
+        mock_get_request.assert_not_called()
+        assert [card['id'] for card in result] == [2, 1]
+        assert result[0]['name'] == 'Question on table'
+
+    def test_user_created_cards_fall_back_when_index_is_stale(self):
+        """Test get_metabase_user_created_cards queries Metabase once the index is older than catalog_max_age"""
+        cards = [dict(card, creator={'email': 'jdoe@example.com'}) for card in CARD_CATALOG]
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', return_value=cards):
+            sync.rebuild_card_index()
+        MetabaseSyncState.set_value(sync.CARD_SYNCED_AT_KEY, '2025-01-01T00:00:00')
+        model.Session.commit()
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        return_value={'data': []}) as mock_get_request, \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']):
+            result = utils.get_metabase_user_created_cards('jdoe@example.com')
+
+        assert result == []
+        assert '/api/collection/1/items' in mock_get_request.call_args[0][0]
+
+    def test_user_created_dashboards_use_index(self):
+        """Test get_metabase_user_created_dashboards reads from the index once built"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        side_effect=_fake_dashboards(DASHBOARDS)):
+            sync.rebuild_dashboard_index()
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request') as mock_get_request, \
+             mock.patch('ckanext.in_app_reporting.utils.metabase_get_cached') as mock_get_cached, \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']):
+            result = utils.get_metabase_user_created_dashboards('jdoe@example.com')
+            other = utils.get_metabase_user_created_dashboards('other@example.com')
+
+        mock_get_request.assert_not_called()
+        mock_get_cached.assert_not_called()
+        assert [dashboard['id'] for dashboard in result] == [10]
+        assert result[0]['description'] == 'Budget'
+        assert other == []
@@ -0,0 +1,66 @@
+"""
+Tests for table_index.py.
+"""
+from unittest import mock
+
+from ckanext.in_app_reporting.table_index import TableIndex
+
+
+class TestTableIndex:
+    """Test the Metabase table name index"""
+
+    def test_lookup_loads_once(self):
+        """Test that lookups are served from memory after the first load"""
+        loader = mock.Mock(return_value={'table1': 1, 'table2': 2})
+        index = TableIndex(loader, ttl=600, miss_refresh_interval=30)
+
+        assert index.lookup('table1') == 1
+        assert index.lookup('table2') == 2
+        loader.assert_called_once()
+
+    def test_lookup_miss_refreshes(self):
+        """Test that a miss reloads the index once the interval has passed"""
+        loader = mock.Mock(side_effect=[{'table1': 1}, {'table1': 1, 'new_table': 5}])
+        index = TableIndex(loader, ttl=600, miss_refresh_interval=30)
+
+        with mock.patch('time.monotonic', return_value=100):
+            assert index.lookup('table1') == 1
+        with mock.patch('time.monotonic', return_value=200):
+            assert index.lookup('new_table') == 5
+        assert loader.call_count == 2
+        # Misses bypass the shared metadata cache
+        assert loader.call_args_list[0].kwargs == {'fresh': False}
+        assert loader.call_args_list[1].kwargs == {'fresh': True}
+
+    def test_lookup_miss_is_rate_limited(self):
+        """Test that repeated misses do not reload the index every time"""
+        loader = mock.Mock(return_value={'table1': 1})
+        index = TableIndex(loader, ttl=600, miss_refresh_interval=30)
+
+        with mock.patch('time.monotonic', return_value=100):
+            assert index.lookup('missing') is None
+            assert index.lookup('missing') is None
+        loader.assert_called_once()
+
+    def test_stale_index_refreshes_in_background(self):
+        """Test that a stale index is served while a refresh is scheduled"""
+        loader = mock.Mock(return_value={'table1': 1})
+        index = TableIndex(loader, ttl=600, miss_refresh_interval=30)
+
+        with mock.patch('time.monotonic', return_value=100):
+            index.lookup('table1')
+        with mock.patch('time.monotonic', return_value=1000), \
+             mock.patch.object(index, 'refresh_in_background') as mock_refresh:
+            assert index.lookup('table1') == 1
+        mock_refresh.assert_called_once()
+
+    def test_failed_refresh_keeps_previous_index(self):
+        """Test that a failed reload does not drop known tables"""
+        loader = mock.Mock(side_effect=[{'table1': 1}, Exception('boom')])
+        index = TableIndex(loader, ttl=600, miss_refresh_interval=30)
+
+        with mock.patch('time.monotonic', return_value=100):
+            index.lookup('table1')
+        with mock.patch('time.monotonic', return_value=200):
+            index.refresh()
+            assert index.lookup('table1') == 1
@@ -2,12 +2,16 @@
 Tests for utils.py utility functions.
 """
 import pytest
+import io
 import json
+import threading
+import time
 from unittest import mock
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 from ckan.tests import factories
 
+import ckanext.in_app_reporting.client as client
 import ckanext.in_app_reporting.utils as utils
 
 
@@ -115,6 +119,66 @@ class TestUserValidation:
 
         assert result is False
 
+    def test_user_is_admin_or_editor_is_cached(self):
+        """Test that repeated role checks do not repeat the organization query"""
+        user = factories.User()
+        factories.Organization(users=[{'name': user['name'], 'capacity': 'editor'}])
+
+        with mock.patch('ckanext.in_app_reporting.utils._user_is_admin_or_editor', return_value=True) as mock_check:
+            assert utils.user_is_admin_or_editor(user['name']) is True
+            assert utils.user_is_admin_or_editor(user['id']) is True
+
+        mock_check.assert_called_once()
+
+    def test_user_roles_invalidated_on_membership_change(self):
+        """Test that removing a membership drops the cached decision"""
+        user = factories.User()
+        org = factories.Organization(users=[{'name': user['name'], 'capacity': 'editor'}])
+        assert utils.user_is_admin_or_editor(user['name']) is True
+
+        toolkit.get_action('organization_member_delete')(
+            {'ignore_auth': True},
+            {'id': org['id'], 'username': user['name']}
+        )
+
+        assert utils.user_is_admin_or_editor(user['name']) is False
+
+    def test_user_roles_invalidated_on_sysadmin_change(self):
+        """Test that updating a user drops the cached decision"""
+        user = factories.User()
+        assert utils.user_is_admin_or_editor(user['name']) is False
+
+        userobj = model.User.get(user['id'])
+        userobj.sysadmin = True
+        model.Session.commit()
+        toolkit.get_action('user_update')({'ignore_auth': True}, {'id': user['id'], 'email': user['email']})
+
+        assert utils.user_is_admin_or_editor(user['name']) is True
+
+    def test_user_roles_invalidated_on_organization_change(self):
+        """Test that deleting an organization drops the decisions of its members"""
+        user = factories.User()
+        org = factories.Organization(users=[{'name': user['name'], 'capacity': 'editor'}])
+        assert utils.user_is_admin_or_editor(user['name']) is True
+
+        toolkit.get_action('organization_delete')({'ignore_auth': True}, {'id': org['id']})
+
+        assert utils.user_is_admin_or_editor(user['name']) is False
+
+    def test_is_metabase_sso_user_is_cached(self):
+        """Test that the SSO decision is cached per user name"""
+        user = mock.Mock()
+        user.name = 'cached@example.com'
+        user.is_active.return_value = True
+        user.password = None
+
+        with mock.patch('ckanext.in_app_reporting.utils.user_is_admin_or_editor', return_value=True) as mock_role, \
+             mock.patch('ckan.model.User.by_name', return_value=user):
+            assert utils.is_metabase_sso_user(user) is True
+            assert utils.is_metabase_sso_user(user) is True
+
+        mock_role.assert_called_once_with('cached@example.com')
+
 
 class TestExtractNativeSql:
     """Test _extract_native_sql_from_dataset_query helper function"""
@@ -200,7 +264,7 @@ class TestExtractNativeSql:
 class TestMetabaseApiRequests:
     """Test Metabase API request functions"""
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_metabase_get_request_success(self, mock_get):
         """Test successful Metabase GET request"""
         mock_response = mock.Mock()
@@ -214,10 +278,86 @@ class TestMetabaseApiRequests:
         assert result == {'data': 'test'}
         mock_get.assert_called_once_with(
             'https://example.com/api/test',
+            timeout=mock.ANY,
             headers={'x-api-key': 'test-key'}
         )
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
+    def test_metabase_stream_request_yields_items(self, mock_get):
+        """Test that array items are parsed from the response stream"""
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.raw = io.BytesIO(json.dumps([{'id': 1}, {'id': 2}]).encode('utf-8'))
+
+        items = utils.metabase_stream_request('https://example.com/api/card')
+
+        assert list(items) == [{'id': 1}, {'id': 2}]
+        assert mock_get.call_args.kwargs['stream'] is True
+        mock_get.return_value.close.assert_called_once()
+
+    @mock.patch('requests.Session.get')
+    def test_metabase_stream_request_failure(self, mock_get):
+        """Test that a failed request returns None"""
+        mock_get.return_value.status_code = 500
+
+        assert utils.metabase_stream_request('https://example.com/api/card') is None
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_card_catalog_keeps_projected_fields(self, mock_stream_request):
+        """Test that the catalog only keeps the fields the scans need"""
+        mock_stream_request.return_value = iter([{
+            'id': 1,
+            'entity_id': 'card-1',
+            'name': 'SQL card',
+            'type': 'question',
+            'updated_at': '2025-08-01T18:20:49.005658Z',
+            'collection_id': 1,
+            'table_id': None,
+            'dataset_query': {'native': {'query': 'SELECT 1'}},
+            'result_metadata': [{'name': 'column'}]
+        }])
+
+        result = utils.get_metabase_card_catalog()
+
+        assert result == [{
+            'id': 1,
+            'entity_id': 'card-1',
+            'name': 'SQL card',
+            'type': 'question',
+            'updated_at': '2025-08-01T18:20:49.005658Z',
+            'collection_id': 1,
+            'table_id': None,
+            'native_sql': 'SELECT 1'
+        }]
+
+    def test_metabase_get_request_coalesces_concurrent_calls(self):
+        """Test that concurrent GETs of the same URL share one fetch"""
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_get(url):
+            started.set()
+            release.wait(5)
+            return {'tables': []}
+
+        results = []
+        with mock.patch('ckanext.in_app_reporting.utils._metabase_get_request', side_effect=slow_get) as mock_get:
+            threads = [threading.Thread(target=lambda: results.append(
+                utils.metabase_get_request('https://example.com/api/database/1?include=tables'))) for _ in range(4)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            # Give the other threads time to join the in-flight fetch
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        assert mock_get.call_count == 1
+        assert results == [{'tables': []}] * 4
+        assert results[0] is results[1]
+
+    @mock.patch('requests.Session.get')
     def test_metabase_get_request_failure(self, mock_get):
         """Test failed Metabase GET request"""
         mock_response = mock.Mock()
@@ -229,7 +369,7 @@ class TestMetabaseApiRequests:
 
         assert result is None
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_metabase_get_request_exception(self, mock_get):
         """Test Metabase GET request with exception"""
         mock_get.side_effect = Exception('Network error')
@@ -239,7 +379,7 @@ class TestMetabaseApiRequests:
 
         assert result is None
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_metabase_post_request_success(self, mock_post):
         """Test successful Metabase POST request"""
         mock_response = mock.Mock()
@@ -254,11 +394,12 @@ class TestMetabaseApiRequests:
         assert result == {'id': 123}
         mock_post.assert_called_once_with(
             'https://example.com/api/test',
+            timeout=mock.ANY,
             headers={'x-api-key': 'test-key', 'Content-Type': 'application/json'},
             data=json.dumps(data)
         )
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_metabase_post_request_exception(self, mock_post):
         """Test Metabase POST request with exception"""
         mock_post.side_effect = Exception('Network error')
@@ -309,6 +450,22 @@ class TestUtilityHelpers:
         assert first is None
         assert last is None
 
+    def test_filter_items_by_name(self):
+        """Test filter_items_by_name matches names case-insensitively"""
+        items = [{'name': 'Sales by month'}, {'name': 'Budget'}, {'name': 'SALES by region'}]
+
+        result = utils.filter_items_by_name(items, q='sales')
+
+        assert [item['name'] for item in result] == ['Sales by month', 'SALES by region']
+
+    def test_filter_items_by_name_pages(self):
+        """Test filter_items_by_name applies offset and limit after filtering"""
+        items = [{'name': f'Chart {i}'} for i in range(10)]
+
+        result = utils.filter_items_by_name(items, limit=3, offset=4)
+
+        assert [item['name'] for item in result] == ['Chart 4', 'Chart 5', 'Chart 6']
+
 
 class TestMetabaseIframeUrl:
     """Test Metabase iframe URL generation"""
@@ -334,6 +491,83 @@ class TestMetabaseIframeUrl:
             'exp': 1234567890 + (60 * 10)
         }, 'embedding-secret-key', algorithm='HS256')
 
+    @mock.patch('jwt.encode', return_value='test-jwt-token')
+    def test_get_metabase_iframe_url_reuses_token(self, mock_jwt_encode):
+        """Test that a minted token is reused for the same item"""
+        with mock.patch('ckanext.in_app_reporting.utils.METABASE_MANAGE_SERVICE_URL', None):
+            utils.get_metabase_iframe_url('card', '123', True, True, True)
+            utils.get_metabase_iframe_url('card', '123', False, False, False)
+            utils.get_metabase_iframe_url('dashboard', '123', True, True, True)
+
+        assert mock_jwt_encode.call_count == 2
+
+    @mock.patch('jwt.encode', return_value='test-jwt-token')
+    def test_get_metabase_iframe_url_remints_before_expiry(self, mock_jwt_encode):
+        """Test that a token is not reused within the safety margin before exp"""
+        with mock.patch('ckanext.in_app_reporting.utils.METABASE_MANAGE_SERVICE_URL', None), \
+             mock.patch('ckanext.in_app_reporting.config.embed_token_expiry_margin', return_value=600):
+            utils.get_metabase_iframe_url('card', '123', True, True, True)
+            utils.get_metabase_iframe_url('card', '123', True, True, True)
+
+        assert mock_jwt_encode.call_count == 2
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_manage_service_request')
+    def test_get_metabase_iframe_url_caches_manage_service_token(self, mock_manage_service):
+        """Test that manage service tokens are cached until their exp claim"""
+        import time
+        import jwt
+        mock_manage_service.return_value = jwt.encode(
+            {'resource': {'card': '123'}, 'exp': round(time.time()) + 600}, 'secret', algorithm='HS256')
+
+        with mock.patch('ckanext.in_app_reporting.utils.METABASE_MANAGE_SERVICE_URL', 'https://service.com'), \
+             mock.patch('ckanext.in_app_reporting.utils.METABASE_SERVICE_KEY', 'service-key'):
+            first = utils.get_metabase_iframe_url('card', '123', True, True, True)
+            second = utils.get_metabase_iframe_url('card', '123', True, True, True)
+
+        assert first == second
+        mock_manage_service.assert_called_once()
+
+    @mock.patch('jwt.encode', side_effect=lambda payload, *args, **kwargs: 'token-' + list(payload['resource'].values())[0])
+    def test_get_metabase_iframe_urls_signs_batch(self, mock_jwt_encode):
+        """Test that a batch returns one URL per entity and signs each item once"""
+        items = [
+            {'model_type': 'question', 'entity_id': 'card-1', 'bordered': True, 'titled': False},
+            {'model_type': 'dashboard', 'entity_id': 'dash-1', 'downloads': True},
+            {'model_type': 'question', 'entity_id': 'card-1', 'bordered': True, 'titled': False},
+        ]
+
+        with mock.patch('ckanext.in_app_reporting.utils.METABASE_SITE_URL', 'https://example.com'), \
+             mock.patch('ckanext.in_app_reporting.utils.METABASE_MANAGE_SERVICE_URL', None):
+            result = utils.get_metabase_iframe_urls(items)
+
+        assert result == {
+            'card-1': 'https://example.com/embed/question/token-card-1#bordered=true&titled=false&downloads=false',
+            'dash-1': 'https://example.com/embed/dashboard/token-dash-1#bordered=true&titled=true&downloads=true',
+        }
+        assert mock_jwt_encode.call_count == 2
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_manage_service_request')
+    def test_get_metabase_iframe_urls_with_manage_service(self, mock_manage_service):
+        """Test that missing tokens are minted through the manage service and failures are left out"""
+        def mint(params, payload):
+            if 'broken' in payload['resources'].values():
+                raise toolkit.ValidationError({'error': 'Failed to retrieve Metabase token'})
+            return 'token-' + list(payload['resources'].values())[0]
+        mock_manage_service.side_effect = mint
+        items = [
+            {'model_type': 'question', 'entity_id': 'card-1'},
+            {'model_type': 'dashboard', 'entity_id': 'dash-1'},
+            {'model_type': 'dashboard', 'entity_id': 'broken'},
+        ]
+
+        with mock.patch('ckanext.in_app_reporting.utils.METABASE_MANAGE_SERVICE_URL', 'https://service.com'), \
+             mock.patch('ckanext.in_app_reporting.utils.METABASE_SERVICE_KEY', 'service-key'):
+            result = utils.get_metabase_iframe_urls(items)
+
+        assert sorted(result) == ['card-1', 'dash-1']
+        assert '/embed/dashboard/token-dash-1#' in result['dash-1']
+        assert mock_manage_service.call_count == 3
+
 
 class TestMetabaseUserToken:
     """Test Metabase user token generation"""
@@ -428,6 +662,25 @@ class TestMetabaseHelpers:
 
         assert result == []
 
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
+    def test_mark_metabase_embeddable(self, mock_get_request):
+        """Test that a published item joins the cached ids without a refetch"""
+        mock_get_request.return_value = [{'id': 1, 'name': 'Card 1'}]
+
+        assert utils.get_metabase_embeddable_ids('card') == {1}
+        utils.mark_metabase_embeddable('card', '7')
+
+        assert utils.get_metabase_embeddable_ids('card') == {1, 7}
+        mock_get_request.assert_called_once()
+
+    def test_with_embeddable_flag(self):
+        """Test list items are flagged with their embeddable state"""
+        with mock.patch('ckanext.in_app_reporting.utils.get_metabase_embeddable_ids',
+                        return_value=frozenset([2])):
+            result = utils.with_embeddable_flag([{'id': 1}, {'id': 2}], 'card')
+
+        assert result == [{'id': 1, 'embeddable': False}, {'id': 2, 'embeddable': True}]
+
     def test_get_metabase_collection_id_with_collections(self):
         """Test get_metabase_collection_id with collections configured"""
         with mock.patch('ckanext.in_app_reporting.config.collection_ids', return_value=['1', '2', '3']):
@@ -469,6 +722,36 @@ class TestMetabaseHelpers:
 
         assert result is None
 
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
+    def test_get_metabase_table_id_uses_index(self, mock_get_request):
+        """Test get_metabase_table_id only fetches the database metadata once"""
+        mock_get_request.return_value = {
+            'tables': [
+                {'id': 1, 'name': 'table1'},
+                {'id': 2, 'name': 'table2'}
+            ]
+        }
+
+        assert utils.get_metabase_table_id('table1') == 1
+        assert utils.get_metabase_table_id('table2') == 2
+        mock_get_request.assert_called_once()
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
+    def test_get_metabase_table_id_caches_projection(self, mock_get_request):
+        """Test that only the table name -> id projection is kept in the metadata cache"""
+        mock_get_request.return_value = {
+            'id': 4,
+            'tables': [
+                {'id': 1, 'name': 'table1', 'fields': [{'id': 10}]},
+                {'id': 2, 'name': 'table2', 'fields': [{'id': 20}]}
+            ]
+        }
+
+        utils.get_metabase_table_id('table1')
+
+        assert utils._metadata_cache.backend.get('table_ids')['value'] == {'table1': 1, 'table2': 2}
+        assert utils._metadata_cache.backend.get('tables') is None
+
     @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
     def test_get_metabase_model_id_success(self, mock_get_request):
         """Test get_metabase_model_id with successful response"""
@@ -513,10 +796,10 @@ class TestMetabaseHelpers:
             {'id': 2, 'name': 'A', 'type': 'question', 'updated_at': '2025-08-02T18:20:49.005658Z'}
         ]
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_sql_questions_filters(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_sql_questions_filters(self, mock_stream_request):
         """Test get_metabase_sql_questions with filters"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'name': 'Resource 1',
@@ -561,15 +844,15 @@ class TestMetabaseHelpers:
              mock.patch('ckanext.in_app_reporting.utils.METABASE_SITE_URL', 'https://example.com'):
             result = utils.get_metabase_sql_questions('0829999d-80a1-4207-a921-66796079a05e')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert result == [
             {'id': 1, 'name': 'Resource 1', 'type': 'question', 'updated_at': '2025-08-01T18:20:49.005658Z'}
         ]
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_sql_questions_new_mbql_format(self, mock_get_request, app):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_sql_questions_new_mbql_format(self, mock_stream_request, app):
         """Test get_metabase_sql_questions with new MBQL format (stages with native SQL)"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'name': 'MBQL Card 1',
@@ -624,15 +907,15 @@ class TestMetabaseHelpers:
                 
                 result = utils.get_metabase_sql_questions('bee42093-2c03-49f3-b185-200e745ec892')
         
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 1
         assert result[0]['id'] == 1
         assert result[0]['name'] == 'MBQL Card 1'
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_sql_questions_both_formats(self, mock_get_request, app):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_sql_questions_both_formats(self, mock_stream_request, app):
         """Test get_metabase_sql_questions handles both old and new formats"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'name': 'Old Format Card',
@@ -682,7 +965,7 @@ class TestMetabaseHelpers:
                 
                 result = utils.get_metabase_sql_questions('test-resource-id')
         
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 2
         assert result[0]['id'] == 2  # Sorted by type, then name
         assert result[1]['id'] == 1
@@ -800,6 +1083,7 @@ class TestMetabaseMappingUtils:
         result = utils.metabase_mapping_delete(data_dict)
 
         assert f'Mapping for user_id {user["id"]} deleted successfully.' in result['message']
+        assert utils.MetabaseMapping.members_of(collection_id='1').count() == 0
 
     def test_metabase_mapping_delete_not_found(self):
         """Test metabase mapping deletion when mapping doesn't exist"""
@@ -813,15 +1097,151 @@ class TestMetabaseMappingUtils:
         assert f'No mapping found for user_id {user["id"]}' in str(exc_info.value)
 
 
+@pytest.mark.usefixtures("with_plugins", "clean_db")
+@pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
+class TestMetabaseMappingCache:
+    """Test the cache of parsed Metabase mappings"""
+
+    def test_get_metabase_mapping_is_cached(self, metabase_mapping_factory):
+        """Test that the mapping is looked up once per user"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'])
+
+        with mock.patch('ckanext.in_app_reporting.utils._load_mapping',
+                        wraps=utils._load_mapping) as load_mapping:
+            first = utils.get_metabase_mapping(user_id=user['id'])
+            second = utils.get_metabase_mapping(user_id=user['id'])
+
+        assert first == second
+        assert first['group_ids'] == ['group1', 'group2']
+        assert first['collection_ids'] == ['1', '2']
+        load_mapping.assert_called_once()
+
+    def test_memory_backend_caps_ttl(self):
+        """Test that the in-process mapping cache expires other workers' entries quickly"""
+        assert utils.MAPPING_CACHE_TTL <= utils.MEMORY_MAPPING_CACHE_TTL
+        assert utils._mapping_cache.ttl == utils.MAPPING_CACHE_TTL
+
+    def test_get_metabase_mapping_by_email(self, metabase_mapping_factory):
+        """Test that a mapping can be looked up by email"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'], email='mapped@example.com')
+
+        mapping = utils.get_metabase_mapping(email='mapped@example.com')
+
+        assert mapping['user_id'] == user['id']
+
+    def test_get_metabase_mapping_by_email_ignores_case(self, metabase_mapping_factory):
+        """Test that email lookups of any case share one cache entry"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'], email='Mapped@Example.com')
+
+        with mock.patch('ckanext.in_app_reporting.utils._load_mapping',
+                        wraps=utils._load_mapping) as load_mapping:
+            first = utils.get_metabase_mapping(email='mapped@example.com')
+            second = utils.get_metabase_mapping(email='MAPPED@example.com')
+
+        assert first == second
+        assert first['user_id'] == user['id']
+        load_mapping.assert_called_once()
+
+    def test_get_metabase_mapping_by_platform_uuid(self, metabase_mapping_factory):
+        """Test that a mapping can be looked up by platform UUID"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'], platform_uuid='87654321-4321-4321-4321-210987654321')
+
+        mapping = utils.get_metabase_mapping(platform_uuid='87654321-4321-4321-4321-210987654321')
+
+        assert mapping['user_id'] == user['id']
+
+    def test_get_metabase_mapping_missing(self):
+        """Test that users without a mapping get None, and it is cached"""
+        user = factories.User()
+
+        with mock.patch('ckanext.in_app_reporting.utils._load_mapping',
+                        wraps=utils._load_mapping) as load_mapping:
+            assert utils.get_metabase_mapping(user_id=user['id']) is None
+            assert utils.get_metabase_mapping(user_id=user['id']) is None
+
+        load_mapping.assert_called_once()
+        assert utils.get_metabase_mapping() is None
+
+    def test_create_writes_through(self):
+        """Test that a created mapping replaces a cached missing mapping"""
+        user = factories.User()
+        assert utils.get_metabase_mapping(user_id=user['id']) is None
+
+        utils.metabase_mapping_create({
+            'user_id': user['id'],
+            'platform_uuid': '12345678-1234-1234-1234-123456789012',
+            'group_ids': ['group1'],
+            'collection_ids': ['3']
+        })
+
+        with mock.patch('ckanext.in_app_reporting.utils._load_mapping') as load_mapping:
+            by_id = utils.get_metabase_mapping(user_id=user['id'])
+            by_email = utils.get_metabase_mapping(email=user['email'])
+
+        load_mapping.assert_not_called()
+        assert by_id == by_email
+        assert by_id['collection_ids'] == ['3']
+
+    def test_update_writes_through(self, metabase_mapping_factory):
+        """Test that an update replaces the cached mapping"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'])
+        utils.get_metabase_mapping(user_id=user['id'])
+
+        utils.metabase_mapping_update({
+            'user_id': user['id'],
+            'group_ids': ['group1'],
+            'collection_ids': ['5', '6']
+        })
+
+        with mock.patch('ckanext.in_app_reporting.utils._load_mapping') as load_mapping:
+            mapping = utils.get_metabase_mapping(user_id=user['id'])
+
+        load_mapping.assert_not_called()
+        assert mapping['collection_ids'] == ['5', '6']
+
+    def test_update_drops_previous_platform_uuid(self, metabase_mapping_factory):
+        """Test that the mapping is no longer found by its previous platform UUID"""
+        user = factories.User()
+        mapping = metabase_mapping_factory(user_id=user['id'])
+        previous_uuid = mapping.platform_uuid
+        assert utils.get_metabase_mapping(platform_uuid=previous_uuid) is not None
+
+        utils.metabase_mapping_update({
+            'user_id': user['id'],
+            'platform_uuid': '87654321-4321-4321-4321-210987654321',
+            'group_ids': ['group1'],
+            'collection_ids': ['1']
+        })
+
+        assert utils.get_metabase_mapping(platform_uuid=previous_uuid) is None
+        assert utils.get_metabase_mapping(
+            platform_uuid='87654321-4321-4321-4321-210987654321')['user_id'] == user['id']
+
+    def test_delete_writes_through(self, metabase_mapping_factory):
+        """Test that a deleted mapping is no longer served from the cache"""
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'])
+        assert utils.get_metabase_mapping(user_id=user['id']) is not None
+
+        utils.metabase_mapping_delete({'user_id': user['id']})
+
+        assert utils.get_metabase_mapping(user_id=user['id']) is None
+
+
 @pytest.mark.usefixtures("with_plugins", "clean_db")
 @pytest.mark.ckan_config("ckan.plugins", "in_app_reporting")
 class TestGetMetabaseChartList:
     """Test get_metabase_chart_list function"""
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_with_table_id_match(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_with_table_id_match(self, mock_stream_request):
         """Test get_metabase_chart_list with cards matching table_id"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'entity_id': 'card-1',
@@ -875,17 +1295,17 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 2
         assert result[0]['id'] == 3  # Sorted by updated_at desc, then name
         assert result[0]['name'] == 'Chart C'
         assert result[1]['id'] == 1
         assert result[1]['name'] == 'Chart A'
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_with_resource_id_match(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_with_resource_id_match(self, mock_stream_request):
         """Test get_metabase_chart_list with cards matching resource_id in SQL query"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'entity_id': 'card-1',
@@ -939,17 +1359,17 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 2
         assert result[0]['id'] == 3  # Sorted by updated_at desc, then name
         assert result[0]['name'] == 'SQL Chart C'
         assert result[1]['id'] == 1
         assert result[1]['name'] == 'SQL Chart A'
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_with_new_mbql_format(self, mock_get_request, app):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_with_new_mbql_format(self, mock_stream_request, app):
         """Test get_metabase_chart_list with new MBQL format (stages with native SQL)"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'entity_id': 'card-1',
@@ -1006,16 +1426,16 @@ class TestGetMetabaseChartList:
                 
                 result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 1
         assert result[0]['id'] == 1
         assert result[0]['name'] == 'MBQL Chart A'
         assert result[0]['text'] == 'MBQL Chart A'
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_no_api_response(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_no_api_response(self, mock_stream_request):
         """Test get_metabase_chart_list when API returns no response"""
-        mock_get_request.return_value = None
+        mock_stream_request.return_value = None
 
         with mock.patch('ckanext.in_app_reporting.utils.METABASE_SITE_URL', 'https://example.com'), \
              mock.patch('ckanext.in_app_reporting.utils.METABASE_DB_ID', '4'), \
@@ -1026,13 +1446,13 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert result == []
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_empty_response(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_empty_response(self, mock_stream_request):
         """Test get_metabase_chart_list when API returns empty list"""
-        mock_get_request.return_value = []
+        mock_stream_request.return_value = []
 
         with mock.patch('ckanext.in_app_reporting.utils.METABASE_SITE_URL', 'https://example.com'), \
              mock.patch('ckanext.in_app_reporting.utils.METABASE_DB_ID', '4'), \
@@ -1043,13 +1463,13 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert result == []
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_filters_by_collection_and_type(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_filters_by_collection_and_type(self, mock_stream_request):
         """Test get_metabase_chart_list filters by collection_id and type='question'"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'entity_id': 'card-1',
@@ -1103,16 +1523,16 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 1
         assert result[0]['id'] == 1
         assert result[0]['name'] == 'Question Chart'
         assert result[0]['type'] == 'question'
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_sorts_by_updated_at_and_name(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_sorts_by_updated_at_and_name(self, mock_stream_request):
         """Test get_metabase_chart_list sorts by updated_at desc, then name"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'entity_id': 'card-1',
@@ -1166,17 +1586,17 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 3
         # Should be sorted by updated_at desc, then name asc
         assert result[0]['id'] == 2  # Most recent, name 'A Chart'
         assert result[1]['id'] == 3  # Same time, name 'B Chart'
         assert result[2]['id'] == 1  # Older time, name 'Z Chart'
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_mixed_table_and_sql_matches(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_mixed_table_and_sql_matches(self, mock_stream_request):
         """Test get_metabase_chart_list with both table_id and resource_id matches"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'entity_id': 'card-1',
@@ -1230,7 +1650,7 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 2
         # Should be sorted by updated_at desc, then name asc
         assert result[0]['id'] == 2  # SQL Match Chart
@@ -1238,10 +1658,10 @@ class TestGetMetabaseChartList:
         assert result[1]['id'] == 1  # Table Match Chart
         assert result[1]['name'] == 'Table Match Chart'
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_chart_list_includes_text_field(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_chart_list_includes_text_field(self, mock_stream_request):
         """Test get_metabase_chart_list includes 'text' field in returned cards"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'entity_id': 'card-1',
@@ -1267,7 +1687,7 @@ class TestGetMetabaseChartList:
 
             result = utils.get_metabase_chart_list(123, 'resource-123')
 
-        mock_get_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
+        mock_stream_request.assert_called_once_with('https://example.com/api/card?f=database&model_id=4')
         assert len(result) == 1
         assert result[0]['text'] == 'Test Chart'  # Should include text field
         assert result[0]['name'] == 'Test Chart'
@@ -1316,7 +1736,7 @@ class TestParseMetabaseDatetime:
 class TestMetabaseManageServiceRequest:
     """Test metabase_manage_service_request function"""
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_metabase_manage_service_request_success(self, mock_post):
         """Test successful manage service request"""
         mock_response = mock.Mock()
@@ -1334,7 +1754,7 @@ class TestMetabaseManageServiceRequest:
         assert result == 'test-token-123'
         mock_post.assert_called_once()
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_metabase_manage_service_request_no_token(self, mock_post):
         """Test manage service request when no token in response"""
         mock_response = mock.Mock()
@@ -1349,7 +1769,7 @@ class TestMetabaseManageServiceRequest:
             
             assert 'Failed to retrieve Metabase token' in str(exc_info.value)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_metabase_manage_service_request_json_decode_error(self, mock_post):
         """Test manage service request with JSON decode error"""
         mock_response = mock.Mock()
@@ -1426,7 +1846,7 @@ class TestGetMetabaseCollectionItems:
         assert result == []
 
     @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_collection_items_with_mapping(self, mock_get_request):
+    def test_get_metabase_collection_items_with_mapping(self, mock_get_request, app, metabase_mapping_factory):
         """Test get_metabase_collection_items uses user mapping"""
         mock_get_request.return_value = {
             'data': [
@@ -1437,21 +1857,81 @@ class TestGetMetabaseCollectionItems:
                 }
             ]
         }
-        
-        def fake_get_action(name):
-            if name == 'metabase_mapping_show':
-                def mapping_show(context, data_dict):
-                    return {'collection_ids': ['3', '4']}
-                return mapping_show
-            return toolkit.get_action(name)
-        
-        with mock.patch('ckanext.in_app_reporting.config.metabase_site_url', return_value='https://example.com'), \
-             mock.patch('ckan.plugins.toolkit.get_action', fake_get_action):
-            
-            result = utils.get_metabase_collection_items('card')
-        
+        user = factories.User()
+        metabase_mapping_factory(user_id=user['id'], collection_ids='3;4')
+
+        with app.flask_app.app_context():
+            with mock.patch('ckanext.in_app_reporting.utils.METABASE_SITE_URL', 'https://example.com'), \
+                 mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1', '2']):
+                import ckan.plugins.toolkit as tk
+                tk.g.user = user['name']
+                tk.g.userobj = model.User.get(user['id'])
+
+                utils.get_metabase_collection_items('card')
+
         # Should use collection_ids from mapping (3, 4) not default
-        assert mock_get_request.call_count >= 1
+        assert sorted(call.args[0] for call in mock_get_request.call_args_list) == [
+            'https://example.com/api/collection/3/items?models=card',
+            'https://example.com/api/collection/4/items?models=card',
+        ]
+
+    def test_get_metabase_collection_items_invalidated(self):
+        """Test that listings use their own TTL and are dropped by invalidate_collection_items"""
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request',
+                        return_value={'data': []}) as mock_get_request, \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1']), \
+             mock.patch('ckanext.in_app_reporting.config.collection_items_cache_ttl', return_value=30), \
+             mock.patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            mock_get_action.return_value.side_effect = toolkit.ObjectNotFound()
+
+            utils.get_metabase_collection_items('card')
+            entry = utils._metadata_cache.backend.get('collection_items:1:card')
+            utils.get_metabase_collection_items('card')
+            utils.invalidate_collection_items('1')
+            utils.get_metabase_collection_items('card')
+
+        assert entry['expiry'] <= time.time() + 30
+        assert mock_get_request.call_count == 2
+
+    def test_get_metabase_collection_items_merges_collections(self):
+        """Test items of several collections are merged by last edit and paged"""
+        def fake_get_request(url):
+            timestamps = {
+                '1': ['2025-08-05', '2025-08-01'],
+                '2': ['2025-08-02', '2025-08-04', '2025-08-03'],
+            }[url.split('/api/collection/')[1].split('/')[0]]
+            return {'data': [
+                {'id': timestamp, 'name': f'Item {timestamp}', 'last-edit-info': {'timestamp': timestamp}}
+                for timestamp in timestamps
+            ]}
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', side_effect=fake_get_request), \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1', '2']), \
+             mock.patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            mock_get_action.return_value.side_effect = toolkit.ObjectNotFound()
+
+            result = utils.get_metabase_collection_items('card')
+            page = utils.get_metabase_collection_items('card', limit=2, offset=1)
+
+        assert [item['id'] for item in result] == [
+            '2025-08-05', '2025-08-04', '2025-08-03', '2025-08-02', '2025-08-01']
+        assert [item['id'] for item in page] == ['2025-08-04', '2025-08-03']
+
+    def test_get_metabase_collection_items_skips_failed_collection(self):
+        """Test a collection that fails to load does not hide the others"""
+        def fake_get_request(url):
+            if '/api/collection/1/' in url:
+                raise RuntimeError('boom')
+            return {'data': [{'id': 5, 'name': 'Item 5', 'last-edit-info': {'timestamp': '2025-08-01'}}]}
+
+        with mock.patch('ckanext.in_app_reporting.utils.metabase_get_request', side_effect=fake_get_request), \
+             mock.patch('ckanext.in_app_reporting.utils.collection_ids', ['1', '2']), \
+             mock.patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            mock_get_action.return_value.side_effect = toolkit.ObjectNotFound()
+
+            result = utils.get_metabase_collection_items('card')
+
+        assert [item['id'] for item in result] == [5]
 
 
 @pytest.mark.usefixtures("with_plugins", "clean_db")
@@ -1732,6 +2212,24 @@ class TestGetMetabaseIframeUrlWithManageService:
         assert result == expected_url
         mock_manage_service.assert_called_once()
 
+    def test_token_service_circuit_makes_metabase_unavailable(self):
+        """Test that an open circuit of the token service falls back to the unavailable notice"""
+        with mock.patch('ckanext.in_app_reporting.utils.METABASE_SITE_URL', 'https://example.com'), \
+             mock.patch('ckanext.in_app_reporting.utils.METABASE_MANAGE_SERVICE_URL', 'https://service.com'), \
+             mock.patch('ckanext.in_app_reporting.utils.METABASE_SERVICE_KEY', 'service-key'), \
+             mock.patch('ckanext.in_app_reporting.client.is_available',
+                        side_effect=lambda url: url != 'https://service.com'):
+            assert utils.is_metabase_available() is False
+
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_manage_service_request')
+    def test_get_metabase_iframe_url_circuit_open(self, mock_manage_service):
+        """Test that an open circuit while minting returns no URL instead of failing"""
+        mock_manage_service.side_effect = client.CircuitOpenError('open')
+
+        with mock.patch('ckanext.in_app_reporting.utils.METABASE_MANAGE_SERVICE_URL', 'https://service.com'), \
+             mock.patch('ckanext.in_app_reporting.utils.METABASE_SERVICE_KEY', 'service-key'):
+            assert utils.get_metabase_iframe_url('card', '123', True, True, True) is None
+
 
 class TestGetMetabaseUserTokenWithManageService:
     """Test get_metabase_user_token with manage service"""
@@ -2046,10 +2544,10 @@ class TestGetMetabaseCardsByTableIdEdgeCases:
 class TestGetMetabaseSqlQuestionsEdgeCases:
     """Test edge cases for get_metabase_sql_questions"""
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_sql_questions_no_native_query(self, mock_get_request):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_sql_questions_no_native_query(self, mock_stream_request):
         """Test get_metabase_sql_questions when card has no native query"""
-        mock_get_request.return_value = [
+        mock_stream_request.return_value = [
             {
                 'id': 1,
                 'name': 'Card 1',
@@ -2072,10 +2570,10 @@ class TestGetMetabaseSqlQuestionsEdgeCases:
         
         assert result == []
 
-    @mock.patch('ckanext.in_app_reporting.utils.metabase_get_request')
-    def test_get_metabase_sql_questions_exception_handling(self, mock_get_request, app):
+    @mock.patch('ckanext.in_app_reporting.utils.metabase_stream_request')
+    def test_get_metabase_sql_questions_exception_handling(self, mock_stream_request, app):
         """Test get_metabase_sql_questions handles exceptions"""
-        mock_get_request.return_value = []
+        mock_stream_request.return_value = []
         
         user = factories.User()
         
@@ -1,17 +1,32 @@
-import concurrent.futures
+import contextlib
 import datetime
+import heapq
+import itertools
 import json
 import jwt
+import logging
 import re
-import requests
 import time
 import uuid
 from typing import Optional
 import ckan.model as model
 import ckan.plugins.toolkit as tk
+import ckanext.in_app_reporting.async_client as async_client
+import ckanext.in_app_reporting.cache as cache
+import ckanext.in_app_reporting.client as client
 import ckanext.in_app_reporting.config as mb_config
-from ckanext.in_app_reporting.model import MetabaseMapping
+import ckanext.in_app_reporting.fanout as fanout
+import ckanext.in_app_reporting.metrics as metrics
+from ckanext.in_app_reporting.table_index import TableIndex
+from ckanext.in_app_reporting.model import MetabaseCard, MetabaseDashboard, MetabaseMapping
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+log = logging.getLogger(__name__)
 
 METABASE_SITE_URL = mb_config.metabase_site_url()
 METABASE_EMBEDDING_SECRET_KEY = mb_config.metabase_embedding_secret_key()
@@ -25,21 +40,80 @@ METABASE_MANAGE_SERVICE_URL = mb_config.metabase_manage_service_url()
 METABASE_SERVICE_KEY = mb_config.metabase_manage_service_key()
 METABASE_CLIENT_ID = mb_config.metabase_client_id()
 
+# Per-user SSO/editor decisions, shared by templates, can_view and auth. Kept
+# in the metadata cache backend, so that with Redis an invalidation reaches
+# every worker.
+ROLE_CACHE_TTL = mb_config.role_cache_ttl()
+_role_cache = cache.get_backend(
+    mb_config.metadata_cache_backend(),
+    mb_config.role_cache_size(),
+    ROLE_CACHE_TTL,
+    'ckanext.in_app_reporting:{0}:roles:'.format(tk.config.get('ckan.site_id', ''))
+)
+
+# Static embedding tokens keyed by (model_type, entity_id, embedding_type)
+EMBED_TOKEN_LIFETIME = 60 * 10  # 10 minute expiration
+_embed_token_cache = cache.TTLCache(mb_config.embed_token_cache_size(), EMBED_TOKEN_LIFETIME)
+_embed_token_flight = cache.SingleFlight()
+
+# Identical concurrent Metabase GETs, keyed by URL
+_get_flight = cache.SingleFlight()
+
+# Metabase metadata shared by the workers when a shared backend is configured
+_metadata_cache = cache.MetadataCache(
+    cache.get_backend(
+        mb_config.metadata_cache_backend(),
+        mb_config.metadata_cache_size(),
+        mb_config.metadata_cache_ttl(),
+        'ckanext.in_app_reporting:{0}:metadata:'.format(tk.config.get('ckan.site_id', ''))
+    ),
+    mb_config.metadata_cache_ttl()
+)
+
+# Metadata cache key of a collection's item listing, by collection and model
+# type. Listings have a shorter TTL of their own, as items saved in Metabase
+# itself cannot be invalidated
+COLLECTION_ITEMS_KEY = 'collection_items:{0}:{1}'
+
+# Parsed metabase_mapping records keyed by user id, email or platform UUID, written
+# through by metabase_mapping_create/update/delete. An empty dict records
+# that a user has no mapping. The in-process backend only sees the write-through
+# of its own worker, so its TTL is capped to bound how long other workers keep
+# a changed or deleted mapping.
+MEMORY_MAPPING_CACHE_TTL = 30
+MAPPING_CACHE_TTL = mb_config.mapping_cache_ttl()
+if mb_config.metadata_cache_backend() != 'redis':
+    MAPPING_CACHE_TTL = min(MAPPING_CACHE_TTL, MEMORY_MAPPING_CACHE_TTL)
+_mapping_cache = cache.MetadataCache(
+    cache.get_backend(
+        mb_config.metadata_cache_backend(),
+        mb_config.mapping_cache_size(),
+        MAPPING_CACHE_TTL,
+        'ckanext.in_app_reporting:{0}:mapping:'.format(tk.config.get('ckan.site_id', ''))
+    ),
+    MAPPING_CACHE_TTL,
+    name='mapping'
+)
+
 
 def is_metabase_sso_user(userobj):
     if not userobj:
         return False
 
     user_name = userobj.name
-    if not user_is_admin_or_editor(user_name):
-        return False
+    cached = _role_cache.get('sso:{0}'.format(user_name))
+    if cached is not None:
+        return cached
 
-    if re.match("[^@]+@[^@]+\.[^@]+", user_name, re.IGNORECASE):
-        user = model.User.by_name(user_name)
-        if user:
-            if user.is_active() and not user.password:
-                return True
-    return False
+    is_sso_user = False
+    if user_is_admin_or_editor(user_name):
+        if re.match("[^@]+@[^@]+\.[^@]+", user_name, re.IGNORECASE):
+            user = model.User.by_name(user_name)
+            if user:
+                if user.is_active() and not user.password:
+                    is_sso_user = True
+    _role_cache.set('sso:{0}'.format(user_name), is_sso_user, ROLE_CACHE_TTL)
+    return is_sso_user
 
 
 def user_is_admin_or_editor(user):
@@ -48,6 +122,15 @@ def user_is_admin_or_editor(user):
     if not userobj:
         return False
 
+    cached = _role_cache.get('editor:{0}'.format(userobj.name))
+    if cached is not None:
+        return cached
+    is_admin_or_editor = _user_is_admin_or_editor(userobj)
+    _role_cache.set('editor:{0}'.format(userobj.name), is_admin_or_editor, ROLE_CACHE_TTL)
+    return is_admin_or_editor
+
+
+def _user_is_admin_or_editor(userobj):
     # If user is sysadmin, return True
     if userobj.sysadmin:
         return True
@@ -68,6 +151,19 @@ def user_is_admin_or_editor(user):
     return False
 
 
+def invalidate_user_roles(user=None):
+    '''
+    Drop cached SSO/editor decisions for a user (name or id), or for
+    every user when no user can be resolved.
+    '''
+    userobj = model.User.get(user) if user else None
+    if not userobj:
+        _role_cache.clear()
+        return
+    _role_cache.delete('sso:{0}'.format(userobj.name))
+    _role_cache.delete('editor:{0}'.format(userobj.name))
+
+
 def parse_metabase_datetime(datetime_str):
     """
     Parse Metabase ISO datetime string to Python datetime object.
@@ -89,23 +185,139 @@ def parse_metabase_datetime(datetime_str):
         return None
 
 
-def metabase_get_request(url):
+def is_metabase_available():
+    '''
+    Whether Metabase calls are let through, i.e. neither the circuit of
+    Metabase nor, in manage service mode, that of the token service is open.
+    '''
+    if METABASE_MANAGE_SERVICE_URL and METABASE_SERVICE_KEY:
+        if not client.is_available(METABASE_MANAGE_SERVICE_URL):
+            return False
+    return client.is_available(METABASE_SITE_URL)
+
+
+def _metabase_get_request(url):
     headers = {'x-api-key': METABASE_API_KEY}
     try:
-        response = requests.get(url, headers=headers)
+        response = client.get(url, headers=headers)
         if response.status_code == 200:
             return response.json()
     except Exception:
         return None
 
 
+def metabase_get_request(url):
+    '''
+    GET a Metabase API URL and return the parsed JSON, or None on failure.
+
+    Concurrent requests for the same URL in this process share a single
+    in-flight fetch and its parsed result, which callers must not mutate.
+    '''
+    return _get_flight.do(url, _metabase_get_request, url)
+
+
+def metabase_get_many(urls):
+    '''
+    GET many Metabase API URLs concurrently.
+
+    With the async client enabled (httpx installed and async_client_enabled
+    set) the requests overlap on one event loop, without a thread each;
+    otherwise they run on the shared fan-out executor.
+
+    Yields:
+        (url, parsed JSON or None on failure) tuples, as they complete.
+        Closing the generator cancels the requests not started yet.
+    '''
+    urls = list(urls)
+    if async_client.can_run():
+        results = async_client.run(
+            async_client.get_json_many(urls, headers={'x-api-key': METABASE_API_KEY}))
+        yield from zip(urls, results)
+        return
+    with contextlib.closing(fanout.fan_out(metabase_get_request, urls)) as results:
+        for url, future in results:
+            try:
+                yield url, future.result()
+            except Exception:
+                yield url, None
+
+
+def _iter_json_items(response):
+    try:
+        if ijson is None:
+            for item in response.json():
+                yield item
+            return
+        response.raw.decode_content = True
+        for item in ijson.items(response.raw, 'item', use_float=True):
+            yield item
+    finally:
+        response.close()
+
+
+def metabase_stream_request(url):
+    '''
+    GET a Metabase API URL returning a JSON array and iterate over its items.
+
+    With ijson installed the items are parsed one at a time from the
+    response stream, so the whole array never sits in memory at once;
+    otherwise the response is parsed in one go.
+
+    Returns:
+        Iterator over the array items, or None if the request failed
+    '''
+    headers = {'x-api-key': METABASE_API_KEY}
+    try:
+        response = client.get(url, headers=headers, stream=True)
+    except Exception:
+        return None
+    if response.status_code != 200:
+        response.close()
+        return None
+    return _iter_json_items(response)
+
+
+def metabase_get_cached(key, url, fresh=False, ttl=None):
+    '''
+    GET a Metabase API URL through the metadata cache.
+
+    Args:
+        key: Cache key of the metadata, e.g. 'embeddable:card'
+        url: Metabase API URL
+        fresh (optional): Bypass the cached value and refresh it
+        ttl (optional): Seconds to cache it for, by default metadata_cache_ttl
+
+    Returns:
+        The parsed JSON response, or None on failure
+    '''
+    return _metadata_cache.get_or_compute(key, lambda: metabase_get_request(url), ttl=ttl, fresh=fresh)
+
+
+def invalidate_metadata(*keys):
+    '''Drop cached Metabase metadata after a change made through CKAN.'''
+    for key in keys:
+        _metadata_cache.delete(key)
+
+
+def invalidate_collection_items(*ids):
+    '''
+    Drop the cached item listings of collections, by default of the
+    configured collections, after a card, model or dashboard changed.
+    '''
+    for collection_id in ids or collection_ids:
+        invalidate_metadata(*(
+            COLLECTION_ITEMS_KEY.format(collection_id, model_type)
+            for model_type in ('card', 'dashboard')
+        ))
+
+
 def metabase_post_request(url, data_dict):
     headers = {
         'x-api-key': METABASE_API_KEY,
         'Content-Type': 'application/json'
     }
     try:
-        response = requests.post(
+        response = client.post(
             url,
             headers=headers,
             data=json.dumps(data_dict)
@@ -120,8 +332,9 @@ def metabase_manage_service_request(params, payload):
         'Authorization': 'Token {}'.format(METABASE_SERVICE_KEY),
         'Content-Type': 'application/json'
     }
-    response = requests.post(
+    response = client.post(
         f"{METABASE_MANAGE_SERVICE_URL}/api/v1/token",
+        call_class=client.TOKEN,
         params=params,
         headers=headers,
         json=payload
@@ -142,7 +355,15 @@ def split_fullname(fullname):
     return None, None
 
 
-def get_metabase_iframe_url(model_type, entity_id, bordered, titled, downloads):
+def _embed_token_expiry(token):
+    '''Read the exp claim of a token minted elsewhere, without verifying it.'''
+    try:
+        return jwt.decode(token, options={'verify_signature': False}).get('exp')
+    except jwt.PyJWTError:
+        return None
+
+
+def _mint_static_embed_token(model_type, entity_id):
     if METABASE_MANAGE_SERVICE_URL and METABASE_SERVICE_KEY:
         params = {
             'domain': METABASE_CLIENT_ID,
@@ -152,14 +373,94 @@ def get_metabase_iframe_url(model_type, entity_id, bordered, titled, downloads):
             "resources": {model_type: entity_id},
         }
         token = metabase_manage_service_request(params, payload)
+        return token, _embed_token_expiry(token)
+    exp = round(time.time()) + EMBED_TOKEN_LIFETIME
+    payload = {
+        "resource": {model_type: entity_id},
+        "params": {},
+        "exp": exp
+    }
+    token = jwt.encode(payload, METABASE_EMBEDDING_SECRET_KEY, algorithm="HS256")
+    return token, exp
+
+
+def _mint_and_cache_static_embed_token(key):
+    # A concurrent flight may have filled the cache since the caller missed
+    token = _embed_token_cache.get(key)
+    if token is not None:
+        return token
+    model_type, entity_id, _embedding_type = key
+    token, exp = _mint_static_embed_token(model_type, entity_id)
+    if exp is not None:
+        ttl = exp - time.time() - mb_config.embed_token_expiry_margin()
+        _embed_token_cache.set(key, token, ttl=ttl)
+    return token
+
+
+def get_static_embed_token(model_type, entity_id):
+    '''
+    Return a static embedding token for a card or dashboard.
+
+    Tokens are reused until shortly before they expire, and concurrent
+    renders of the same item share a single mint.
+    '''
+    key = (model_type, str(entity_id), 'static')
+    token = _embed_token_cache.get(key)
+    metrics.observe_cache('embed_token', hit=token is not None)
+    if token is not None:
+        return token
+    return _embed_token_flight.do(key, _mint_and_cache_static_embed_token, key)
+
+
+def get_static_embed_tokens(items):
+    '''
+    Return static embedding tokens for many cards and dashboards.
+
+    Cached tokens are reused. In manage service mode the missing tokens
+    are minted concurrently, one request per item, as the service returns
+    a single token per call; otherwise they are signed locally in one pass.
+    Items whose token could not be minted are left out.
+
+    Args:
+        items: Iterable of (model_type, entity_id) tuples
+
+    Returns:
+        Dictionary mapping (model_type, entity_id) to token
+    '''
+    tokens = {}
+    missing = []
+    for model_type, entity_id in dict.fromkeys(items):
+        key = (model_type, str(entity_id), 'static')
+        token = _embed_token_cache.get(key)
+        metrics.observe_cache('embed_token', hit=token is not None)
+        if token is not None:
+            tokens[(model_type, entity_id)] = token
+        else:
+            missing.append(((model_type, entity_id), key))
+    if not missing:
+        return tokens
+
+    if METABASE_MANAGE_SERVICE_URL and METABASE_SERVICE_KEY and len(missing) > 1:
+        def mint(missing_item):
+            item, key = missing_item
+            return _embed_token_flight.do(key, _mint_and_cache_static_embed_token, key)
+
+        for (item, key), future in fanout.fan_out(mint, missing):
+            try:
+                tokens[item] = future.result()
+            except Exception:
+                log.exception('Failed to mint an embedding token for %s %s', *item)
     else:
-        payload = {
-            "resource": {model_type: entity_id},
-            "params": {},
-            "exp": round(time.time()) + (60 * 10) # 10 minute expiration
-        }
-        token = jwt.encode(payload, METABASE_EMBEDDING_SECRET_KEY, algorithm="HS256")
-    iframeUrl = "{}/embed/{}/{}#bordered={}&titled={}&downloads={}".format(
+        for item, key in missing:
+            try:
+                tokens[item] = _embed_token_flight.do(key, _mint_and_cache_static_embed_token, key)
+            except Exception:
+                log.exception('Failed to mint an embedding token for %s %s', *item)
+    return tokens
+
+
+def _format_iframe_url(model_type, token, bordered, titled, downloads):
+    return "{}/embed/{}/{}#bordered={}&titled={}&downloads={}".format(
         METABASE_SITE_URL,
         model_type,
         token,
@@ -167,13 +468,191 @@ def get_metabase_iframe_url(model_type, entity_id, bordered, titled, downloads):
         str(titled).lower(),
         str(downloads).lower(),
     )
+
+
+def get_metabase_iframe_url(model_type, entity_id, bordered, titled, downloads):
+    '''
+    Build the iframe URL of a card or dashboard, or return None when the
+    circuit of the token host opened since the availability check, so that
+    views fall back to the unavailable notice.
+    '''
+    try:
+        token = get_static_embed_token(model_type, entity_id)
+    except client.CircuitOpenError:
+        log.warning('Cannot embed Metabase %s %s, its token host is unavailable', model_type, entity_id)
+        return None
+    iframeUrl = _format_iframe_url(model_type, token, bordered, titled, downloads)
     return iframeUrl
 
 
-def get_metabase_user_token(userobj):
+def get_metabase_iframe_urls(items):
+    '''
+    Build iframe URLs for many cards and dashboards, minting their missing
+    tokens with get_static_embed_tokens.
+
+    Args:
+        items: List of dictionaries with model_type and entity_id, and
+            optional bordered, titled and downloads flags
+
+    Returns:
+        Dictionary mapping entity_id to iframe URL
+    '''
+    tokens = get_static_embed_tokens(
+        (item['model_type'], item['entity_id']) for item in items)
+    iframe_urls = {}
+    for item in items:
+        token = tokens.get((item['model_type'], item['entity_id']))
+        if token is None:
+            continue
+        iframe_urls[item['entity_id']] = _format_iframe_url(
+            item['model_type'],
+            token,
+            item.get('bordered', True),
+            item.get('titled', True),
+            item.get('downloads', False)
+        )
+    return iframe_urls
+
+
+# Fields of a parsed mapping, as returned by metabase_mapping_show
+MAPPING_FIELDS = ('user_id', 'platform_uuid', 'email', 'group_ids', 'collection_ids')
+
+
+def metabase_mapping_dict(mapping, fields=MAPPING_FIELDS):
+    '''
+    Parse a MetabaseMapping row, or a query row of some of its columns, into
+    the metabase_mapping_show dict, with only the given fields.
+    '''
+    mapping_dict = {}
+    for field in fields:
+        value = getattr(mapping, field)
+        if field in ('group_ids', 'collection_ids'):
+            value = [i.strip() for i in value.split(';')]
+        mapping_dict[field] = value
+    return mapping_dict
+
+
+def _non_negative_int(data_dict, name):
+    value = data_dict.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise tk.ValidationError({name: 'Must be a whole number'})
+    if value < 0:
+        raise tk.ValidationError({name: 'Must not be negative'})
+    return value
+
+
+def metabase_mapping_list_query(data_dict, default_limit=None, max_limit=None):
+    '''
+    Build the query of the mappings selected by the metabase_mapping_list
+    arguments, ordered by user id, and the fields to return.
+
+    Arguments (all optional):
+        collection_id, group_id: only the users mapped to them
+        after_user_id: continue after this user id (keyset pagination)
+        limit, offset: page size and offset
+        fields: list or comma-separated names of the fields to return;
+            user_id is always returned, as the keyset of the next page
+
+    Args:
+        data_dict: The arguments above
+        default_limit (optional): Page size when no limit is given
+        max_limit (optional): Largest page size, larger limits are lowered to it
+
+    Returns:
+        A tuple of the query of mapping rows and the field names
+    '''
+    fields = data_dict.get('fields') or MAPPING_FIELDS
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in MAPPING_FIELDS]
+    if unknown:
+        raise tk.ValidationError({'fields': 'Unknown fields: {0}'.format(', '.join(unknown))})
+    fields = [field for field in MAPPING_FIELDS if field == 'user_id' or field in fields]
+    limit = _non_negative_int(data_dict, 'limit')
+    offset = _non_negative_int(data_dict, 'offset')
+    if limit is None:
+        limit = default_limit
+    if max_limit is not None:
+        limit = max_limit if limit is None else min(limit, max_limit)
+
+    query = MetabaseMapping.members_of(
+        collection_id=data_dict.get('collection_id'),
+        group_id=data_dict.get('group_id')
+    ).with_entities(*[getattr(MetabaseMapping, field) for field in fields]) \
+        .order_by(MetabaseMapping.user_id)
+    if data_dict.get('after_user_id'):
+        query = query.filter(MetabaseMapping.user_id > data_dict['after_user_id'])
+    if offset:
+        query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    return query, fields
+
+
+def _mapping_cache_key(user_id=None, email=None, platform_uuid=None):
+    if user_id:
+        return 'user:{0}'.format(user_id)
+    if email:
+        # Emails are looked up case-insensitively
+        return 'email:{0}'.format(email.lower())
+    return 'platform:{0}'.format(platform_uuid)
+
+
+def _load_mapping(user_id=None, email=None, platform_uuid=None):
+    if user_id:
+        data_dict = {'user_id': user_id}
+    elif email:
+        data_dict = {'email': email}
+    else:
+        data_dict = {'platform_uuid': platform_uuid}
     try:
-        metabase_mapping = tk.get_action('metabase_mapping_show')({'ignore_auth': True}, {'user_id': userobj.id})
+        return tk.get_action('metabase_mapping_show')({'ignore_auth': True}, data_dict)
     except tk.ObjectNotFound:
+        return {}
+
+
+def get_metabase_mapping(user_id=None, email=None, platform_uuid=None):
+    '''
+    Return the parsed Metabase mapping of a user by id, email or OpenGov
+    platform UUID, as returned by metabase_mapping_show, or None when the
+    user has no mapping.
+    '''
+    if not user_id and not email and not platform_uuid:
+        return None
+    mapping = _mapping_cache.get_or_compute(
+        _mapping_cache_key(user_id, email, platform_uuid),
+        lambda: _load_mapping(user_id, email, platform_uuid))
+    return mapping or None
+
+
+def _forget_mapping(user_id, email, platform_uuid):
+    _mapping_cache.delete(_mapping_cache_key(user_id=user_id))
+    _mapping_cache.delete(_mapping_cache_key(email=email))
+    _mapping_cache.delete(_mapping_cache_key(platform_uuid=platform_uuid))
+
+
+def _write_mapping_through(mapping, previous=None):
+    '''
+    Write a created or updated mapping through to the cache. ``previous`` is
+    its (user_id, email, platform_uuid) before an update, whose keys are
+    dropped first.
+    '''
+    record = metabase_mapping_dict(mapping)
+    if previous:
+        _forget_mapping(*previous)
+    _mapping_cache.set(_mapping_cache_key(user_id=mapping.user_id), record)
+    _mapping_cache.set(_mapping_cache_key(email=mapping.email), record)
+    # Several mappings may share a platform UUID, so that key is read through
+    _mapping_cache.delete(_mapping_cache_key(platform_uuid=mapping.platform_uuid))
+
+
+def get_metabase_user_token(userobj):
+    metabase_mapping = get_metabase_mapping(user_id=userobj.id)
+    if not metabase_mapping:
         # If no mapping exists, use default values
         metabase_mapping = {
             'platform_uuid': None,
@@ -208,17 +687,46 @@ def get_metabase_user_token(userobj):
     return token
 
 
+def _load_embeddable_ids(model_type):
+    all_embeddables = metabase_get_request(f'{METABASE_SITE_URL}/api/{model_type}/embeddable')
+    if all_embeddables is None:
+        return None
+    return [item.get('id') for item in all_embeddables]
+
+
 def get_metabase_embeddable(model_type):
-    embeddable_items = []
     if model_type not in ['dashboard', 'card']:
-        return embeddable_items
-    # Get all embeddable of specific model type
-    all_embeddables = metabase_get_request(
-        f'{METABASE_SITE_URL}/api/{model_type}/embeddable')
-    if not all_embeddables:
-        return embeddable_items
-    embeddable_items = [item.get('id') for item in all_embeddables]
-    return embeddable_items
+        return []
+    # Only the ids of the embeddable items of a model type are cached
+    embeddable_items = _metadata_cache.get_or_compute(
+        f'embeddable:{model_type}', lambda: _load_embeddable_ids(model_type))
+    return embeddable_items or []
+
+
+def get_metabase_embeddable_ids(model_type):
+    '''Return the ids of the embeddable items of a model type as a set.'''
+    return frozenset(get_metabase_embeddable(model_type))
+
+
+def mark_metabase_embeddable(model_type, item_id):
+    '''
+    Add a freshly published card or dashboard to the cached embeddable ids
+    of its model type, in place of refetching the whole list.
+    '''
+    try:
+        item_id = int(item_id)
+    except (TypeError, ValueError):
+        pass
+    _metadata_cache.update(
+        f'embeddable:{model_type}',
+        lambda ids: ids if item_id in ids else ids + [item_id]
+    )
+
+
+def with_embeddable_flag(items, model_type):
+    '''Copy list items with an ``embeddable`` flag, for the form pickers.'''
+    embeddable_ids = get_metabase_embeddable_ids(model_type)
+    return [dict(item, embeddable=item.get('id') in embeddable_ids) for item in items]
 
 
 def get_metabase_collection_id():
@@ -229,17 +737,32 @@ def get_metabase_collection_id():
         return ''
 
 
-def get_metabase_table_id(table_name):
-    table_id = None
-    result = metabase_get_request(
-        f'{METABASE_SITE_URL}/api/database/{METABASE_DB_ID}?include=tables')
+def _fetch_metabase_tables():
+    result = metabase_get_request(f'{METABASE_SITE_URL}/api/database/{METABASE_DB_ID}?include=tables')
     if not result:
-        return table_id
+        return None
+    tables = {}
     for table in result.get('tables', []):
-        if table.get('name') == table_name:
-            table_id = table.get('id')
-            break
-    return table_id
+        if table.get('name'):
+            tables.setdefault(table.get('name'), table.get('id'))
+    return tables
+
+
+def _load_metabase_tables(fresh=False):
+    # Cache the name -> id projection, not the database payload with the
+    # metadata of every table
+    return _metadata_cache.get_or_compute('table_ids', _fetch_metabase_tables, fresh=fresh)
+
+
+_table_index = TableIndex(
+    _load_metabase_tables,
+    mb_config.table_index_ttl(),
+    mb_config.table_index_miss_refresh_interval()
+)
+
+
+def get_metabase_table_id(table_name):
+    return _table_index.lookup(table_name)
 
 
 def get_metabase_model_id(table_id):
@@ -254,15 +777,39 @@ def get_metabase_model_id(table_id):
     return model_id
 
 
+def _card_index_is_current():
+    '''
+    Whether the listing helpers can read the local card catalog: it has been
+    built and synced within catalog_max_age. Otherwise they query Metabase.
+    '''
+    return MetabaseCard.is_populated() and MetabaseCard.is_fresh(mb_config.catalog_max_age())
+
+
+def _dashboard_index_is_current():
+    '''Whether the listing helpers can read the local dashboard catalog.'''
+    return MetabaseDashboard.is_populated() and MetabaseDashboard.is_fresh(mb_config.catalog_max_age())
+
+
 def get_metabase_cards_by_table_id(table_id):
     metabase_mapping = {
         'collection_ids': collection_ids
     }
     try:
         userobj = tk.g.userobj
-        metabase_mapping = tk.get_action('metabase_mapping_show')({'ignore_auth': True}, {'user_id': userobj.id})
+        metabase_mapping = get_metabase_mapping(user_id=userobj.id) or metabase_mapping
     except Exception:
         pass
+    if _card_index_is_current():
+        return [
+            {
+                'id': card.id,
+                'name': card.name,
+                'type': card.type,
+                'updated_at': card.updated_at
+            }
+            for card in MetabaseCard.cards_for_table(table_id, metabase_mapping['collection_ids'])
+        ]
+
     matching_cards = []
     card_results = metabase_get_request(f'{METABASE_SITE_URL}/api/card?f=table&model_id={table_id}')
     if not card_results:
@@ -326,10 +873,53 @@ def _extract_native_sql_from_dataset_query(dataset_query: dict) -> str:
     return ''
 
 
+def _card_catalog_entry(card):
+    '''Keep only the card fields the catalog scans need.'''
+    entry = {
+        'id': card.get('id'),
+        'entity_id': card.get('entity_id'),
+        'name': card.get('name'),
+        'type': card.get('type'),
+        'updated_at': card.get('updated_at'),
+        'collection_id': card.get('collection_id'),
+        'table_id': card.get('table_id'),
+        'native_sql': ''
+    }
+    if not card.get('table_id'):
+        entry['native_sql'] = _extract_native_sql_from_dataset_query(card.get('dataset_query', {}))
+    return entry
+
+
+def _load_card_catalog():
+    cards = metabase_stream_request(
+        f'{METABASE_SITE_URL}/api/card?f=database&model_id={METABASE_DB_ID}')
+    if cards is None:
+        return None
+    try:
+        return [_card_catalog_entry(card) for card in cards]
+    except Exception:
+        log.exception('Failed to read the Metabase card catalog')
+        return None
+
+
+def get_metabase_card_catalog():
+    '''
+    Return a projection of every card of the Metabase database: id,
+    entity_id, name, type, updated_at, collection_id, table_id and, for
+    cards not built on a table, their native SQL.
+
+    The catalog is streamed from Metabase and cached as projected.
+    '''
+    return _metadata_cache.get_or_compute('cards:database', _load_card_catalog)
+
+
 def get_metabase_sql_questions(resource_id):
     """
     Get Metabase SQL questions that reference a specific resource ID.
 
+    Uses the local card index when it has been built (see
+    ``ckan metabase index-cards``), otherwise scans the card catalog.
+
     Args:
         resource_id: The CKAN resource ID to search for in Metabase SQL queries
 
@@ -341,18 +931,27 @@ def get_metabase_sql_questions(resource_id):
     }
     try:
         userobj = tk.g.userobj
-        metabase_mapping = tk.get_action('metabase_mapping_show')({'ignore_auth': True}, {'user_id': userobj.id})
+        metabase_mapping = get_metabase_mapping(user_id=userobj.id) or metabase_mapping
     except Exception:
         pass
+    if _card_index_is_current():
+        return [
+            {
+                'id': card.id,
+                'name': card.name,
+                'type': card.type,
+                'updated_at': card.updated_at
+            }
+            for card in MetabaseCard.sql_cards_for_resource(resource_id, metabase_mapping['collection_ids'])
+        ]
+
     matching_cards = []
-    card_results = metabase_get_request(f'{METABASE_SITE_URL}/api/card?f=database&model_id={METABASE_DB_ID}')
+    card_results = get_metabase_card_catalog()
     if not card_results:
         return matching_cards
     for card in card_results:
         if str(card.get('collection_id')) in metabase_mapping['collection_ids'] and not card.get('table_id'):
-            dataset_query = card.get('dataset_query', {})
-            native_sql = _extract_native_sql_from_dataset_query(dataset_query)
-            if resource_id in native_sql:
+            if resource_id in card['native_sql']:
                 matching_cards.append({
                     'id': card.get('id'),
                     'name': card.get('name'),
@@ -363,12 +962,38 @@ def get_metabase_sql_questions(resource_id):
     return matching_cards
 
 
-def get_metabase_collection_items(model_type):
+def filter_items_by_name(items, q=None, limit=None, offset=0):
+    """
+    Filter items on a case-insensitive name match and return one page.
+
+    Args:
+        items: Iterable of item dictionaries with a 'name' key
+        q (optional): Text that the item name must contain
+        limit (optional): Maximum number of items to return
+        offset (optional): Number of matching items to skip
+
+    Returns:
+        List of matching items
+    """
+    if q:
+        q = q.lower()
+        items = (item for item in items if q in (item.get('name') or '').lower())
+    stop = offset + limit if limit is not None else None
+    return list(itertools.islice(items, offset, stop))
+
+
+def get_metabase_collection_items(model_type, q=None, limit=None, offset=0):
     """
     Get Metabase items of a specific model type from specific collections.
 
+    The collections are fetched in parallel and their items merged, most
+    recently edited first.
+
     Args:
         model_type: The Metabase model type (dashboard or card)
+        q (optional): Only return items whose name contains this text
+        limit (optional): Maximum number of items to return
+        offset (optional): Number of matching items to skip
 
     Returns:
         List of dictionaries containing item information (id, name, type, updated_at)
@@ -378,32 +1003,51 @@ def get_metabase_collection_items(model_type):
     }
     try:
         userobj = tk.g.userobj
-        metabase_mapping = tk.get_action('metabase_mapping_show')({'ignore_auth': True}, {'user_id': userobj.id})
+        metabase_mapping = get_metabase_mapping(user_id=userobj.id) or metabase_mapping
     except Exception:
         pass
-    collection_items = []
     if model_type not in ['dashboard', 'card']:
-        return collection_items
-    # Get items of specific model type from specific collections
-    for collection_id in metabase_mapping['collection_ids']:
-        collection_results = metabase_get_request(
-            f'{METABASE_SITE_URL}/api/collection/{collection_id}/items?models={model_type}')
+        return []
+
+    def fetch_collection_items(collection_id):
+        collection_results = metabase_get_cached(
+            COLLECTION_ITEMS_KEY.format(collection_id, model_type),
+            f'{METABASE_SITE_URL}/api/collection/{collection_id}/items?models={model_type}',
+            ttl=mb_config.collection_items_cache_ttl())
         if not collection_results:
-            continue
-        for item in collection_results.get('data', []):
-            item['text'] = item.get('name', '')
-            collection_items.append(item)
-    collection_items.sort(key=lambda item: (item['last-edit-info']['timestamp']), reverse=True)
-    return collection_items
+            return []
+        return sorted(collection_results.get('data', []), key=_last_edited_at, reverse=True)
 
+    # Fetch the collections in parallel, then merge their already sorted
+    # items lazily so that a page only walks as far as it needs
+    collections = []
+    for collection_id, future in fanout.fan_out(fetch_collection_items, metabase_mapping['collection_ids']):
+        try:
+            collections.append(future.result())
+        except Exception:
+            log.exception('Failed to fetch the items of Metabase collection %s', collection_id)
+    merged = heapq.merge(*collections, key=_last_edited_at, reverse=True)
+    collection_items = (dict(item, text=item.get('name', '')) for item in merged)
+    return filter_items_by_name(collection_items, q, limit, offset)
 
-def get_metabase_chart_list(table_id, resource_id):
+
+def _last_edited_at(item):
+    return (item.get('last-edit-info') or {}).get('timestamp') or ''
+
+
+def get_metabase_chart_list(table_id, resource_id, q=None, limit=None, offset=0):
     """
     Get Metabase questions that reference a specific table and resource ID.
 
+    Uses the local card index when it has been built (see
+    ``ckan metabase index-cards``), otherwise scans the card catalog.
+
     Args:
         table_id: The Metabase table ID
         resource_id: The CKAN resource ID
+        q (optional): Only return questions whose name contains this text
+        limit (optional): Maximum number of questions to return
+        offset (optional): Number of matching questions to skip
 
     Returns:
         List of dictionaries containing question information (id, name, type, updated_at)
@@ -413,11 +1057,26 @@ def get_metabase_chart_list(table_id, resource_id):
     }
     try:
         userobj = tk.g.userobj
-        metabase_mapping = tk.get_action('metabase_mapping_show')({'ignore_auth': True}, {'user_id': userobj.id})
+        metabase_mapping = get_metabase_mapping(user_id=userobj.id) or metabase_mapping
     except Exception:
         pass
+    if _card_index_is_current():
+        return [
+            {
+                'id': card.id,
+                'entity_id': card.entity_id,
+                'name': card.name,
+                'type': card.type,
+                'updated_at': card.updated_at,
+                'text': card.name
+            }
+            for card in MetabaseCard.charts_for_resource(
+                table_id, resource_id, metabase_mapping['collection_ids'],
+                q=q, limit=limit, offset=offset)
+        ]
+
     matching_cards = []
-    card_results = metabase_get_request(f'{METABASE_SITE_URL}/api/card?f=database&model_id={METABASE_DB_ID}')
+    card_results = get_metabase_card_catalog()
     if not card_results:
         return matching_cards
     for card in card_results:
@@ -432,9 +1091,7 @@ def get_metabase_chart_list(table_id, resource_id):
                     'text': card.get('name')
                 })
             elif not card.get('table_id'):
-                dataset_query = card.get('dataset_query', {})
-                native_sql = _extract_native_sql_from_dataset_query(dataset_query)
-                if resource_id in native_sql:
+                if resource_id in card['native_sql']:
                     matching_cards.append({
                         'id': card.get('id'),
                         'entity_id': card.get('entity_id'),
@@ -444,14 +1101,16 @@ def get_metabase_chart_list(table_id, resource_id):
                         'text': card.get('name')
                     })
     matching_cards.sort(key=lambda card: (card['updated_at']), reverse=True)
-    return matching_cards
+    return filter_items_by_name(matching_cards, q, limit, offset)
 
 
 def get_metabase_user_created_cards(user_email: str) -> list:
     """
     Get Metabase cards created by a specific user.
 
-    Uses /api/collection/{collection_id}/items?models=card for server-side filtering,
+    Uses the local card index when it has been built (see
+    ``ckan metabase sync-cards``). Otherwise uses
+    /api/collection/{collection_id}/items?models=card for server-side filtering,
     then fetches individual card details in parallel to get creator information.
 
     Args:
@@ -472,7 +1131,7 @@ def get_metabase_user_created_cards(user_email: str) -> list:
     try:
         userobj = tk.g.userobj
         if userobj:
-            metabase_mapping = tk.get_action('metabase_mapping_show')({'ignore_auth': True}, {'user_id': userobj.id})
+            metabase_mapping = get_metabase_mapping(user_id=userobj.id) or metabase_mapping
     except Exception:
         pass
 
@@ -480,14 +1139,27 @@ def get_metabase_user_created_cards(user_email: str) -> list:
         return []
 
     max_results = 5
+    if _card_index_is_current():
+        return [
+            {
+                'id': card.id,
+                'name': card.name,
+                'description': card.description,
+                'type': card.type,
+                'display': card.display,
+                'created_at': parse_metabase_datetime(card.created_at),
+                'updated_at': parse_metabase_datetime(card.updated_at),
+                'creator_id': card.creator_id
+            }
+            for card in MetabaseCard.created_by(user_email, metabase_mapping['collection_ids'], limit=max_results)
+        ]
+
     page_size = 30  # Number of cards to fetch per page
     user_created_cards = []
 
-    # Fetch all card details in parallel
-    def fetch_card_details(card_id: int) -> Optional[dict]:
-        """Fetch full card details for a single card."""
+    def card_details(full_item: Optional[dict]) -> Optional[dict]:
+        """Return the details of a card if the user created it."""
         try:
-            full_item = metabase_get_request(f'{METABASE_SITE_URL}/api/card/{card_id}')
             if not full_item:
                 return None
 
@@ -509,9 +1181,7 @@ def get_metabase_user_created_cards(user_email: str) -> list:
                     'creator_id': full_item.get('creator_id')
                 }
             return None
-        except (requests.RequestException, KeyError, AttributeError) as e:
-            # Log specific errors but don't fail the entire operation
-            # In a production environment, you might want to log this
+        except (KeyError, AttributeError):
             return None
 
     # Process each collection with pagination until we have enough results
@@ -548,39 +1218,16 @@ def get_metabase_user_created_cards(user_email: str) -> list:
                 has_more = False
                 break
 
-            # Fetch card details in parallel
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                future_to_card_id = {
-                    executor.submit(fetch_card_details, card_id): card_id
-                    for card_id in card_ids
-                }
-                
-                # Process completed futures
-                for future in concurrent.futures.as_completed(future_to_card_id):
-                    # Early exit if we have enough results
-                    if len(user_created_cards) >= max_results:
-                        # Cancel remaining futures
-                        for remaining_future in future_to_card_id:
-                            if not remaining_future.done():
-                                remaining_future.cancel()
-                        break
-                    
-                    try:
-                        result = future.result()
-                        if result:
-                            user_created_cards.append(result)
-                            # Check again after adding a result
-                            if len(user_created_cards) >= max_results:
-                                # Cancel remaining futures
-                                for remaining_future in future_to_card_id:
-                                    if not remaining_future.done():
-                                        remaining_future.cancel()
-                                break
-                    except concurrent.futures.CancelledError:
-                        continue
-                    except Exception as e:
-                        # Log unexpected errors but don't fail the entire operation
-                        continue
+            # Fetch card details concurrently, closing the batch cancels the
+            # fetches not started once we have enough results
+            card_urls = [f'{METABASE_SITE_URL}/api/card/{card_id}' for card_id in card_ids]
+            with contextlib.closing(metabase_get_many(card_urls)) as results:
+                for card_url, full_item in results:
+                    result = card_details(full_item)
+                    if result:
+                        user_created_cards.append(result)
+                        if len(user_created_cards) >= max_results:
+                            break
 
             # Move to next page if we don't have enough results yet
             if len(user_created_cards) < max_results:
@@ -599,7 +1246,9 @@ def get_metabase_user_created_dashboards(user_email: str) -> list:
     """
     Get Metabase dashboards created by a specific user.
 
-    Uses /api/collection/{collection_id}/items?models=dashboard for server-side filtering,
+    Uses the local dashboard index when it has been built (see
+    ``ckan metabase sync-dashboards``). Otherwise uses
+    /api/collection/{collection_id}/items?models=dashboard for server-side filtering,
     then fetches individual dashboard details in parallel to get creator information.
 
     Args:
@@ -620,30 +1269,42 @@ def get_metabase_user_created_dashboards(user_email: str) -> list:
     try:
         userobj = tk.g.userobj
         if userobj:
-            metabase_mapping = tk.get_action('metabase_mapping_show')({'ignore_auth': True}, {'user_id': userobj.id})
+            metabase_mapping = get_metabase_mapping(user_id=userobj.id) or metabase_mapping
     except Exception:
         pass
 
     if not metabase_mapping.get('collection_ids'):
         return []
 
+    max_results = 5
+    if _dashboard_index_is_current():
+        return [
+            {
+                'id': dashboard.id,
+                'name': dashboard.name,
+                'description': dashboard.description,
+                'created_at': parse_metabase_datetime(dashboard.created_at),
+                'updated_at': parse_metabase_datetime(dashboard.updated_at),
+                'creator_id': dashboard.creator_id
+            }
+            for dashboard in MetabaseDashboard.created_by(
+                user_email, metabase_mapping['collection_ids'], limit=max_results)
+        ]
+
     # Look up the user ID by email to avoid fetching user details for each dashboard
     metabase_user_id = None
-    user_query_result = metabase_get_request(
-        f'{METABASE_SITE_URL}/api/user?query={user_email}')
+    user_query_result = metabase_get_cached(
+        f'user:{user_email}', f'{METABASE_SITE_URL}/api/user?query={user_email}')
     if user_query_result and len(user_query_result.get('data', [])) > 0:
         # Get the first matching user
         metabase_user_id = user_query_result['data'][0].get('id')
 
-    max_results = 5
     page_size = 30  # Number of dashboards to fetch per page
     user_created_dashboards = []
 
-    # Fetch all dashboard details in parallel
-    def fetch_dashboard_details(dashboard_id: int) -> Optional[dict]:
-        """Fetch full dashboard details for a single dashboard."""
+    def dashboard_details(full_item: Optional[dict]) -> Optional[dict]:
+        """Return the details of a dashboard if the user created it."""
         try:
-            full_item = metabase_get_request(f'{METABASE_SITE_URL}/api/dashboard/{dashboard_id}')
             if not full_item:
                 return None
 
@@ -665,9 +1326,7 @@ def get_metabase_user_created_dashboards(user_email: str) -> list:
                     'creator_id': full_item.get('creator_id')
                 }
             return None
-        except (requests.RequestException, KeyError, AttributeError) as e:
-            # Log specific errors but don't fail the entire operation
-            # In a production environment, you might want to log this
+        except (KeyError, AttributeError):
             return None
 
     # Process each collection with pagination until we have enough results
@@ -704,39 +1363,16 @@ def get_metabase_user_created_dashboards(user_email: str) -> list:
                 has_more = False
                 break
 
-            # Fetch dashboard details in parallel
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                future_to_dashboard_id = {
-                    executor.submit(fetch_dashboard_details, dashboard_id): dashboard_id
-                    for dashboard_id in dashboard_ids
-                }
-                
-                # Process completed futures
-                for future in concurrent.futures.as_completed(future_to_dashboard_id):
-                    # Early exit if we have enough results
-                    if len(user_created_dashboards) >= max_results:
-                        # Cancel remaining futures
-                        for remaining_future in future_to_dashboard_id:
-                            if not remaining_future.done():
-                                remaining_future.cancel()
-                        break
-                    
-                    try:
-                        result = future.result()
-                        if result:
-                            user_created_dashboards.append(result)
-                            # Check again after adding a result
-                            if len(user_created_dashboards) >= max_results:
-                                # Cancel remaining futures
-                                for remaining_future in future_to_dashboard_id:
-                                    if not remaining_future.done():
-                                        remaining_future.cancel()
-                                break
-                    except concurrent.futures.CancelledError:
-                        continue
-                    except Exception as e:
-                        # Log unexpected errors but don't fail the entire operation
-                        continue
+            # Fetch dashboard details concurrently, closing the batch cancels
+            # the fetches not started once we have enough results
+            dashboard_urls = [f'{METABASE_SITE_URL}/api/dashboard/{dashboard_id}' for dashboard_id in dashboard_ids]
+            with contextlib.closing(metabase_get_many(dashboard_urls)) as results:
+                for dashboard_url, full_item in results:
+                    result = dashboard_details(full_item)
+                    if result:
+                        user_created_dashboards.append(result)
+                        if len(user_created_dashboards) >= max_results:
+                            break
 
             # Move to next page if we don't have enough results yet
             if len(user_created_dashboards) < max_results:
@@ -806,7 +1442,9 @@ def metabase_mapping_create(data_dict):
     )
 
     model.Session.add(mapping)
+    mapping.save_memberships()
     model.Session.commit()
+    _write_mapping_through(mapping)
 
     return {
         "user_id": user_id,
@@ -831,6 +1469,7 @@ def metabase_mapping_update(data_dict):
     mapping = MetabaseMapping.get(user_id=user_id)
     if not mapping:
         raise tk.ObjectNotFound(f'No mapping found for user_id={user_id}')
+    previous = (mapping.user_id, mapping.email, mapping.platform_uuid)
 
     if data_dict.get('platform_uuid'):
         try:
@@ -855,8 +1494,10 @@ def metabase_mapping_update(data_dict):
     mapping.group_ids = ';'.join(group_ids)
     mapping.collection_ids = ';'.join(collection_ids)
     mapping.modified = datetime.datetime.utcnow()
+    mapping.save_memberships()
 
     model.Session.commit()
+    _write_mapping_through(mapping, previous)
 
     return {
         "user_id": user_id,
@@ -878,7 +1519,10 @@ def metabase_mapping_delete(data_dict):
     if not mapping:
         raise tk.ObjectNotFound(f'No mapping found for user_id {user_id}')
 
+    keys = (mapping.user_id, mapping.email, mapping.platform_uuid)
+    mapping.delete_memberships()
     model.Session.delete(mapping)
     model.Session.commit()
+    _forget_mapping(*keys)
 
     return {'message': f'Mapping for user_id {user_id} deleted successfully.'}